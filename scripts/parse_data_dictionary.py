@@ -1,12 +1,23 @@
-"""Parse deid_uf_data_dictionary.xlsx into schema_reference.json"""
+"""Parse deid_uf_data_dictionary.xlsx into schema_reference.json and schema_reference.cdw
 
+The JSON file is the human-readable reference; the .cdw file is the compact,
+table-of-contents format the server loads. Pass --from-json to rebuild the
+.cdw file from an existing schema_reference.json without the spreadsheet.
+"""
+
+import argparse
 import json
 import sys
 from pathlib import Path
 
-import openpyxl
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from cdw_medcp.schema_store import write_schema_store
+
+
+def parse_data_dictionary(xlsx_path: str, output_path: str, store_path: str):
+    import openpyxl
 
-def parse_data_dictionary(xlsx_path: str, output_path: str):
     wb = openpyxl.load_workbook(xlsx_path, read_only=True)
 
     # Parse Tables sheet
@@ -73,10 +84,27 @@ def parse_data_dictionary(xlsx_path: str, output_path: str):
         json.dump(schema, f, indent=2, default=str)
 
     print(f"Wrote {len(schema)} tables to {output_path}")
+    write_schema_store(schema, store_path)
+    print(f"Wrote {len(schema)} tables to {store_path}")
+
+
+def rebuild_store(json_path: str, store_path: str):
+    with open(json_path) as f:
+        schema = json.load(f)
+    write_schema_store(schema, store_path)
+    print(f"Wrote {len(schema)} tables to {store_path}")
 
 
 if __name__ == "__main__":
     project_root = Path(__file__).parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--from-json", action="store_true", help="Rebuild the .cdw file from data/schema_reference.json")
+    args = parser.parse_args()
+
     xlsx = project_root / "deid_uf_data_dictionary.xlsx"
     output = project_root / "data" / "schema_reference.json"
-    parse_data_dictionary(str(xlsx), str(output))
+    store = project_root / "data" / "schema_reference.cdw"
+    if args.from_json:
+        rebuild_store(str(output), str(store))
+    else:
+        parse_data_dictionary(str(xlsx), str(output), str(store))
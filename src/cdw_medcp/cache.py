@@ -0,0 +1,187 @@
+"""LRU + TTL result cache for idempotent tools, keyed on normalized SQL"""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from cdw_medcp.config import CacheConfig
+from cdw_medcp.metrics import count
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Seconds a result stays fresh, per tool. Tools not listed are never cached.
+# The CDW is refreshed nightly, so nothing is kept longer than a day.
+DEFAULT_TTLS: dict[str, float] = {
+    "query": 300,
+    "get_patient_demographics": 3600,
+    "get_encounters": 3600,
+    "get_medications": 3600,
+    "get_diagnoses": 3600,
+    "get_labs": 3600,
+    "search_diagnoses_by_code": 86400,
+    "search_medications_by_code": 86400,
+    "search_procedures_by_code": 86400,
+}
+
+# A string literal or a comment, whichever starts first; scanning them together
+# keeps -- inside a literal, and a quote inside a comment, from being misread
+_LITERAL_OR_COMMENT = re.compile(r"('(?:[^']|'')*')|--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+def normalize_sql(sql: str) -> str:
+    """Strip comments, collapse whitespace and lowercase everything outside string literals"""
+    parts, code, cursor = [], [], 0
+    for m in _LITERAL_OR_COMMENT.finditer(sql):
+        code.append(sql[cursor:m.start()])
+        cursor = m.end()
+        if m.group(1) is None:
+            code.append(" ")
+            continue
+        # Literals are kept verbatim
+        parts += [re.sub(r"\s+", " ", "".join(code)).lower(), m.group(1)]
+        code = []
+    code.append(sql[cursor:])
+    parts.append(re.sub(r"\s+", " ", "".join(code)).lower())
+    return "".join(parts).strip()
+
+
+def _last_refresh(refresh_time: str, now: datetime) -> float:
+    """Epoch time of the most recent occurrence of the HH:MM refresh time"""
+    hour, minute = (int(x) for x in refresh_time.split(":"))
+    boundary = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if boundary > now:
+        boundary -= timedelta(days=1)
+    return boundary.timestamp()
+
+
+class ResultCache:
+    """Byte-bounded LRU cache of rendered tool results with per-tool TTLs.
+
+    Entries are keyed on (normalized SQL, row_limit). Concurrent misses for
+    the same key share a single database call. invalidate_all() drops every
+    entry cached before a given refresh timestamp, and a configured nightly
+    refresh_time does the same automatically once per day.
+    """
+
+    def __init__(self, config: CacheConfig | None = None):
+        self._config = config or CacheConfig()
+        self._ttls = {**DEFAULT_TTLS, **self._config.ttl_overrides}
+        self._entries: OrderedDict = OrderedDict()  # key -> (value, size, created_at, expires_at)
+        self._bytes = 0
+        self._valid_after = 0.0
+        self._inflight: dict = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def ttl_for(self, tool: str) -> float:
+        return self._ttls.get(tool, 0) if self._config.max_bytes else 0
+
+    @staticmethod
+    def make_key(sql: str, row_limit: Optional[int]) -> tuple:
+        return normalize_sql(sql), row_limit
+
+    def _cutoff(self, now: float) -> float:
+        cutoff = self._valid_after
+        if self._config.refresh_time:
+            cutoff = max(cutoff, _last_refresh(self._config.refresh_time, datetime.fromtimestamp(now)))
+        return cutoff
+
+    def _drop(self, key) -> None:
+        value, size, _, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, _, created_at, expires_at = entry
+                if now < expires_at and created_at >= self._cutoff(now):
+                    self._entries.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return value
+                self._drop(key)
+                self._counters["expirations"] += 1
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key, value: str, ttl: float) -> None:
+        size = len(value.encode("utf-8")) + len(key[0])
+        if ttl <= 0 or size > self._config.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, size, now, now + ttl)
+            self._bytes += size
+            while self._bytes > self._config.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self._counters["evictions"] += 1
+
+    async def fetch(self, tool: str, sql: str, row_limit: Optional[int], load: Callable[[], Awaitable[str]]) -> str:
+        """Return the cached result for this SQL, or run load() and cache what it returns"""
+        ttl = self.ttl_for(tool)
+        if ttl <= 0:
+            return await load()
+        key = self.make_key(sql, row_limit)
+        cached = self.get(key)
+        if cached is not None:
+            count("cache_hits")
+            return cached
+        count("cache_misses")
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await self._wait(key, pending[0])
+        task = asyncio.ensure_future(load())
+        self._inflight[key] = [task, 0]
+        value = await self._wait(key, task)
+        self.put(key, value, ttl)
+        return value
+
+    async def _wait(self, key, task: asyncio.Future) -> str:
+        """Await a shared load; the load is cancelled once every caller waiting for it is cancelled"""
+        entry = self._inflight.get(key) or [task, 0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+            if task.done() or not entry[1]:
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+
+    def invalidate_all(self, refreshed_at: Optional[float] = None) -> int:
+        """Discard every entry cached before refreshed_at (default: now). Returns entries dropped."""
+        cutoff = time.time() if refreshed_at is None else refreshed_at
+        with self._lock:
+            self._valid_after = max(self._valid_after, cutoff)
+            stale = [key for key, (_, _, created_at, _) in self._entries.items() if created_at < self._valid_after]
+            for key in stale:
+                self._drop(key)
+            self._counters["invalidations"] += 1
+        logger.info(f"Result cache invalidated: {len(stale)} entries dropped")
+        return len(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": round(self._counters["hits"] / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._config.max_bytes,
+                "valid_after": datetime.fromtimestamp(self._valid_after).isoformat() if self._valid_after else None,
+                "refresh_time": self._config.refresh_time,
+            }
@@ -16,6 +16,9 @@ def main() -> None:
     logger.info("Starting CDW_MedCP - Clinical Data Warehouse MCP Server")
 
     server_main(
+        transport=os.getenv("CDW_TRANSPORT", "stdio"),
+        host=os.getenv("CDW_HOST", "127.0.0.1"),
+        port=int(os.getenv("CDW_PORT", "8000")),
         clinical_records_server=os.getenv("CLINICAL_RECORDS_SERVER"),
         clinical_records_database=os.getenv("CLINICAL_RECORDS_DATABASE"),
         clinical_records_username=os.getenv("CLINICAL_RECORDS_USERNAME"),
@@ -23,6 +26,30 @@ def main() -> None:
         namespace=os.getenv("CDW_NAMESPACE", "CDW"),
         schema=os.getenv("CDW_SCHEMA", "deid_uf"),
         log_level=log_level,
+        pool_min_size=int(os.getenv("CDW_POOL_MIN_SIZE", "1")),
+        pool_max_size=int(os.getenv("CDW_POOL_MAX_SIZE", "8")),
+        pool_idle_timeout=float(os.getenv("CDW_POOL_IDLE_TIMEOUT", "300")),
+        max_concurrent_queries=int(os.getenv("CDW_MAX_CONCURRENT_QUERIES", "8")),
+        max_queued_queries=int(os.getenv("CDW_MAX_QUEUED_QUERIES", "32")),
+        cache_max_mb=int(os.getenv("CDW_CACHE_MAX_MB", "64")),
+        cache_refresh_time=os.getenv("CDW_CACHE_REFRESH_TIME") or None,
+        max_open_cursors=int(os.getenv("CDW_MAX_OPEN_CURSORS", "4")),
+        cursor_idle_timeout=float(os.getenv("CDW_CURSOR_IDLE_TIMEOUT", "120")),
+        notes_index_dir=os.getenv("CDW_NOTES_INDEX_DIR") or None,
+        notes_index_max_mb=int(os.getenv("CDW_NOTES_INDEX_MAX_MB", "1024")),
+        notes_index_max_age_hours=float(os.getenv("CDW_NOTES_INDEX_MAX_AGE_HOURS", "24")),
+        note_cache_dir=os.getenv("CDW_NOTE_CACHE_DIR") or None,
+        note_cache_max_mb=int(os.getenv("CDW_NOTE_CACHE_MAX_MB", "128")),
+        terminology_dir=os.getenv("CDW_TERMINOLOGY_DIR") or None,
+        terminology_max_age_hours=float(os.getenv("CDW_TERMINOLOGY_MAX_AGE_HOURS", "168")),
+        max_query_cost=float(os.getenv("CDW_MAX_QUERY_COST", "0")),
+        max_scan_rows=int(os.getenv("CDW_MAX_SCAN_ROWS", "0")),
+        slow_query_dir=os.getenv("CDW_SLOW_QUERY_DIR") or None,
+        slow_query_ms=float(os.getenv("CDW_SLOW_QUERY_MS", "1000")),
+        slow_query_max_mb=int(os.getenv("CDW_SLOW_QUERY_MAX_MB", "64")),
+        query_timeout=float(os.getenv("CDW_QUERY_TIMEOUT", "300")),
+        tool_timeouts=os.getenv("CDW_TOOL_TIMEOUTS") or None,
+        login_timeout=int(os.getenv("CDW_LOGIN_TIMEOUT", "30")),
     )
 
 
@@ -0,0 +1,128 @@
+"""Reusable code sets: expanded terminology keys referenced from SQL by a short handle"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastmcp.exceptions import ToolError
+
+from cdw_medcp.patients import quote_literal
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Expanded code sets kept in memory, and the most keys one set may hold
+MAX_CODE_SETS = 256
+MAX_CODESET_KEYS = 50_000
+
+# Keys per IN (...) list when a handle is inlined; SQL Server compiles several
+# short lists far faster than one list of thousands of literals
+IN_LIST_CHUNK = 1000
+
+# col [NOT] IN ({{codeset:cs_xxx}}) and a bare {{codeset:cs_xxx}}
+_IN_HANDLE = re.compile(
+    r"(?P<column>(?:\[[^\]]+\]|[\w#@$]+)(?:\.(?:\[[^\]]+\]|[\w#@$]+))*)\s+(?P<negate>NOT\s+)?IN\s*"
+    r"\(\s*\{\{\s*codeset:(?P<handle>\w+)\s*\}\}\s*\)",
+    re.IGNORECASE,
+)
+_BARE_HANDLE = re.compile(r"\{\{\s*codeset:(?P<handle>\w+)\s*\}\}", re.IGNORECASE)
+
+
+def placeholder(handle: str) -> str:
+    return "{{codeset:" + handle + "}}"
+
+
+def _literal(key) -> str:
+    return str(key) if isinstance(key, int) else quote_literal(key)
+
+
+class CodeSetStore:
+    """LRU store of expanded code sets, addressed by deterministic handles.
+
+    A handle is derived from the domain, code type and normalized patterns,
+    so expanding the same request again returns the same handle (refreshing
+    its keys). SQL passed to query, export_query_to_csv and cohort_summary may
+    use col IN ({{codeset:<handle>}}); expand_sql() rewrites it into chunked
+    IN lists before the statement is validated and run.
+    """
+
+    def __init__(self, max_entries: int = MAX_CODE_SETS):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"expansions": 0, "inlined": 0, "unknown_handles": 0}
+
+    @staticmethod
+    def handle_for(domain: str, patterns: list[str], code_type: Optional[str]) -> str:
+        canonical = "|".join([domain, (code_type or "").upper()] + sorted({p.strip().upper() for p in patterns}))
+        return "cs_" + hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:12]
+
+    def put(self, domain: str, patterns: list[str], code_type: Optional[str], key_column: str,
+            keys_by_pattern: dict[str, list], source: str) -> dict:
+        """Store an expansion and return its summary (handle, counts, sample keys)"""
+        handle = self.handle_for(domain, patterns, code_type)
+        keys = sorted({k for found in keys_by_pattern.values() for k in found}, key=lambda k: (isinstance(k, str), k))
+        entry = {
+            "handle": handle,
+            "domain": domain,
+            "code_type": code_type,
+            "key_column": key_column,
+            "keys": keys,
+            "pattern_counts": {pattern: len(found) for pattern, found in keys_by_pattern.items()},
+            "source": source,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._entries.pop(handle, None)
+            self._entries[handle] = entry
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self._counters["expansions"] += 1
+        logger.info(f"Code set {handle}: {len(keys)} {key_column} values from {len(keys_by_pattern)} patterns ({source})")
+        return entry
+
+    def get(self, handle: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(handle)
+            if entry is None:
+                self._counters["unknown_handles"] += 1
+                raise ToolError(f"Unknown or expired code set {handle!r}. Run expand_code_set again to get a handle.")
+            self._entries.move_to_end(handle)
+            return entry
+
+    def expand_sql(self, sql: str) -> str:
+        """Inline every {{codeset:<handle>}} in sql as literal key lists; other SQL passes through unchanged"""
+        if "{{" not in sql:
+            return sql
+
+        def in_lists(match: re.Match) -> str:
+            keys = self.get(match.group("handle"))["keys"]
+            column, negate = match.group("column"), bool(match.group("negate"))
+            if not keys:
+                return "1 = 1" if negate else "1 = 0"
+            operator, joiner = ("NOT IN", " AND ") if negate else ("IN", " OR ")
+            chunks = [keys[i:i + IN_LIST_CHUNK] for i in range(0, len(keys), IN_LIST_CHUNK)]
+            lists = [f"{column} {operator} ({', '.join(_literal(k) for k in chunk)})" for chunk in chunks]
+            return lists[0] if len(lists) == 1 else "(" + joiner.join(lists) + ")"
+
+        def bare_list(match: re.Match) -> str:
+            keys = self.get(match.group("handle"))["keys"]
+            return ", ".join(_literal(k) for k in keys) if keys else "NULL"
+
+        expanded = _BARE_HANDLE.sub(bare_list, _IN_HANDLE.sub(in_lists, sql))
+        if expanded != sql:
+            with self._lock:
+                self._counters["inlined"] += 1
+        return expanded
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "max_entries": self._max_entries,
+                "keys": sum(len(entry["keys"]) for entry in self._entries.values()),
+            }
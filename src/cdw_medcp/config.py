@@ -1,6 +1,8 @@
 """CDW_MedCP configuration models"""
 
-from pydantic import BaseModel, Field
+from typing import Optional
+
+from pydantic import BaseModel, Field, field_validator
 
 
 class ClinicalDBConfig(BaseModel):
@@ -11,9 +13,98 @@ class ClinicalDBConfig(BaseModel):
     password: str = Field(..., description="CDW database password")
 
 
+class PoolConfig(BaseModel):
+    """Connection pool sizing and health-check settings"""
+    min_size: int = Field(1, ge=0, description="Connections kept open even when idle")
+    max_size: int = Field(8, ge=1, description="Maximum open connections")
+    idle_timeout: float = Field(300.0, ge=0, description="Seconds an idle connection is kept before eviction (0 = never)")
+    checkout_timeout: float = Field(30.0, gt=0, description="Seconds to wait for a free connection before failing")
+    health_check_after: float = Field(30.0, ge=0, description="Ping connections idle longer than this many seconds on checkout (0 = always)")
+    login_timeout: int = Field(30, ge=1, description="Seconds to wait for a new connection's login before failing")
+
+
+class ExecutorConfig(BaseModel):
+    """Worker pool and admission control for blocking database work"""
+    max_workers: int = Field(8, ge=1, description="Maximum database calls executing concurrently")
+    max_queue: int = Field(32, ge=0, description="Maximum calls waiting for a worker before new calls are rejected")
+    reserved_workers: int = Field(2, ge=0, description="Workers reserved for lightweight lookups so heavy queries cannot starve them")
+    default_timeout: float = Field(300.0, ge=0, description="Seconds a database call may run before its statement is cancelled, for tools without a built-in timeout (0 = no limit)")
+    timeout_overrides: dict[str, float] = Field(default_factory=dict, description="Per-tool timeouts in seconds (0 = no limit), overriding the built-in defaults")
+
+    @field_validator("timeout_overrides", mode="before")
+    @classmethod
+    def _parse_overrides(cls, value):
+        """Accept "tool=seconds,tool=seconds" as well as a mapping"""
+        if not isinstance(value, str):
+            return value
+        overrides = {}
+        for item in filter(None, (part.strip() for part in value.split(","))):
+            tool, sep, seconds = item.partition("=")
+            if not sep:
+                raise ValueError(f"Expected tool=seconds, got {item!r}")
+            overrides[tool.strip()] = seconds.strip()
+        return overrides
+
+
+class CacheConfig(BaseModel):
+    """Result cache settings for idempotent tools"""
+    max_bytes: int = Field(64 * 1024 * 1024, ge=0, description="Total size budget for cached results (0 disables caching)")
+    ttl_overrides: dict[str, float] = Field(default_factory=dict, description="Per-tool TTL in seconds, overriding the built-in defaults")
+    refresh_time: Optional[str] = Field(None, pattern=r"^\d{1,2}:\d{2}$", description="Local HH:MM of the nightly CDW refresh; results cached before it are discarded")
+
+
+class CursorConfig(BaseModel):
+    """Server-side result cursors held open for paged query results"""
+    max_open: int = Field(4, ge=0, description="Result cursors held open at once; each holds a pooled connection (0 disables paging)")
+    idle_timeout: float = Field(120.0, gt=0, description="Seconds an unread result cursor is kept before it is closed")
+
+
+class NotesIndexConfig(BaseModel):
+    """Opt-in local full-text indexes of per-patient notes"""
+    directory: Optional[str] = Field(None, description="Directory for per-patient note indexes (unset disables indexed note search)")
+    max_disk_mb: int = Field(1024, ge=1, description="Disk budget for all indexes; least recently searched patients are evicted beyond it")
+    max_age_hours: float = Field(24.0, gt=0, description="Hours before a patient's index is rebuilt from the CDW")
+
+
+class NoteCacheConfig(BaseModel):
+    """Compressed cache of retrieved clinical notes"""
+    directory: Optional[str] = Field(None, description="Directory for cached notes (unset keeps them in memory)")
+    max_mb: int = Field(128, ge=0, description="Compressed size budget for cached notes (0 disables the cache)")
+    max_age_hours: float = Field(24.0, gt=0, description="Hours a cached note is served before it is fetched again")
+
+
+class TerminologyConfig(BaseModel):
+    """Local snapshot of the terminology dimensions used by concept search"""
+    directory: Optional[str] = Field(None, description="Directory for the terminology snapshot (unset searches the live CDW)")
+    max_age_hours: float = Field(168.0, gt=0, description="Hours a snapshot is used before concept search falls back to the live CDW")
+
+
+class CostGuardConfig(BaseModel):
+    """Limits on a statement's estimated plan, checked before ad-hoc SQL runs"""
+    max_cost: float = Field(0.0, ge=0, description="Reject statements whose estimated subtree cost exceeds this (0 = no limit)")
+    max_scan_rows: int = Field(0, ge=0, description="Reject statements with a single scan estimated to read more rows than this (0 = no limit)")
+
+
+class SlowQueryLogConfig(BaseModel):
+    """Log of statements slower than a threshold, for finding the query shapes that load the CDW"""
+    directory: Optional[str] = Field(None, description="Directory for the slow-query log files (unset disables the log)")
+    threshold_ms: float = Field(1000.0, ge=0, description="Statements running at least this many milliseconds are logged (0 = all)")
+    max_mb: int = Field(64, ge=1, description="Size at which the log file is rotated")
+    backups: int = Field(5, ge=0, description="Rotated log files kept")
+
+
 class CDWConfig(BaseModel):
     """Complete CDW_MedCP server configuration"""
     clinical_db: ClinicalDBConfig = Field(..., description="Clinical Data Warehouse configuration")
+    pool: PoolConfig = Field(default_factory=PoolConfig, description="Connection pool configuration")
+    executor: ExecutorConfig = Field(default_factory=ExecutorConfig, description="Database worker pool configuration")
+    cache: CacheConfig = Field(default_factory=CacheConfig, description="Result cache configuration")
+    cursors: CursorConfig = Field(default_factory=CursorConfig, description="Paged query result configuration")
+    notes_index: NotesIndexConfig = Field(default_factory=NotesIndexConfig, description="Local notes index configuration")
+    note_cache: NoteCacheConfig = Field(default_factory=NoteCacheConfig, description="Note cache configuration")
+    terminology: TerminologyConfig = Field(default_factory=TerminologyConfig, description="Terminology snapshot configuration")
+    cost_guard: CostGuardConfig = Field(default_factory=CostGuardConfig, description="Pre-execution cost limits")
+    slow_query_log: SlowQueryLogConfig = Field(default_factory=SlowQueryLogConfig, description="Slow-query log configuration")
     namespace: str = Field("CDW", description="Tool namespace prefix")
     db_schema: str = Field("deid_uf", description="Database schema for table qualification (e.g., deid or deid_uf)")
     log_level: str = Field("INFO", description="Logging level")
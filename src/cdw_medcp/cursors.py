@@ -0,0 +1,228 @@
+"""Server-side result cursors that let a query's rows be read page by page"""
+
+import logging
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from fastmcp.exceptions import ToolError
+
+from cdw_medcp.config import CursorConfig
+from cdw_medcp.db import CallScope, ConnectionPool
+from cdw_medcp.metrics import count, record, statement, timed
+from cdw_medcp.rendering import FETCH_CHUNK_ROWS, BoundedCSV
+
+logger = logging.getLogger("CDW_MedCP")
+
+
+class _HeldResult:
+    """An executed query whose remaining rows have not been read yet"""
+
+    def __init__(self, handle: str, conn, cursor, columns: list[str]):
+        self.handle = handle
+        self.conn = conn
+        self.cursor = cursor
+        self.columns = columns
+        self.lock = threading.Lock()
+        self.next_row = 0
+        self.pending: deque = deque()  # fetched but not yet served
+        self.exhausted = False
+        self.last_used = time.monotonic()
+        self.last_token: Optional[str] = None
+        self.last_page: Optional[dict] = None
+
+
+class CursorStore:
+    """Hold open query results across tool calls, so later pages cost no re-execution.
+
+    Each held result keeps its pooled connection checked out until its last
+    row is read, it sits unread for idle_timeout, or it is closed. When
+    max_open results are held, opening another closes the least recently used
+    one. Pages are addressed by tokens "<handle>.<first row>"; asking for the
+    page just served again (a retried call) returns it from memory.
+
+    All methods block on the database and are meant to run on executor workers.
+    """
+
+    def __init__(self, pool: ConnectionPool, config: CursorConfig | None = None):
+        self._pool = pool
+        self._config = config or CursorConfig()
+        self._results: dict[str, _HeldResult] = {}
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "exhausted": 0, "expired": 0, "evicted": 0, "closed": 0, "pages": 0}
+        self._stop = threading.Event()
+        self._reaper = threading.Thread(target=self._reap_loop, name="cdw-cursor-reaper", daemon=True)
+        self._reaper.start()
+
+    @property
+    def enabled(self) -> bool:
+        return self._config.max_open > 0
+
+    @staticmethod
+    def _page(held: _HeldResult, page_size: int) -> dict:
+        """Render up to page_size rows within the response byte budget.
+
+        Rows that do not fit the budget stay pending for the next page, so a
+        byte-limited page never skips rows. One row is peeked ahead to know
+        whether a next page exists.
+        """
+        started = time.perf_counter()
+        fetching = 0.0
+        builder = BoundedCSV(held.columns)
+        byte_limited = False
+        while builder.rows < page_size:
+            if not held.pending:
+                fetch_started = time.perf_counter()
+                held.pending.extend(held.cursor.fetchmany(min(FETCH_CHUNK_ROWS, page_size - builder.rows)))
+                fetching += time.perf_counter() - fetch_started
+                if not held.pending:
+                    held.exhausted = True
+                    break
+            if not builder.add(held.pending[0]):
+                byte_limited = True
+                break
+            held.pending.popleft()
+        if not held.pending and not held.exhausted:
+            row = held.cursor.fetchone()
+            if row is None:
+                held.exhausted = True
+            else:
+                held.pending.append(row)
+        first_row = held.next_row + 1
+        held.next_row += builder.rows
+        held.last_used = time.monotonic()
+        text = builder.text()
+        record("fetch", fetching)
+        record("render", time.perf_counter() - started - fetching)
+        count("rows", builder.rows)
+        return {
+            "text": text,
+            "first_row": first_row,
+            "rows": builder.rows,
+            "byte_limited": byte_limited,
+            "clipped_columns": builder.clipped_columns,
+            "next_token": None if held.exhausted and not held.pending else f"{held.handle}.{held.next_row}",
+        }
+
+    def _release(self, held: _HeldResult, reason: str) -> None:
+        with self._lock:
+            if self._results.pop(held.handle, None) is None:
+                return
+            self._stats[reason] += 1
+        try:
+            held.cursor.close()
+        except Exception:
+            pass
+        self._pool.recycle(held.conn)
+        logger.debug(f"Result cursor {held.handle} released ({reason}) after {held.next_row} rows")
+
+    def open(self, sql: str, page_size: int) -> dict:
+        """Execute sql and return its first page, holding the cursor if more rows remain"""
+        conn = self._pool.acquire()
+        handle = secrets.token_hex(8)
+        try:
+            cursor = conn.cursor()
+            with statement(sql):
+                with timed("execute"):
+                    cursor.execute(sql)
+                if not cursor.description:
+                    self._pool.recycle(conn)
+                    return {"text": None, "first_row": 1, "rows": 0, "next_token": None}
+                held = _HeldResult(handle, conn, cursor, [desc[0] for desc in cursor.description])
+                page = self._page(held, page_size)
+        except Exception:
+            self._pool.recycle(conn)
+            raise
+
+        if page["next_token"] is None:
+            cursor.close()
+            self._pool.recycle(conn)
+            return page
+
+        with self._lock:
+            self._results[handle] = held
+            self._stats["opened"] += 1
+            victims = self._over_limit()
+        for victim in victims:
+            self._release(victim, "evicted")
+        return page
+
+    def _over_limit(self) -> list[_HeldResult]:
+        """Least recently used idle results beyond max_open (caller holds the lock)"""
+        excess = len(self._results) - self._config.max_open
+        if excess <= 0:
+            return []
+        idle = sorted((h for h in self._results.values() if not h.lock.locked()), key=lambda h: h.last_used)
+        return idle[:excess]
+
+    def fetch(self, token: str, page_size: int) -> dict:
+        """Return the page starting at the token's row"""
+        handle, _, offset = token.partition(".")
+        with self._lock:
+            held = self._results.get(handle)
+        if held is None or not offset.isdigit():
+            raise ToolError("Unknown or expired page token. Results are released after their last page or when idle; re-run the query.")
+        with held.lock:
+            if token == held.last_token:
+                return held.last_page
+            # The held connection was checked out by an earlier call; let this one cancel it
+            scope = CallScope.current()
+            if scope is not None:
+                scope.add(held.conn)
+            if int(offset) != held.next_row:
+                raise ToolError(f"Stale page token: the next page of this result starts at row {held.next_row + 1}.")
+            try:
+                page = self._page(held, page_size)
+            except Exception:
+                # The session is in an unknown state; give the connection back
+                self._release(held, "closed")
+                raise
+            held.last_token, held.last_page = token, page
+            with self._lock:
+                self._stats["pages"] += 1
+        if page["next_token"] is None:
+            self._release(held, "exhausted")
+        return page
+
+    def close(self, token: str) -> bool:
+        """Release the result a page token belongs to; False if it was already gone"""
+        handle = token.partition(".")[0]
+        with self._lock:
+            held = self._results.get(handle)
+        if held is None:
+            return False
+        with held.lock:
+            self._release(held, "closed")
+        return True
+
+    def _reap_loop(self) -> None:
+        interval = min(self._config.idle_timeout / 4, 30.0)
+        while not self._stop.wait(interval):
+            self.reap()
+
+    def reap(self) -> None:
+        """Release results that have gone unread for idle_timeout"""
+        cutoff = time.monotonic() - self._config.idle_timeout
+        with self._lock:
+            expired = [h for h in self._results.values() if h.last_used < cutoff and not h.lock.locked()]
+        for held in expired:
+            self._release(held, "expired")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "open": len(self._results),
+                "max_open": self._config.max_open,
+                "idle_timeout": self._config.idle_timeout,
+            }
+
+    def close_all(self) -> None:
+        """Release every held result and stop the idle reaper"""
+        self._stop.set()
+        with self._lock:
+            held = list(self._results.values())
+        for h in held:
+            self._release(h, "closed")
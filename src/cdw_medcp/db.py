@@ -1,24 +1,288 @@
-"""Database connection management (identical pattern to MedCP)"""
+"""Database connection management — bounded pool of reusable pymssql connections"""
 
 import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 
 import pymssql
 from fastmcp.exceptions import ToolError
 
-from cdw_medcp.config import ClinicalDBConfig
+from cdw_medcp.config import ClinicalDBConfig, PoolConfig
+from cdw_medcp.metrics import timed
 
 logger = logging.getLogger("CDW_MedCP")
 
 
-def get_connection(config: ClinicalDBConfig):
-    """Get a per-query database connection"""
+def get_connection(config: ClinicalDBConfig, login_timeout: int = 30):
+    """Open a new database connection, giving up on the login after login_timeout seconds.
+
+    Connections run in autocommit mode: pooled sessions live for many tool
+    calls and are never committed, so an implicit transaction would hold its
+    locks and tempdb work (#cohort and friends) for the life of the session.
+    """
     try:
         return pymssql.connect(
             server=config.server,
             user=config.username,
             password=config.password,
-            database=config.database
+            database=config.database,
+            login_timeout=login_timeout,
+            autocommit=True,
         )
     except Exception as e:
         logger.error(f"Database connection failed: {e}")
         raise ToolError(f"Database connection failed: {e}")
+
+
+def _reset(conn) -> bool:
+    """Flush any unread results so the session can be reused; False if the link is dead"""
+    try:
+        raw = conn._conn
+        raw.cancel()
+        return bool(raw.connected)
+    except Exception:
+        return False
+
+
+def _close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class CallScope:
+    """Connections checked out on behalf of one executor call.
+
+    The executor enters a scope on the worker thread before running a call;
+    every connection the pool hands out on that thread while the scope is
+    active is recorded, so cancel() can interrupt the statements from another
+    thread. Connections released after a cancel are discarded rather than
+    pooled, since their session state is unknown.
+    """
+
+    _current = threading.local()
+
+    def __init__(self):
+        self.cancelled = False
+        self._connections: list = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def current(cls) -> "CallScope | None":
+        return getattr(cls._current, "scope", None)
+
+    @contextmanager
+    def active(self):
+        CallScope._current.scope = self
+        try:
+            yield self
+        finally:
+            CallScope._current.scope = None
+
+    def add(self, conn) -> None:
+        with self._lock:
+            self._connections.append(conn)
+
+    def owns(self, conn) -> bool:
+        with self._lock:
+            return any(c is conn for c in self._connections)
+
+    def cancel(self) -> int:
+        """Send a cancel to every connection of the call; returns how many were signalled"""
+        with self._lock:
+            self.cancelled = True
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn._conn.cancel()
+            except Exception as e:
+                logger.debug(f"Cancel of an in-flight statement failed: {e}")
+        return len(connections)
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of pymssql connections.
+
+    Connections are reused across tool calls instead of paying a TDS login
+    per call. Idle connections beyond min_size are evicted after idle_timeout,
+    connections idle longer than health_check_after are pinged on checkout,
+    and broken connections are replaced transparently.
+    """
+
+    def __init__(self, db_config: ClinicalDBConfig, pool_config: PoolConfig | None = None):
+        self._db_config = db_config
+        self._config = pool_config or PoolConfig()
+        self._idle: deque = deque()  # (conn, last_used) — most recently used on the right
+        self._open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "connects": 0,
+            "reconnects": 0,
+            "evictions": 0,
+            "discards": 0,
+            "waits": 0,
+            "wait_timeouts": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+
+    def _evict_idle(self, now: float) -> list:
+        """Pop idle connections past idle_timeout (caller holds the lock)"""
+        expired = []
+        timeout = self._config.idle_timeout
+        if timeout <= 0:
+            return expired
+        # Oldest connections sit on the left
+        while self._idle and self._open > self._config.min_size and now - self._idle[0][1] > timeout:
+            conn, _ = self._idle.popleft()
+            self._open -= 1
+            self._stats["evictions"] += 1
+            expired.append(conn)
+        return expired
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        """Check out a connection, waiting up to checkout_timeout for a free slot"""
+        start = time.monotonic()
+        deadline = start + self._config.checkout_timeout
+        waited = False
+        # Evicted connections are closed outside the lock, however the wait ends
+        expired = []
+        try:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise ToolError("Connection pool is closed")
+                    expired.extend(self._evict_idle(time.monotonic()))
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._open < self._config.max_size:
+                        conn, last_used = None, None
+                        self._open += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["wait_timeouts"] += 1
+                        raise ToolError(
+                            f"Timed out after {self._config.checkout_timeout:.0f}s waiting for a database connection "
+                            f"(pool max_size={self._config.max_size})"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+                wait_ms = (time.monotonic() - start) * 1000
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                self._stats["wait_ms_total"] += wait_ms
+                self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+        finally:
+            for stale in expired:
+                _close_quietly(stale)
+
+        # Network I/O happens outside the lock
+        if conn is not None:
+            if time.monotonic() - last_used < self._config.health_check_after or self._is_healthy(conn):
+                return self._bind(conn)
+            logger.warning("Pooled connection failed health check; reconnecting")
+            _close_quietly(conn)
+            with self._cond:
+                self._stats["reconnects"] += 1
+        try:
+            with timed("connect"):
+                conn = get_connection(self._db_config, self._config.login_timeout)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats["connects"] += 1
+        return self._bind(conn)
+
+    def _bind(self, conn):
+        """Record conn in the calling thread's executor call, if any, so it can be cancelled"""
+        scope = CallScope.current()
+        if scope is not None:
+            scope.add(conn)
+            if scope.cancelled:
+                self.release(conn)
+                raise ToolError("Call cancelled before it reached the database")
+        return conn
+
+    def release(self, conn, discard: bool = False) -> None:
+        """Return a connection to the pool, or close it if it is no longer usable"""
+        scope = CallScope.current()
+        if scope is not None and scope.cancelled and scope.owns(conn):
+            discard = True
+        with self._cond:
+            if discard or self._closed:
+                self._open -= 1
+                self._stats["discards"] += int(discard)
+            else:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            _close_quietly(conn)
+
+    def recycle(self, conn) -> None:
+        """Reset a borrowed connection and return it, discarding it if the reset fails"""
+        self.release(conn, discard=not _reset(conn))
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with-block.
+
+        The connection is discarded instead of returned if it can no longer
+        be reset, so a broken session is never handed to the next caller.
+        """
+        with timed("checkout"):
+            conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.recycle(conn)
+
+    def stats(self) -> dict:
+        """Snapshot of pool size and checkout wait statistics"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._open - len(self._idle),
+                "min_size": self._config.min_size,
+                "max_size": self._config.max_size,
+            })
+        checkouts = stats["checkouts"]
+        stats["wait_ms_avg"] = round(stats["wait_ms_total"] / checkouts, 2) if checkouts else 0.0
+        stats["wait_ms_total"] = round(stats["wait_ms_total"], 2)
+        stats["wait_ms_max"] = round(stats["wait_ms_max"], 2)
+        return stats
+
+    def close(self) -> None:
+        """Close all idle connections and refuse further checkouts"""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._open -= len(idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            _close_quietly(conn)
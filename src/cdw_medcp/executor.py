@@ -0,0 +1,223 @@
+"""Bounded worker pool that keeps blocking pymssql calls off the event loop"""
+
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from fastmcp.exceptions import ToolError
+
+from cdw_medcp.config import ExecutorConfig
+from cdw_medcp.db import CallScope, ConnectionPool
+from cdw_medcp.metrics import record
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Seconds a call may run before its statement is cancelled on the server, per
+# tool (0 = no limit). Lookups fail fast; statistics and exports get longer.
+# Tools not listed use ExecutorConfig.default_timeout.
+DEFAULT_TIMEOUTS: dict[str, float] = {
+    "resolve_patient": 15,
+    "get_patient_demographics": 30,
+    "search_diagnoses_by_code": 30,
+    "search_medications_by_code": 30,
+    "search_procedures_by_code": 30,
+    "get_note": 30,
+    "get_notes": 60,
+    "explain_query": 60,
+    "expand_code_set": 120,
+    "get_encounters": 120,
+    "get_medications": 120,
+    "get_diagnoses": 120,
+    "get_labs": 120,
+    "get_patient_timeline": 120,
+    "cohort_summary": 900,
+    "summarize_table": 900,
+    "search_notes_indexed": 900,
+    "refresh_terminology_snapshot": 3600,
+    "export_query_to_csv": 4 * 3600,
+}
+
+
+class _Lane:
+    """One fixed-size group of worker threads with its own admission counters"""
+
+    def __init__(self, name: str, workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"cdw-db-{name}")
+        self.queued = 0
+        self.active = 0
+        self.rejected = 0
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
+
+
+class QueryExecutor:
+    """Run blocking database work on a dedicated, size-limited thread pool.
+
+    At most max_workers calls execute at once and at most max_queue wait for a
+    worker; anything beyond that is rejected immediately with a "server busy"
+    error instead of piling up. Heavy calls (ad-hoc SQL, cohort statistics,
+    exports) share the workers left after reserved_workers are set aside for
+    lightweight lookups, so a burst of slow queries cannot delay get_note and
+    friends. Time spent waiting for a worker is tracked separately from
+    execution time, per tool.
+
+    Every call runs under a per-tool timeout. When it expires, or when the
+    awaiting tool call is cancelled by the client, the statements of the call
+    are cancelled on the server and its connections are discarded, so
+    abandoned work stops holding warehouse capacity and a pooled session.
+    """
+
+    def __init__(self, pool: ConnectionPool, config: ExecutorConfig | None = None):
+        self.pool = pool
+        self._config = config or ExecutorConfig()
+        reserved = min(self._config.reserved_workers, self._config.max_workers - 1)
+        self._heavy = _Lane("heavy", self._config.max_workers - reserved, self._config.max_queue)
+        self._light = _Lane("light", reserved, self._config.max_queue) if reserved else self._heavy
+        self._lock = threading.Lock()
+        self._tool_stats: dict[str, dict] = {}
+        self._timeouts = {**DEFAULT_TIMEOUTS, **self._config.timeout_overrides}
+
+    def timeout_for(self, tool: str) -> Optional[float]:
+        """Seconds tool's calls may run, or None for no limit"""
+        timeout = self._timeouts.get(tool, self._config.default_timeout)
+        return timeout if timeout > 0 else None
+
+    def _tool_entry(self, tool: str) -> dict:
+        entry = self._tool_stats.get(tool)
+        if entry is None:
+            entry = self._tool_stats[tool] = {
+                "calls": 0, "errors": 0, "rejected": 0, "timeouts": 0, "cancelled": 0,
+                "queue_ms_total": 0.0, "queue_ms_max": 0.0,
+                "exec_ms_total": 0.0, "exec_ms_max": 0.0,
+            }
+        return entry
+
+    def _admit(self, lane: _Lane, tool: str) -> None:
+        with self._lock:
+            if lane.queued >= lane.max_queue and lane.active >= lane.workers:
+                lane.rejected += 1
+                self._tool_entry(tool)["rejected"] += 1
+                raise ToolError(
+                    f"Server busy: {lane.active} {lane.name} database calls running and {lane.queued} queued "
+                    f"(limit {lane.workers} + {lane.max_queue}). Retry shortly."
+                )
+            lane.queued += 1
+
+    def _record(self, tool: str, queue_ms: float, exec_ms: float, failed: bool) -> None:
+        with self._lock:
+            entry = self._tool_entry(tool)
+            entry["calls"] += 1
+            entry["errors"] += int(failed)
+            entry["queue_ms_total"] += queue_ms
+            entry["queue_ms_max"] = max(entry["queue_ms_max"], queue_ms)
+            entry["exec_ms_total"] += exec_ms
+            entry["exec_ms_max"] = max(entry["exec_ms_max"], exec_ms)
+        logger.debug(f"{tool}: queued {queue_ms:.1f} ms, executed {exec_ms:.1f} ms")
+
+    async def run(self, tool: str, fn: Callable[..., Any], *args: Any, heavy: bool = False, checkout: bool = True) -> Any:
+        """Run fn(conn, *args) on a worker thread with a pooled connection.
+
+        Pass heavy=True for calls whose cost depends on user-supplied SQL or
+        scans large tables; everything else runs on the reserved lookup lane.
+        With checkout=False fn(*args) is called without a connection, for work
+        that manages its own (e.g. result cursors held across tool calls);
+        connections it takes from the pool can still be cancelled.
+        """
+        lane = self._heavy if heavy else self._light
+        self._admit(lane, tool)
+        submitted = time.monotonic()
+        scope = CallScope()
+
+        def work():
+            started = time.monotonic()
+            with self._lock:
+                lane.queued -= 1
+                lane.active += 1
+            failed = True
+            try:
+                with scope.active():
+                    if checkout:
+                        with self.pool.connection() as conn:
+                            result = fn(conn, *args)
+                    else:
+                        result = fn(*args)
+                failed = False
+                return result
+            finally:
+                finished = time.monotonic()
+                with self._lock:
+                    lane.active -= 1
+                self._record(tool, (started - submitted) * 1000, (finished - started) * 1000, failed)
+                record("queue", started - submitted)
+                record("db", finished - started)
+
+        # The worker runs in a copy of the caller's context, so metrics land on the calling tool
+        future = lane.threads.submit(contextvars.copy_context().run, work)
+
+        def on_done(f):
+            # A call cancelled before a worker picked it up never ran work()
+            if f.cancelled():
+                with self._lock:
+                    lane.queued -= 1
+
+        future.add_done_callback(on_done)
+        timeout = self.timeout_for(tool)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self._abandon(tool, scope, "timeouts")
+            raise ToolError(
+                f"{tool} timed out after {timeout:g}s and its statement was cancelled on the server. "
+                f"Narrow the query (filter on PatientDurableKey or a *DateKey range) or export it to a file."
+            )
+        except asyncio.CancelledError:
+            self._abandon(tool, scope, "cancelled")
+            raise
+
+    def _abandon(self, tool: str, scope: CallScope, reason: str) -> None:
+        """Cancel the statements of a call nobody is waiting for any more"""
+        signalled = scope.cancel()
+        with self._lock:
+            self._tool_entry(tool)[reason] += 1
+        logger.warning(f"{tool}: call abandoned ({reason}); cancelled {signalled} in-flight statement(s)")
+
+    def stats(self) -> dict:
+        """Snapshot of worker utilisation and per-tool queue/execution times"""
+        with self._lock:
+            tools = {}
+            for tool, entry in sorted(self._tool_stats.items()):
+                calls = entry["calls"]
+                tools[tool] = {
+                    "calls": calls,
+                    "errors": entry["errors"],
+                    "rejected": entry["rejected"],
+                    "timeouts": entry["timeouts"],
+                    "cancelled": entry["cancelled"],
+                    "queue_ms_avg": round(entry["queue_ms_total"] / calls, 2) if calls else 0.0,
+                    "queue_ms_max": round(entry["queue_ms_max"], 2),
+                    "exec_ms_avg": round(entry["exec_ms_total"] / calls, 2) if calls else 0.0,
+                    "exec_ms_max": round(entry["exec_ms_max"], 2),
+                }
+            lanes = {"heavy": self._heavy.stats()}
+            if self._light is not self._heavy:
+                lanes["light"] = self._light.stats()
+            return {"max_workers": self._config.max_workers, "lanes": lanes, "tools": tools}
+
+    def shutdown(self) -> None:
+        """Stop accepting work and release worker threads"""
+        for lane in {self._heavy, self._light}:
+            lane.threads.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,219 @@
+"""Estimated execution plans (SHOWPLAN_XML): cost summaries and a pre-execution cost guard"""
+
+import logging
+import re
+import threading
+import xml.etree.ElementTree as ET
+from typing import Any, Callable
+
+from fastmcp.exceptions import ToolError
+
+from cdw_medcp.config import CostGuardConfig
+
+logger = logging.getLogger("CDW_MedCP")
+
+_NS = "{http://schemas.microsoft.com/sqlserver/2004/07/showplan}"
+
+# Scans reading fewer rows than this are not worth a hint
+LARGE_SCAN_ROWS = 1_000_000
+
+# Operators listed in a summary, largest first
+MAX_LISTED_OPERATORS = 8
+
+_PATIENT_FILTER = re.compile(r"\bPatientDurableKey\s*(=|IN\b)", re.IGNORECASE)
+
+
+def fetch_plan(conn, sql: str) -> list[str]:
+    """Estimated plan XML of each statement in sql, compiled but not executed.
+
+    SHOWPLAN_XML is a session setting; if it cannot be switched off again the
+    connection is closed so the pool discards it instead of handing a
+    plan-only session to the next caller.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SET SHOWPLAN_XML ON")
+    plans = []
+    try:
+        cursor.execute(sql)
+        while True:
+            plans += [row[0].decode("utf-8") if isinstance(row[0], bytes) else row[0] for row in cursor.fetchall()]
+            if not cursor.nextset():
+                break
+    finally:
+        try:
+            cursor.execute("SET SHOWPLAN_XML OFF")
+            cursor.close()
+        except Exception:
+            logger.warning("Could not switch SHOWPLAN_XML off; closing the connection")
+            conn.close()
+            raise
+    return plans
+
+
+def _object_name(relop: ET.Element) -> tuple[str, str]:
+    obj = relop.find(f"./*/{_NS}Object")
+    if obj is None:
+        return "", ""
+    table = ".".join(obj.get(part, "").strip("[]") for part in ("Schema", "Table") if obj.get(part))
+    return table, obj.get("Index", "").strip("[]")
+
+
+def parse_plan(plans: list[str]) -> dict:
+    """Compact summary of ShowPlanXML documents: cost, rows, scans, seeks, warnings, missing indexes.
+
+    estimated_cost is summed over every statement of the batch; estimated_rows
+    is the row estimate of the most expensive statement (usually the final
+    SELECT of a batch that first declares or fills variables and temp tables).
+    """
+    cost, rows, seeks, statements = 0.0, 0, 0, 0
+    costliest = -1.0
+    operators, warnings, missing = [], [], []
+    for document in plans:
+        root = ET.fromstring(document)
+        for statement in root.iter(f"{_NS}StmtSimple"):
+            statement_cost = float(statement.get("StatementSubTreeCost", 0) or 0)
+            cost += statement_cost
+            statements += 1
+            if statement_cost > costliest:
+                costliest = statement_cost
+                rows = int(float(statement.get("StatementEstRows", 0) or 0))
+        for relop in root.iter(f"{_NS}RelOp"):
+            physical = relop.get("PhysicalOp", "")
+            if "Seek" in physical:
+                seeks += 1
+            table, index = _object_name(relop)
+            if "Scan" not in physical or not table:
+                continue
+            rows_read = relop.get("EstimatedRowsRead") or relop.get("TableCardinality") or relop.get("EstimateRows")
+            operators.append({
+                "operator": physical,
+                "table": table,
+                "index": index,
+                "rows_read": int(float(rows_read or 0)),
+                "rows": int(float(relop.get("EstimateRows", 0) or 0)),
+                "cost": round(float(relop.get("EstimatedTotalSubtreeCost", 0) or 0), 3),
+            })
+        for element in root.iter(f"{_NS}Warnings"):
+            if element.get("NoJoinPredicate") == "true":
+                warnings.append("No join predicate")
+            for convert in element.iter(f"{_NS}PlanAffectingConvert"):
+                warnings.append(f"Implicit conversion {convert.get('Expression', '')} affects {convert.get('ConvertIssue', 'the plan')}")
+            for _ in element.iter(f"{_NS}ColumnsWithNoStatistics"):
+                warnings.append("Columns without statistics")
+        for group in root.iter(f"{_NS}MissingIndexGroup"):
+            for index in group.iter(f"{_NS}MissingIndex"):
+                columns = {
+                    usage.get("Usage", "").lower(): [c.get("Name", "").strip("[]") for c in usage.iter(f"{_NS}Column")]
+                    for usage in index.iter(f"{_NS}ColumnGroup")
+                }
+                missing.append({
+                    "table": ".".join(index.get(p, "").strip("[]") for p in ("Schema", "Table") if index.get(p)),
+                    "impact": round(float(group.get("Impact", 0) or 0), 1),
+                    **columns,
+                })
+    operators.sort(key=lambda op: op["rows_read"], reverse=True)
+    return {
+        "estimated_cost": round(cost, 3),
+        "estimated_rows": rows,
+        "estimated_rows_of": "most expensive statement",
+        "statements": statements,
+        "seeks": seeks,
+        "scans": len(operators),
+        "largest_scans": operators[:MAX_LISTED_OPERATORS],
+        "warnings": list(dict.fromkeys(warnings)),
+        "missing_indexes": missing,
+    }
+
+
+def plan_hints(summary: dict, sql: str, large_scan_rows: int = LARGE_SCAN_ROWS) -> list[str]:
+    """Actionable suggestions for the expensive parts of a plan summary"""
+    hints = []
+    has_patient_filter = bool(_PATIENT_FILTER.search(sql))
+    for scan in summary["largest_scans"]:
+        if scan["rows_read"] < large_scan_rows:
+            break
+        where = f"{scan['operator']} of {scan['table'] or 'a table'} reads ~{scan['rows_read']:,} rows"
+        name = scan["table"].split(".")[-1].lower()
+        if not has_patient_filter and (name.endswith("fact") or name.startswith("note_")):
+            hints.append(f"{where} and the query has no PatientDurableKey filter: restrict it with "
+                         f"WHERE PatientDurableKey IN (...) or a code-set handle.")
+        else:
+            hints.append(f"{where}: filter it on an indexed column (PatientDurableKey, a *DateKey range, "
+                         f"a code-set key list) or add TOP.")
+    for warning in summary["warnings"]:
+        if warning.startswith("No join predicate"):
+            hints.append("A join has no ON predicate (cartesian product); check the join conditions.")
+        elif warning.startswith("Implicit conversion"):
+            hints.append(f"{warning}: compare columns to literals of their own type "
+                         f"(e.g. *DateKey to 20240115, not '2024-01-15').")
+    for index in summary["missing_indexes"][:3]:
+        columns = ", ".join(index.get("equality", []) + index.get("inequality", []))
+        hints.append(f"SQL Server estimates a {index['impact']}% gain from an index on {index['table']} ({columns}); "
+                     f"filter on an already indexed column instead if possible.")
+    return hints
+
+
+class CostGuard:
+    """Reject statements whose estimated plan exceeds the configured cost limits.
+
+    check() compiles the statement with SHOWPLAN_XML (nothing is executed)
+    and raises a ToolError with the plan's hints when the estimated subtree
+    cost exceeds max_cost or a single scan reads more than max_scan_rows.
+    A limit of 0 is off; with both off no plan is fetched at all. The plan
+    source can be swapped for recorded plans (e.g. .sqlplan files saved from
+    SSMS) to exercise the guard without a warehouse.
+    """
+
+    def __init__(self, config: CostGuardConfig | None = None,
+                 plan_source: Callable[[Any, str], list[str]] = fetch_plan):
+        self._config = config or CostGuardConfig()
+        self._plan_source = plan_source
+        self._lock = threading.Lock()
+        self._stats = {"explains": 0, "checks": 0, "rejections": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._config.max_cost > 0 or self._config.max_scan_rows > 0
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._stats[counter] += 1
+
+    def explain(self, conn, sql: str) -> dict:
+        """Plan summary of sql with hints and the limits it would violate"""
+        summary = parse_plan(self._plan_source(conn, sql))
+        summary["hints"] = plan_hints(summary, sql, self._config.max_scan_rows or LARGE_SCAN_ROWS)
+        summary["violations"] = self.violations(summary)
+        self._count("explains")
+        return summary
+
+    def violations(self, summary: dict) -> list[str]:
+        found = []
+        if self._config.max_cost and summary["estimated_cost"] > self._config.max_cost:
+            found.append(f"estimated cost {summary['estimated_cost']:,} exceeds the limit of {self._config.max_cost:,}")
+        if self._config.max_scan_rows:
+            for scan in summary["largest_scans"]:
+                if scan["rows_read"] > self._config.max_scan_rows:
+                    found.append(f"scan of {scan['table']} reads ~{scan['rows_read']:,} rows "
+                                 f"(limit {self._config.max_scan_rows:,})")
+        return found
+
+    def check(self, conn, sql: str) -> None:
+        """Raise ToolError if the estimated plan of sql exceeds the limits. Blocks on the database."""
+        if not self.enabled:
+            return
+        summary = self.explain(conn, sql)
+        self._count("checks")
+        if summary["violations"]:
+            self._count("rejections")
+            hints = "\n".join(f"- {hint}" for hint in summary["hints"])
+            raise ToolError(
+                f"Query rejected before execution: {'; '.join(summary['violations'])}."
+                + (f"\n{hints}" if hints else "")
+                + "\nNarrow the query, or run explain_query to see its estimated plan."
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        return {**stats, "max_cost": self._config.max_cost, "max_scan_rows": self._config.max_scan_rows}
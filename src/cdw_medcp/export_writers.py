@@ -0,0 +1,395 @@
+"""Streaming, size-rotated file writers for query exports"""
+
+import csv
+import datetime
+import decimal
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Export format -> file extension
+FORMATS = {
+    "csv": ".csv",
+    "csv.gz": ".csv.gz",
+    "ndjson": ".ndjson",
+    "ndjson.gz": ".ndjson.gz",
+    "parquet": ".parquet",
+}
+
+# Format written instead of parquet when pyarrow is not installed
+PARQUET_FALLBACK = "ndjson.gz"
+
+# Rows buffered per Parquet row group
+PARQUET_ROW_GROUP_ROWS = 50_000
+
+# pymssql cursor.description type codes
+_STRING, _BINARY, _NUMBER, _DATETIME, _DECIMAL = 1, 2, 3, 4, 5
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def resolve_format(fmt: str) -> str:
+    """Format that will actually be written for a requested format"""
+    if fmt == "parquet" and not parquet_available():
+        logger.warning(f"pyarrow is not installed; writing {PARQUET_FALLBACK} instead of parquet")
+        return PARQUET_FALLBACK
+    return fmt
+
+
+def output_base(filepath: Path) -> Path:
+    """Strip any known export extension, so results.csv and results.csv.gz share a base"""
+    name = filepath.name
+    for ext in sorted(FORMATS.values(), key=len, reverse=True):
+        if name.lower().endswith(ext):
+            return filepath.with_name(name[:-len(ext)])
+    return filepath
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class _HashingFile:
+    """Binary file wrapper that counts and checksums bytes as they are written"""
+
+    def __init__(self, path: Path):
+        self._raw = open(path, "wb")
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self._raw.write(data)
+
+    def flush(self) -> None:
+        self._raw.flush()
+
+    def tell(self) -> int:
+        return self.bytes
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def readable(self) -> bool:
+        return False
+
+    @property
+    def closed(self) -> bool:
+        return self._raw.closed
+
+    def close(self) -> None:
+        self._raw.close()
+
+
+class _Shard:
+    """One open output file of a given format"""
+
+    def __init__(self, path: Path, fmt: str, columns: list[str], column_types: list, schema=None):
+        self.path = path
+        self.rows = 0
+        self._fmt = fmt
+        self._columns = columns
+        self._file = _HashingFile(path)
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb", mtime=0) if fmt.endswith(".gz") else None
+        binary = self._gzip or self._file
+        if fmt == "parquet":
+            self._parquet = _ParquetShard(self._file, columns, column_types, schema)
+        else:
+            self._text = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+            if fmt.startswith("csv"):
+                self._csv = csv.writer(self._text)
+                self._csv.writerow(columns)
+            else:
+                self._encoder = json.JSONEncoder(default=_json_default, ensure_ascii=False, separators=(",", ":"))
+
+    @property
+    def bytes(self) -> int:
+        return self._file.bytes
+
+    @property
+    def schema(self):
+        """Arrow schema of a parquet shard, once known"""
+        return self._parquet.schema if self._fmt == "parquet" else None
+
+    def write(self, rows: list) -> None:
+        if self._fmt == "parquet":
+            self._parquet.write(rows)
+        elif self._fmt.startswith("csv"):
+            self._csv.writerows(rows)
+        else:
+            encode = self._encoder.encode
+            columns = self._columns
+            self._text.write("".join(encode(dict(zip(columns, row))) + "\n" for row in rows))
+        if self._fmt != "parquet":
+            # Push the batch down so bytes reflects what has reached the file
+            self._text.flush()
+        self.rows += len(rows)
+
+    def close(self) -> dict:
+        if self._fmt == "parquet":
+            self._parquet.close()
+        else:
+            self._text.flush()
+            self._text.detach()
+        if self._gzip is not None:
+            self._gzip.close()
+        self._file.close()
+        return {
+            "file": self.path.name,
+            "rows": self.rows,
+            "bytes": self._file.bytes,
+            "sha256": self._file.sha256.hexdigest(),
+        }
+
+
+class _ParquetShard:
+    """Parquet writer with a schema taken from the cursor and the first batch of rows.
+
+    Later shards of the same export reuse the first shard's schema so every
+    file has identical column types.
+    """
+
+    def __init__(self, sink: _HashingFile, columns: list[str], column_types: list, schema=None):
+        import pyarrow.parquet as pq
+
+        self._pq = pq
+        self._sink = sink
+        self._columns = columns
+        self._column_types = column_types
+        self._schema = schema
+        self._writer = None
+        self._buffer: list = []
+
+    def _infer_schema(self, rows: list):
+        import pyarrow as pa
+
+        fields = []
+        for i, (name, type_code) in enumerate(zip(self._columns, self._column_types)):
+            sample = next((row[i] for row in rows if row[i] is not None), None)
+            if type_code == _STRING:
+                arrow_type = pa.string()
+            elif type_code == _BINARY:
+                arrow_type = pa.binary()
+            elif type_code == _DATETIME:
+                if isinstance(sample, datetime.time):
+                    arrow_type = pa.time64("us")
+                elif type(sample) is datetime.date:
+                    arrow_type = pa.date32()
+                else:
+                    arrow_type = pa.timestamp("us")
+            elif type_code == _DECIMAL and isinstance(sample, decimal.Decimal):
+                arrow_type = pa.decimal128(38, max(0, -sample.as_tuple().exponent))
+            elif type_code == _NUMBER and isinstance(sample, bool):
+                arrow_type = pa.bool_()
+            elif type_code == _NUMBER and isinstance(sample, int):
+                arrow_type = pa.int64()
+            elif type_code in (_NUMBER, _DECIMAL):
+                arrow_type = pa.float64()
+            else:
+                arrow_type = pa.string()
+            fields.append(pa.field(name, arrow_type))
+        return pa.schema(fields)
+
+    @property
+    def schema(self):
+        return self._schema
+
+    def _flush(self) -> None:
+        import pyarrow as pa
+
+        if not self._buffer:
+            return
+        if self._writer is None:
+            self._schema = self._schema or self._infer_schema(self._buffer)
+            self._writer = self._pq.ParquetWriter(self._sink, self._schema, compression="zstd")
+        arrays = []
+        for i, field in enumerate(self._schema):
+            values = [row[i] for row in self._buffer]
+            if pa.types.is_string(field.type):
+                values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+            arrays.append(pa.array(values, type=field.type))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+        self._buffer = []
+
+    def write(self, rows: list) -> None:
+        self._buffer.extend(rows)
+        if len(self._buffer) >= PARQUET_ROW_GROUP_ROWS:
+            self._flush()
+
+    def close(self) -> None:
+        self._flush()
+        if self._writer is None:
+            # No rows: still write a valid file carrying the column names
+            self._schema = self._schema or self._infer_schema([])
+            self._writer = self._pq.ParquetWriter(self._sink, self._schema, compression="zstd")
+        self._writer.close()
+
+
+class ShardedExportWriter:
+    """Stream row batches into one or more numbered files of a single format.
+
+    With max_shard_bytes=0 everything goes to <base><ext>. Otherwise a new
+    shard <base>-00001<ext>, <base>-00002<ext>, ... is started whenever the
+    current one reaches max_shard_bytes on disk (checked between batches, so
+    shards overshoot by at most one batch). Each shard's row count, size and
+    SHA-256 are collected for the manifest while the bytes are written.
+
+    With auto_rotate=False the caller decides where shards end: check
+    shard_full after each write and call rotate(). Passing the shards of an
+    earlier, interrupted run continues numbering after them.
+    """
+
+    def __init__(self, base: Path, fmt: str, columns: list[str], column_types: Optional[list] = None,
+                 max_shard_bytes: int = 0, shards: Optional[list[dict]] = None, auto_rotate: bool = True):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown export format '{fmt}'. Choose one of: {', '.join(FORMATS)}")
+        self.base = base
+        self.fmt = fmt
+        self.columns = columns
+        self.column_types = column_types or [None] * len(columns)
+        self.max_shard_bytes = max_shard_bytes
+        self.auto_rotate = auto_rotate
+        self.shards: list[dict] = list(shards or [])
+        self.rows = sum(shard["rows"] for shard in self.shards)
+        self._current: Optional[_Shard] = None
+        self._schema = None
+
+    def _shard_path(self, number: int) -> Path:
+        ext = FORMATS[self.fmt]
+        if not self.max_shard_bytes:
+            return self.base.with_name(self.base.name + ext)
+        return self.base.with_name(f"{self.base.name}-{number:05d}{ext}")
+
+    def _open_shard(self) -> _Shard:
+        return _Shard(self._shard_path(len(self.shards) + 1), self.fmt, self.columns, self.column_types, self._schema)
+
+    def _close_shard(self) -> None:
+        self.shards.append(self._current.close())
+        self._schema = self._current.schema
+        self._current = None
+
+    def write(self, rows: list) -> None:
+        if not rows:
+            return
+        if self._current is None:
+            self._current = self._open_shard()
+        self._current.write(rows)
+        self.rows += len(rows)
+        if self.auto_rotate and self.shard_full:
+            self._close_shard()
+
+    @property
+    def shard_full(self) -> bool:
+        return bool(self.max_shard_bytes) and self._current is not None and self._current.bytes >= self.max_shard_bytes
+
+    def rotate(self) -> None:
+        """Finish the open shard; the next write starts a new one"""
+        if self._current is not None:
+            self._close_shard()
+
+    def close(self) -> list[dict]:
+        """Finish the open shard (creating an empty one if nothing was written)"""
+        if self._current is None and not self.shards:
+            self._current = self._open_shard()
+        if self._current is not None:
+            self._close_shard()
+        return self.shards
+
+    def discard_unrecorded(self) -> None:
+        """Delete numbered files past the recorded shards, left by an interrupted run"""
+        if not self.max_shard_bytes:
+            return
+        ext = FORMATS[self.fmt]
+        for path in self.base.parent.glob(f"{self.base.name}-[0-9][0-9][0-9][0-9][0-9]{ext}"):
+            if int(path.name[len(self.base.name) + 1:len(self.base.name) + 6]) > len(self.shards):
+                path.unlink()
+
+    def abort(self) -> None:
+        """Close the open shard after a failure, leaving partial output on disk"""
+        if self._current is not None:
+            try:
+                self._current.close()
+            except Exception:
+                pass
+            self._current = None
+
+    def write_manifest(self, **extra) -> Path:
+        """Write <base>.manifest.json describing every shard"""
+        return write_manifest(self.base, self.fmt, self.columns, self.shards, **extra)
+
+
+def manifest_path(base: Path) -> Path:
+    return base.with_name(base.name + ".manifest.json")
+
+
+def write_manifest(base: Path, fmt: str, columns: list[str], shards: list[dict], **extra) -> Path:
+    """Write <base>.manifest.json listing each output file with its rows, size and checksum"""
+    manifest = {
+        "format": fmt,
+        "columns": columns,
+        "total_rows": sum(shard["rows"] for shard in shards),
+        "shards": shards,
+        **extra,
+    }
+    path = manifest_path(base)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def checkpoint_path(base: Path) -> Path:
+    return base.with_name(base.name + ".checkpoint.json")
+
+
+def save_checkpoint(base: Path, state: dict) -> None:
+    """Atomically replace <base>.checkpoint.json, so a crash never leaves it half-written"""
+    path = checkpoint_path(base)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_checkpoint(base: Path) -> Optional[dict]:
+    path = checkpoint_path(base)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,244 @@
+"""Hot-path instrumentation: per-tool, per-phase latency histograms and counters"""
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from fastmcp.server.middleware import Middleware
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Upper bounds in seconds of the latency histogram buckets (Prometheus "le")
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+# Phases, in the order a call goes through them:
+#   total     whole tool call, as seen by the MCP client
+#   queue     waiting for an executor worker
+#   checkout  borrowing a pooled connection (connect: opening a new one)
+#   db        time on the worker thread, connection included
+#   execute   cursor.execute until the first result set is ready
+#   fetch     pulling rows from the cursor
+#   render    CSV/JSON formatting of the response
+PHASES = ("total", "queue", "checkout", "connect", "db", "execute", "fetch", "render")
+
+COUNTERS = ("calls", "errors", "rows", "response_bytes", "cache_hits", "cache_misses")
+
+# (Metrics, tool) of the tool call running in this context. The executor runs
+# worker functions in a copy of the caller's context, so phases timed on
+# worker threads are attributed to the tool call that submitted them.
+_active: ContextVar[Optional[tuple["Metrics", str]]] = ContextVar("cdw_metrics", default=None)
+
+# Rows and other details of the SQL statement running in this context, see statement()
+_statement: ContextVar[Optional[dict]] = ContextVar("cdw_statement", default=None)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "count", "sum", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """Estimate from the buckets, interpolating linearly inside the bucket that holds q"""
+        rank = q * self.count
+        seen = 0
+        for index, in_bucket in enumerate(self.buckets):
+            if in_bucket and seen + in_bucket >= rank:
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / in_bucket, self.max)
+            seen += in_bucket
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.5) * 1000, 2),
+            "p95_ms": round(self.quantile(0.95) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Thread-safe registry of latency histograms per (tool, phase) and counters per tool.
+
+    Instrumented code does not hold a reference to the registry: it calls the
+    module-level timed(), record(), count() and statement() helpers, which
+    attribute the measurement to the tool call active in the current context
+    and do nothing outside a tool call. on_statement(tool, sql, seconds, rows,
+    failed) is called for every statement timed with statement().
+    """
+
+    def __init__(self, on_statement: Optional[Callable[[str, str, float, int, bool], None]] = None):
+        self.on_statement = on_statement
+        self._lock = threading.Lock()
+        self._histograms: dict[tuple[str, str], _Histogram] = {}
+        self._counters: dict[str, dict[str, int]] = {}
+
+    @contextmanager
+    def tool_call(self, tool: str):
+        """Attribute everything measured inside the block to tool"""
+        token = _active.set((self, tool))
+        try:
+            yield
+        finally:
+            _active.reset(token)
+
+    def observe(self, tool: str, phase: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get((tool, phase))
+            if histogram is None:
+                histogram = self._histograms[(tool, phase)] = _Histogram()
+            histogram.observe(seconds)
+
+    def add(self, tool: str, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            counters = self._counters.get(tool)
+            if counters is None:
+                counters = self._counters[tool] = dict.fromkeys(COUNTERS, 0)
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def stats(self) -> dict:
+        """Per tool: counters and p50/p95/max latency of each phase seen"""
+        with self._lock:
+            tools = {tool: {**counters, "phases": {}} for tool, counters in self._counters.items()}
+            for (tool, phase), histogram in self._histograms.items():
+                entry = tools.setdefault(tool, {**dict.fromkeys(COUNTERS, 0), "phases": {}})
+                entry["phases"][phase] = histogram.summary()
+        for entry in tools.values():
+            entry["phases"] = {p: entry["phases"][p] for p in PHASES if p in entry["phases"]}
+        return dict(sorted(tools.items()))
+
+    def prometheus(self, gauges: Optional[dict[str, dict[tuple, float]]] = None) -> str:
+        """Prometheus text exposition of the histograms and counters, plus optional gauges.
+
+        gauges maps a metric name to {((label, value), ...): number}.
+        """
+        lines = [
+            "# HELP cdw_phase_seconds Latency of each phase of a tool call.",
+            "# TYPE cdw_phase_seconds histogram",
+        ]
+        with self._lock:
+            for (tool, phase), histogram in sorted(self._histograms.items()):
+                labels = f'tool="{_label(tool)}",phase="{phase}"'
+                cumulative = 0
+                for bound, in_bucket in zip(LATENCY_BUCKETS, histogram.buckets):
+                    cumulative += in_bucket
+                    lines.append(f'cdw_phase_seconds_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+                lines.append(f'cdw_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"cdw_phase_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+                lines.append(f"cdw_phase_seconds_count{{{labels}}} {histogram.count}")
+            counters = {tool: dict(values) for tool, values in self._counters.items()}
+        for counter in COUNTERS:
+            lines.append(f"# TYPE cdw_tool_{counter}_total counter")
+            for tool, values in sorted(counters.items()):
+                lines.append(f'cdw_tool_{counter}_total{{tool="{_label(tool)}"}} {values.get(counter, 0)}')
+        for name, samples in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples.items():
+                rendered = ",".join(f'{key}="{_label(str(val))}"' for key, val in labels)
+                lines.append(f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def timed(phase: str):
+    """Time the block as phase of the current tool call"""
+    active = _active.get()
+    if active is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        active[0].observe(active[1], phase, time.perf_counter() - started)
+
+
+def record(phase: str, seconds: float) -> None:
+    """Record an already measured phase duration for the current tool call"""
+    active = _active.get()
+    if active is not None:
+        active[0].observe(active[1], phase, seconds)
+
+
+def count(counter: str, amount: int = 1) -> None:
+    """Add to a counter of the current tool call; rows also count towards the current statement"""
+    active = _active.get()
+    if active is not None and amount:
+        active[0].add(active[1], counter, amount)
+        current = _statement.get()
+        if counter == "rows" and current is not None:
+            current["rows"] += amount
+
+
+@contextmanager
+def statement(sql: str):
+    """Time one SQL statement, fetching included, and pass it to the registry's on_statement.
+
+    Rows counted inside the block are attributed to the statement; the block
+    may also set the yielded dict's "rows" itself.
+    """
+    active = _active.get()
+    if active is None or active[0].on_statement is None:
+        yield {"rows": 0}
+        return
+    current = {"rows": 0}
+    token = _statement.set(current)
+    started = time.perf_counter()
+    failed = True
+    try:
+        yield current
+        failed = False
+    finally:
+        _statement.reset(token)
+        try:
+            active[0].on_statement(active[1], sql, time.perf_counter() - started, current["rows"], failed)
+        except Exception as e:
+            logger.warning(f"Statement listener failed: {e}")
+
+
+class MetricsMiddleware(Middleware):
+    """Time every tool call end to end and count calls, errors and response bytes.
+
+    Tool names are recorded without the namespace prefix, matching the names
+    the executor reports in server_stats.
+    """
+
+    def __init__(self, metrics: Metrics, namespace_prefix: str = ""):
+        self._metrics = metrics
+        self._prefix = namespace_prefix
+
+    async def on_call_tool(self, context, call_next):
+        name = context.message.name
+        tool = name[len(self._prefix):] if self._prefix and name.startswith(self._prefix) else name
+        with self._metrics.tool_call(tool):
+            count("calls")
+            started = time.perf_counter()
+            try:
+                result = await call_next(context)
+            except BaseException:
+                count("errors")
+                raise
+            finally:
+                record("total", time.perf_counter() - started)
+            count("response_bytes", sum(len(getattr(c, "text", "").encode("utf-8")) for c in result.content or ()))
+            return result
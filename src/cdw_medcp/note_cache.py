@@ -0,0 +1,163 @@
+"""Byte-bounded LRU cache of clinical notes, zlib-compressed, in memory or on disk"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, Optional
+
+from cdw_medcp.config import NoteCacheConfig
+from cdw_medcp.metrics import count
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Columns of a cached note row, in the order get_note and get_notes return them
+NOTE_COLUMNS = ["deid_note_key", "note_type", "encounter_type", "enc_dept_specialty", "deid_service_date", "note_text"]
+
+
+class NoteCache:
+    """LRU cache of note rows keyed by deid_note_key, bounded by compressed size.
+
+    Each note is stored as a zlib-compressed JSON row (clinical text typically
+    compresses several-fold). With a directory configured the blobs live in
+    files there and survive restarts; otherwise they are kept in memory.
+    Entries older than max_age_hours, or cached before the last invalidate(),
+    are treated as misses.
+    """
+
+    def __init__(self, config: NoteCacheConfig | None = None):
+        self._config = config or NoteCacheConfig()
+        self._dir = Path(self._config.directory).expanduser() if self._config.directory else None
+        self._entries: OrderedDict = OrderedDict()  # digest -> (size, created_at, blob or None when on disk)
+        self._bytes = 0
+        self._written = [0, 0]  # raw and compressed bytes of every put, for the compression ratio
+        self._valid_after = 0.0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        if self._dir:
+            self._dir.mkdir(parents=True, exist_ok=True)
+            self._load_directory()
+
+    @property
+    def enabled(self) -> bool:
+        return self._config.max_mb > 0
+
+    @staticmethod
+    def _digest(note_key: str) -> str:
+        # Hash the key so arbitrary identifier characters never reach the filesystem
+        return hashlib.sha256(note_key.encode("utf-8")).hexdigest()[:32]
+
+    def _path(self, digest: str) -> Path:
+        return self._dir / f"{digest}.z"
+
+    def _load_directory(self) -> None:
+        """Index blobs left by a previous run, least recently used first"""
+        files = sorted(self._dir.glob("*.z"), key=lambda p: p.stat().st_atime)
+        for path in files:
+            stat = path.stat()
+            self._entries[path.stem] = (stat.st_size, stat.st_mtime, None)
+            self._bytes += stat.st_size
+        self._evict()
+        if files:
+            logger.info(f"Note cache: {len(self._entries)} notes ({self._bytes // 1024} KB) found in {self._dir}")
+
+    def _drop(self, digest: str) -> None:
+        size, _, _ = self._entries.pop(digest)
+        self._bytes -= size
+        if self._dir:
+            self._path(digest).unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until within max_mb (caller holds the lock)"""
+        budget = self._config.max_mb * 1024 * 1024
+        while self._bytes > budget and self._entries:
+            self._drop(next(iter(self._entries)))
+            self._counters["evictions"] += 1
+
+    def _fresh(self, created_at: float) -> bool:
+        return created_at >= self._valid_after and time.time() - created_at < self._config.max_age_hours * 3600
+
+    def get_many(self, note_keys: Iterable[str]) -> dict[str, list]:
+        """Cached note rows for whichever of note_keys are present and fresh"""
+        found, missed = {}, 0
+        for key in note_keys:
+            digest = self._digest(key)
+            with self._lock:
+                entry = self._entries.get(digest)
+                if entry is not None and not self._fresh(entry[1]):
+                    self._drop(digest)
+                    entry = None
+                if entry is None:
+                    self._counters["misses"] += 1
+                    missed += 1
+                    continue
+                self._entries.move_to_end(digest)
+                self._counters["hits"] += 1
+            blob = entry[2]
+            if blob is None:
+                try:
+                    blob = self._path(digest).read_bytes()
+                except FileNotFoundError:
+                    with self._lock:
+                        if digest in self._entries:
+                            self._drop(digest)
+                    missed += 1
+                    continue
+            found[key] = json.loads(zlib.decompress(blob))
+        count("cache_hits", len(found))
+        count("cache_misses", missed)
+        return found
+
+    def put(self, note_key: str, row) -> None:
+        """Cache one note row (NOTE_COLUMNS order)"""
+        if not self.enabled:
+            return
+        raw = json.dumps(list(row), separators=(",", ":"), default=str).encode("utf-8")
+        blob = zlib.compress(raw, 6)
+        digest = self._digest(note_key)
+        if self._dir:
+            tmp = self._path(digest).with_suffix(".tmp")
+            tmp.write_bytes(blob)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self._path(digest))
+        with self._lock:
+            if digest in self._entries:
+                self._bytes -= self._entries.pop(digest)[0]
+            self._entries[digest] = (len(blob), time.time(), None if self._dir else blob)
+            self._bytes += len(blob)
+            self._written[0] += len(raw)
+            self._written[1] += len(blob)
+            self._evict()
+
+    def put_many(self, rows: dict[str, list]) -> None:
+        for note_key, row in rows.items():
+            self.put(note_key, row)
+
+    def invalidate(self, refreshed_at: Optional[float] = None) -> int:
+        """Discard every note cached before refreshed_at (default: now). Returns notes dropped."""
+        cutoff = time.time() if refreshed_at is None else refreshed_at
+        with self._lock:
+            self._valid_after = max(self._valid_after, cutoff)
+            stale = [digest for digest, (_, created_at, _) in self._entries.items() if created_at < self._valid_after]
+            for digest in stale:
+                self._drop(digest)
+            self._counters["invalidations"] += 1
+        return len(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": round(self._counters["hits"] / lookups, 3) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._config.max_mb * 1024 * 1024,
+                "compression_ratio": round(self._written[0] / self._written[1], 2) if self._written[1] else None,
+                "storage": str(self._dir) if self._dir else "memory",
+            }
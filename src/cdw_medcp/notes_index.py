@@ -0,0 +1,167 @@
+"""Opt-in local full-text index of a patient's notes (SQLite FTS5, BM25 ranking)"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from fastmcp.exceptions import ToolError
+
+from cdw_medcp.config import NotesIndexConfig
+from cdw_medcp.patients import quote_literal
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Notes pulled from the CDW per round trip while building an index
+BUILD_BATCH_ROWS = 200
+
+# Metadata columns stored (unindexed) next to the note text, in result order
+_METADATA_COLUMNS = ("deid_note_key", "note_type", "encounter_type", "enc_dept_specialty", "deid_service_date")
+
+_SCHEMA_SQL = (
+    "CREATE VIRTUAL TABLE notes USING fts5(note_text, "
+    + ", ".join(f"{c} UNINDEXED" for c in _METADATA_COLUMNS)
+    + ", tokenize = 'porter unicode61')",
+    "CREATE TABLE info (built_at REAL, note_count INTEGER)",
+)
+
+RESULT_COLUMNS = list(_METADATA_COLUMNS) + ["score", "snippet"]
+
+
+class NotesIndex:
+    """Per-patient SQLite FTS5 indexes of note text, kept under a disk budget.
+
+    The first search for a patient pulls all of their notes from the CDW once
+    and writes them to <directory>/<hash>.sqlite; later searches are answered
+    from that file. Indexes older than max_age_hours are rebuilt (the CDW is
+    refreshed nightly). When the directory grows past max_disk_mb, the least
+    recently searched indexes are deleted.
+    """
+
+    def __init__(self, config: NotesIndexConfig | None = None):
+        self._config = config or NotesIndexConfig()
+        self._dir = Path(self._config.directory).expanduser() if self._config.directory else None
+        self._lock = threading.Lock()
+        self._building: dict[str, threading.Lock] = {}
+        self._stats = {"builds": 0, "searches": 0, "evictions": 0}
+        if self._dir:
+            self._dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self._dir is not None
+
+    def _path(self, durable_key: str) -> Path:
+        # Hash the key so arbitrary identifier characters never reach the filesystem
+        return self._dir / f"{hashlib.sha256(durable_key.encode('utf-8')).hexdigest()[:32]}.sqlite"
+
+    def is_fresh(self, durable_key: str) -> bool:
+        path = self._path(durable_key)
+        try:
+            return time.time() - path.stat().st_mtime < self._config.max_age_hours * 3600
+        except FileNotFoundError:
+            return False
+
+    def build(self, conn, schema: str, durable_key: str) -> Optional[int]:
+        """Pull every note for the patient and (re)write their index; returns the note count.
+
+        Blocks on the database; run it on an executor worker. Concurrent builds
+        for the same patient wait for the first one instead of pulling twice,
+        and get None back.
+        """
+        with self._lock:
+            gate = self._building.setdefault(durable_key, threading.Lock())
+        with gate:
+            if self.is_fresh(durable_key):
+                return None
+            path = self._path(durable_key)
+            tmp = path.with_suffix(".tmp")
+            tmp.unlink(missing_ok=True)
+            db = sqlite3.connect(tmp)
+            try:
+                for statement in _SCHEMA_SQL:
+                    db.execute(statement)
+                cursor = conn.cursor()
+                cursor.execute(
+                    f"SELECT nt.note_text, {', '.join('nm.' + c for c in _METADATA_COLUMNS)} "
+                    f"FROM {schema}.note_metadata nm "
+                    f"JOIN {schema}.note_text nt ON nm.deid_note_key = nt.deid_note_key "
+                    f"WHERE nm.PatientDurableKey = {quote_literal(durable_key)}"
+                )
+                count = 0
+                insert = f"INSERT INTO notes VALUES ({', '.join(['?'] * (len(_METADATA_COLUMNS) + 1))})"
+                while True:
+                    rows = cursor.fetchmany(BUILD_BATCH_ROWS)
+                    if not rows:
+                        break
+                    db.executemany(insert, [tuple(v if v is None or isinstance(v, (str, int, float)) else str(v)
+                                                  for v in row) for row in rows])
+                    count += len(rows)
+                cursor.close()
+                db.execute("INSERT INTO info VALUES (?, ?)", (time.time(), count))
+                db.execute("INSERT INTO notes(notes) VALUES ('optimize')")
+                db.commit()
+            except BaseException:
+                db.close()
+                tmp.unlink(missing_ok=True)
+                raise
+            db.close()
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, path)
+        with self._lock:
+            self._building.pop(durable_key, None)
+            self._stats["builds"] += 1
+        logger.info(f"Indexed {count} notes for patient {durable_key} ({path.stat().st_size // 1024} KB)")
+        self._enforce_budget(keep=path)
+        return count
+
+    def search(self, durable_key: str, query: str, limit: int) -> list[tuple]:
+        """BM25-ranked matches for an FTS5 query, best first, as RESULT_COLUMNS rows"""
+        path = self._path(durable_key)
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = db.execute(
+                f"SELECT {', '.join(_METADATA_COLUMNS)}, round(-bm25(notes), 3), "
+                f"snippet(notes, 0, '[', ']', ' ... ', 24) "
+                f"FROM notes WHERE notes MATCH ? ORDER BY rank LIMIT ?",
+                (query, limit),
+            ).fetchall()
+        except sqlite3.OperationalError as e:
+            raise ToolError(f"Invalid search query {query!r}: {e}. Quote phrases with double quotes; "
+                            f"combine terms with AND, OR, NOT and parentheses.")
+        finally:
+            db.close()
+        # Searching marks the index as recently used for eviction, without touching its age
+        stat = path.stat()
+        os.utime(path, (time.time(), stat.st_mtime))
+        with self._lock:
+            self._stats["searches"] += 1
+        return rows
+
+    def _enforce_budget(self, keep: Path) -> None:
+        """Delete least recently searched indexes until the directory fits max_disk_mb"""
+        files = [(p.stat().st_atime, p.stat().st_size, p) for p in self._dir.glob("*.sqlite")]
+        total = sum(size for _, size, _ in files)
+        budget = self._config.max_disk_mb * 1024 * 1024
+        for _, size, path in sorted(files):
+            if total <= budget:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            with self._lock:
+                self._stats["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        if self._dir:
+            sizes = [p.stat().st_size for p in self._dir.glob("*.sqlite")]
+            stats.update(patients=len(sizes), disk_mb=round(sum(sizes) / 1024 / 1024, 1),
+                         max_disk_mb=self._config.max_disk_mb)
+        return stats
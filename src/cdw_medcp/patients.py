@@ -0,0 +1,89 @@
+"""Patient identifier resolution: any PatientKey or PatientDurableKey to its PatientDurableKey"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Identifier -> PatientDurableKey mappings kept in memory. Both mappings are
+# immutable (a surrogate PatientKey never moves to another person), so entries
+# only ever leave by LRU eviction.
+MAX_CACHED_PATIENTS = 50_000
+
+
+def quote_literal(value: str) -> str:
+    """T-SQL string literal for value, with embedded quotes doubled"""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class PatientResolver:
+    """Map user-supplied patient identifiers to PatientDurableKey once, then reuse the answer.
+
+    Fact tables are indexed on PatientDurableKey; filtering them with
+    "PatientDurableKey = x OR PatientKey = x" defeats a single index seek.
+    The resolver looks the identifier up in PatientDim with two
+    single-column seeks (durable key first, then the bigint surrogate key
+    when the identifier is numeric), so callers can always filter fact
+    tables on PatientDurableKey alone.
+    """
+
+    def __init__(self, schema: str = "deid_uf", max_entries: int = MAX_CACHED_PATIENTS):
+        self._schema = schema
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "not_found": 0}
+
+    def cached(self, patient_id: str) -> Optional[str]:
+        """Durable key for patient_id if it has been resolved before"""
+        key = patient_id.strip()
+        with self._lock:
+            durable = self._entries.get(key)
+            if durable is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+            return durable
+
+    def _lookup_sql(self, patient_id: str) -> str:
+        sql = (f"SELECT TOP 1 PatientDurableKey FROM (\n"
+               f"  SELECT TOP 1 PatientDurableKey, 0 AS priority FROM {self._schema}.PatientDim "
+               f"WHERE PatientDurableKey = {quote_literal(patient_id)}")
+        if patient_id.isdigit():
+            # Compare the bigint surrogate to a number literal so the seek needs no conversion
+            sql += (f"\n  UNION ALL\n"
+                    f"  SELECT TOP 1 PatientDurableKey, 1 FROM {self._schema}.PatientDim "
+                    f"WHERE PatientKey = {int(patient_id)}")
+        return sql + "\n) AS candidates ORDER BY priority"
+
+    def resolve(self, conn, patient_id: str) -> Optional[str]:
+        """Durable key for patient_id, querying PatientDim on a miss; None if no patient matches.
+
+        Blocks on the database; run it on an executor worker.
+        """
+        durable = self.cached(patient_id)
+        if durable is not None:
+            return durable
+        key = patient_id.strip()
+        cursor = conn.cursor()
+        cursor.execute(self._lookup_sql(key))
+        row = cursor.fetchone()
+        cursor.close()
+        with self._lock:
+            if row is None:
+                self._counters["not_found"] += 1
+                return None
+            self._counters["misses"] += 1
+            durable = str(row[0])
+            self._entries[key] = durable
+            self._entries[durable] = durable
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        logger.debug(f"Resolved patient identifier {key} to PatientDurableKey {durable}")
+        return durable
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._counters, "entries": len(self._entries), "max_entries": self._max_entries}
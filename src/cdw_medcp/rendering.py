@@ -0,0 +1,121 @@
+"""Bounded CSV rendering of query results for tool responses"""
+
+import csv
+import io
+import time
+from typing import Optional
+
+from cdw_medcp.metrics import count, record
+
+# Upper bound on the CSV text of a single tool response
+MAX_RESPONSE_BYTES = 512 * 1024
+
+# Rows pulled from the cursor per round trip while rendering
+FETCH_CHUNK_ROWS = 500
+
+_CLIP_MARKER = " ...[truncated]"
+
+
+class BoundedCSV:
+    """CSV text builder that refuses rows once a byte budget would be exceeded.
+
+    Rows are rendered one at a time with csv.writer, so values containing
+    commas, quotes or newlines stay parseable. If the very first row alone is
+    over budget, its longest text values are clipped so that at least one
+    row is always returned.
+    """
+
+    def __init__(self, columns: list[str], max_bytes: int = MAX_RESPONSE_BYTES):
+        self.columns = columns
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.clipped_columns: list[str] = []
+        self._scratch = io.StringIO()
+        self._writer = csv.writer(self._scratch, lineterminator="\n")
+        header = self._render(columns)
+        self._parts = [header]
+        self.bytes = len(header.encode("utf-8"))
+
+    def _render(self, row) -> str:
+        self._scratch.seek(0)
+        self._scratch.truncate()
+        self._writer.writerow(row)
+        return self._scratch.getvalue()
+
+    def _clip(self, row, overflow: int) -> list:
+        """Shorten the longest string values until the row shrinks by overflow bytes"""
+        row = list(row)
+        while overflow > 0:
+            longest = max(
+                (i for i, v in enumerate(row) if isinstance(v, str) and len(v) > len(_CLIP_MARKER)),
+                key=lambda i: len(row[i]), default=None,
+            )
+            if longest is None:
+                break
+            value = row[longest]
+            keep = max(0, len(value.encode("utf-8")) - overflow - len(_CLIP_MARKER))
+            clipped = value.encode("utf-8")[:keep].decode("utf-8", "ignore") + _CLIP_MARKER
+            overflow -= len(value.encode("utf-8")) - len(clipped.encode("utf-8"))
+            row[longest] = clipped
+            if self.columns[longest] not in self.clipped_columns:
+                self.clipped_columns.append(self.columns[longest])
+        return row
+
+    def add(self, row) -> bool:
+        """Append a row; False (and nothing appended) if it does not fit the budget"""
+        line = self._render(row)
+        size = len(line.encode("utf-8"))
+        if self.bytes + size > self.max_bytes:
+            if self.rows:
+                return False
+            line = self._render(self._clip(row, self.bytes + size - self.max_bytes))
+            size = len(line.encode("utf-8"))
+        self._parts.append(line)
+        self.bytes += size
+        self.rows += 1
+        return True
+
+    def text(self) -> str:
+        return "".join(self._parts).rstrip("\n")
+
+
+def cursor_to_csv(cursor, max_rows: Optional[int] = None, max_bytes: int = MAX_RESPONSE_BYTES) -> Optional[str]:
+    """Stream an executed cursor into CSV, stopping at max_rows rows or max_bytes of text.
+
+    Returns None when the statement produced no result set. Rows are fetched
+    in small chunks and fetching stops as soon as a budget is reached, so
+    memory stays bounded by the budget rather than the result size. When the
+    output is cut short a final "[truncated: ...]" line says why.
+    """
+    if not cursor.description:
+        return None
+    started = time.perf_counter()
+    fetching = 0.0
+    builder = BoundedCSV([desc[0] for desc in cursor.description], max_bytes)
+    reason = None
+    while reason is None:
+        want = FETCH_CHUNK_ROWS if max_rows is None else min(FETCH_CHUNK_ROWS, max_rows - builder.rows + 1)
+        fetch_started = time.perf_counter()
+        chunk = cursor.fetchmany(want)
+        fetching += time.perf_counter() - fetch_started
+        if not chunk:
+            break
+        for row in chunk:
+            if max_rows is not None and builder.rows >= max_rows:
+                reason = f"row limit of {max_rows} reached; more rows available. Narrow the query or raise row_limit."
+                break
+            if not builder.add(row):
+                reason = (f"response budget of {max_bytes // 1024} KB reached after {builder.rows} rows; "
+                          "more rows available. Select fewer columns, narrow the query or export it to a file.")
+                break
+    text = builder.text()
+    if builder.clipped_columns:
+        text += (f"\n[truncated: {', '.join(builder.clipped_columns)} clipped to fit the "
+                 f"{max_bytes // 1024} KB response budget]")
+    if reason:
+        text += f"\n[truncated: {reason}]"
+    record("fetch", fetching)
+    record("render", time.perf_counter() - started - fetching)
+    count("rows", builder.rows)
+    return text
+
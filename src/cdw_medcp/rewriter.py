@@ -0,0 +1,377 @@
+"""Rewrites of query shapes known to time out on the CDW into their fast equivalents"""
+
+import datetime
+import re
+from typing import Optional
+
+# Sentinel floor for date keys (unknown dates are stored as 0, -1, 19000101 ...)
+MIN_VALID_DATE_KEY = 19000101
+
+# Relations joined to a fact table only to filter it, and the key the filter is on:
+# key column -> whether the relation needs IsCurrent = 1 for the key to be unique
+_PATIENT_KEYS = {"patientdurablekey": True, "patientkey": False}
+
+_KEYWORDS = {
+    "ON", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "OUTER", "WHERE", "GROUP", "ORDER", "HAVING",
+    "UNION", "EXCEPT", "INTERSECT", "OPTION", "WITH", "SELECT", "FROM", "AS", "APPLY",
+}
+_CLAUSE_END = re.compile(r"\b(WHERE|GROUP\s+BY|ORDER\s+BY|HAVING|OPTION|UNION|EXCEPT|INTERSECT|FOR)\b", re.IGNORECASE)
+_TOP_THEN_DISTINCT = re.compile(r"\bSELECT(\s+)(TOP\s*(?:\(\s*\d+\s*\)|\d+)(?:\s+PERCENT)?)(\s+)DISTINCT\b", re.IGNORECASE)
+_AND = re.compile(r"\bAND\b", re.IGNORECASE)
+_BETWEEN = re.compile(r"\bBETWEEN\b", re.IGNORECASE)
+_OR = re.compile(r"\bOR\b", re.IGNORECASE)
+_TABLE_REF = re.compile(r"^\s*(?P<table>(?:\w+\.){0,2}\w+)(?:\s+(?:AS\s+)?(?P<alias>\w+))?\s*$", re.IGNORECASE)
+
+# Date-key predicates: CONVERT(DATE, CAST(xDateKey AS VARCHAR(8)), 112) and
+# CAST(CAST(xDateKey AS VARCHAR(8)) AS DATE) hide the indexed integer column
+_DATE_COLUMN = r"(?P<col>(?:\w+\.)?\w*DateKey)\b"
+_DATE_OF = (r"(?:CONVERT\s*\(\s*DATE\s*,\s*|CAST\s*\(\s*)CAST\s*\(\s*" + _DATE_COLUMN +
+            r"\s+AS\s+N?(?:VAR)?CHAR\s*\(\s*8\s*\)\s*\)\s*(?:,\s*112\s*\)|AS\s+DATE\s*\)|\))")
+_OP = r"(?P<op>>=|<=|<>|!=|=|<|>)"
+_DATE_LITERAL = r"'(?P<date>\d{4}-?\d{2}-?\d{2})'"
+_DATE_REWRITES = (
+    ("date_op", re.compile(_DATE_OF + r"\s*" + _OP + r"\s*" + _DATE_LITERAL, re.IGNORECASE)),
+    ("op_date", re.compile(_DATE_LITERAL + r"\s*" + _OP + r"\s*" + _DATE_OF, re.IGNORECASE)),
+    ("between", re.compile(_DATE_OF + r"\s+BETWEEN\s+'(?P<low>[\d-]{8,10})'\s+AND\s+'(?P<high>[\d-]{8,10})'",
+                           re.IGNORECASE)),
+    ("year", re.compile(r"\bYEAR\s*\(\s*" + _DATE_OF + r"\s*\)\s*" + _OP + r"\s*(?P<year>\d{4})\b", re.IGNORECASE)),
+    ("key_literal", re.compile(r"(?<![\w.])" + _DATE_COLUMN + r"\s*" + _OP + r"\s*'(?P<date>\d{4}-\d{2}-\d{2})'",
+                               re.IGNORECASE)),
+)
+_FLIPPED = {">=": "<=", "<=": ">=", ">": "<", "<": ">", "=": "=", "<>": "<>", "!=": "!="}
+
+
+def _mask(sql: str) -> str:
+    """sql with the insides of string literals, bracketed names and comments blanked (same length)"""
+    out = list(sql)
+    i, n = 0, len(sql)
+    while i < n:
+        c = sql[i]
+        if c == "'":
+            j = i + 1
+            while j < n:
+                if sql[j] == "'":
+                    if j + 1 < n and sql[j + 1] == "'":
+                        j += 2
+                        continue
+                    break
+                j += 1
+            for k in range(i + 1, min(j, n)):
+                out[k] = "_"
+            i = j + 1
+        elif c == "[":
+            j = sql.find("]", i)
+            j = n if j < 0 else j
+            for k in range(i + 1, j):
+                out[k] = "_"
+            i = j + 1
+        elif sql.startswith("--", i):
+            j = sql.find("\n", i)
+            j = n if j < 0 else j
+            for k in range(i, j):
+                out[k] = " "
+            i = j
+        elif sql.startswith("/*", i):
+            j = sql.find("*/", i + 2)
+            j = n if j < 0 else j + 2
+            for k in range(i, j):
+                out[k] = " " if sql[k] != "\n" else "\n"
+            i = j
+        else:
+            i += 1
+    return "".join(out)
+
+
+def _depths(masked: str) -> list[int]:
+    depth, depths = 0, []
+    for c in masked:
+        if c == ")":
+            depth -= 1
+        depths.append(depth)
+        if c == "(":
+            depth += 1
+    return depths
+
+
+def _top_level(masked: str, depths: list[int], pattern: re.Pattern, start: int = 0, end: Optional[int] = None):
+    """Matches of pattern in masked[start:end] that sit at the depth of start"""
+    end = len(masked) if end is None else end
+    level = depths[start] if start < len(depths) else 0
+    return [m for m in pattern.finditer(masked, start, end) if depths[m.start()] == level]
+
+
+def _split(masked: str, depths: list[int], start: int, end: int, pattern: re.Pattern) -> list[tuple[int, int]]:
+    """Spans of masked[start:end] between top-level matches of pattern"""
+    spans, cursor = [], start
+    for m in _top_level(masked, depths, pattern, start, end):
+        spans.append((cursor, m.start()))
+        cursor = m.end()
+    spans.append((cursor, end))
+    return spans
+
+
+def _conjuncts(masked: str, depths: list[int], start: int, end: int) -> Optional[list[tuple[int, int]]]:
+    """Spans of the top-level AND-ed conditions in masked[start:end]; x BETWEEN a AND b stays one condition.
+
+    None when the conditions have a top-level OR: they cannot be split into
+    conjuncts and moved around without changing what the query returns.
+    """
+    if _top_level(masked, depths, _OR, start, end):
+        return None
+    spans, pending = [], 0
+    for span_start, span_end in _split(masked, depths, start, end, _AND):
+        if pending:
+            # This AND belongs to a BETWEEN in the previous condition
+            spans[-1] = (spans[-1][0], span_end)
+            pending -= 1
+        else:
+            spans.append((span_start, span_end))
+        pending += len(_top_level(masked, depths, _BETWEEN, span_start, span_end))
+    return spans
+
+
+def _date_key(text: str) -> Optional[int]:
+    try:
+        return int(datetime.date.fromisoformat(text if "-" in text else f"{text[:4]}-{text[4:6]}-{text[6:]}")
+                   .strftime("%Y%m%d"))
+    except ValueError:
+        return None
+
+
+def _compare(column: str, op: str, key: int) -> str:
+    if op in ("<", "<=", "<>", "!="):
+        # The original conversion failed on sentinel keys; keep them out of open-ended ranges
+        return f"({column} > {MIN_VALID_DATE_KEY} AND {column} {op} {key})"
+    return f"{column} {op} {key}"
+
+
+def _date_predicate(kind: str, m: re.Match) -> Optional[str]:
+    column = m.group("col")
+    if kind in ("date_op", "key_literal"):
+        key = _date_key(m.group("date"))
+        return None if key is None else _compare(column, m.group("op"), key)
+    if kind == "op_date":
+        key = _date_key(m.group("date"))
+        return None if key is None else _compare(column, _FLIPPED[m.group("op")], key)
+    if kind == "between":
+        low, high = _date_key(m.group("low")), _date_key(m.group("high"))
+        return None if low is None or high is None else f"{column} BETWEEN {low} AND {high}"
+    year, op = int(m.group("year")), m.group("op")
+    first, last = year * 10000 + 101, year * 10000 + 1231
+    if op == "=":
+        return f"{column} BETWEEN {first} AND {last}"
+    if op in ("<>", "!="):
+        return f"({column} > {MIN_VALID_DATE_KEY} AND {column} NOT BETWEEN {first} AND {last})"
+    bound = {">=": first, ">": last, "<=": last, "<": first}[op]
+    return _compare(column, op, bound)
+
+
+def _rewrite_dates(sql: str, notes: list[str]) -> str:
+    total = 0
+    for kind, pattern in _DATE_REWRITES:
+        masked = _mask(sql)
+        pieces, cursor, count = [], 0, 0
+        for m in pattern.finditer(sql):
+            # Skip text inside literals or comments, and overlaps with an earlier rewrite
+            if m.start() < cursor or masked[m.start()] != sql[m.start()]:
+                continue
+            replacement = _date_predicate(kind, m)
+            if replacement is None:
+                continue
+            pieces += [sql[cursor:m.start()], replacement]
+            cursor = m.end()
+            count += 1
+        if count:
+            sql = "".join(pieces) + sql[cursor:]
+            total += count
+    if total:
+        notes.append(f"{total} date predicate(s) compared on the integer *DateKey column")
+    return sql
+
+
+def _strip_comments(sql: str) -> str:
+    masked = _mask(sql)
+    return "".join(c if c == masked[i] or masked[i] == "_" else " " for i, c in enumerate(sql))
+
+
+def _main_select(masked: str, depths: list[int]) -> Optional[re.Match]:
+    """The outermost SELECT of a single SELECT or WITH statement, or None for anything else"""
+    if not re.match(r"\s*(SELECT|WITH)\b", masked, re.IGNORECASE):
+        return None
+    selects = _top_level(masked, depths, re.compile(r"\bSELECT\b", re.IGNORECASE))
+    if not selects or _top_level(masked, depths, re.compile(r"\b(UNION|EXCEPT|INTERSECT)\b", re.IGNORECASE)):
+        return None
+    return selects[0]
+
+
+def _semi_join(sql: str, notes: list[str]) -> str:
+    """Turn a fact-table JOIN used only as a filter into WHERE fact.key IN (subquery).
+
+    Handles FROM fact f JOIN <schema>.PatientDim p ON p.K = f.K (K being
+    PatientDurableKey with p.IsCurrent = 1, or PatientKey) and
+    WITH c AS (SELECT DISTINCT K ...) ... JOIN c ON c.K = f.K, provided the
+    joined relation is referenced nowhere but the ON clause and WHERE filters
+    on it. Anything else is left untouched.
+    """
+    masked = _mask(sql)
+    depths = _depths(masked)
+    select = _main_select(masked, depths)
+    if select is None:
+        return sql
+    froms = _top_level(masked, depths, re.compile(r"\bFROM\b", re.IGNORECASE), select.end())
+    if not froms:
+        return sql
+    from_start = froms[0].end()
+    ends = _top_level(masked, depths, _CLAUSE_END, from_start)
+    from_end = ends[0].start() if ends else len(sql)
+    joins = _split(masked, depths, from_start, from_end, re.compile(r"\b(?:INNER\s+)?JOIN\b", re.IGNORECASE))
+    other_joins = re.compile(r",|\b(LEFT|RIGHT|FULL|CROSS|OUTER|APPLY)\b", re.IGNORECASE)
+    if len(joins) != 2 or _top_level(masked, depths, other_joins, from_start, from_end):
+        return sql
+    on = _top_level(masked, depths, re.compile(r"\bON\b", re.IGNORECASE), *joins[1])
+    if len(on) != 1:
+        return sql
+    first, second = _TABLE_REF.match(sql[joins[0][0]:joins[0][1]]), _TABLE_REF.match(sql[joins[1][0]:on[0].start()])
+    if not first or not second:
+        return sql
+    refs = []
+    for ref in (first, second):
+        table, alias = ref.group("table"), ref.group("alias")
+        if alias and alias.upper() in _KEYWORDS:
+            return sql
+        refs.append((table, alias or table.split(".")[-1], bool(alias)))
+
+    # Which side is the filter: PatientDim, or a CTE defined by the statement
+    ctes = {}
+    if masked.lstrip().upper().startswith("WITH"):
+        for m in re.finditer(r"(?:\bWITH|,)\s*(\w+)\s+AS\s*\(", masked[:select.start()], re.IGNORECASE):
+            if depths[m.start()] == 0:
+                close = m.end() - 1
+                while close < len(depths) and not (masked[close] == ")" and depths[close] == 0):
+                    close += 1
+                ctes[m.group(1).lower()] = (m.start(), m.end(), close)
+    filter_side = None
+    for side, (table, _, _) in enumerate(refs):
+        name = table.split(".")[-1].lower()
+        if name == "patientdim" or (len(ctes) == 1 and "." not in table and name in ctes):
+            filter_side = side
+    if filter_side is None:
+        return sql
+    (filter_table, filter_alias, _), (fact_table, fact_alias, aliased) = refs[filter_side], refs[1 - filter_side]
+    if fact_table.split(".")[-1].lower() in ctes or fact_table.split(".")[-1].lower() == "patientdim":
+        return sql
+    filter_ref = re.compile(rf"(?<![\w.]){re.escape(filter_alias)}\.(\w+)", re.IGNORECASE)
+    fact_ref = re.compile(rf"(?<![\w.]){re.escape(fact_alias)}\.", re.IGNORECASE)
+
+    # ON: one key equality between the two sides, plus filters on the joined relation
+    key, filters = None, []
+    on_conditions = _conjuncts(masked, depths, on[0].end(), from_end)
+    if on_conditions is None:
+        return sql
+    for start, end in on_conditions:
+        condition = sql[start:end].strip()
+        equality = re.fullmatch(rf"(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)", condition)
+        if equality and {equality.group(1).lower(), equality.group(3).lower()} == {filter_alias.lower(), fact_alias.lower()} \
+                and equality.group(2).lower() == equality.group(4).lower() and key is None:
+            key = equality.group(2)
+        elif fact_ref.search(condition) or not filter_ref.search(condition):
+            return sql
+        else:
+            filters.append(condition)
+    if key is None:
+        return sql
+
+    # WHERE: conditions on the joined relation move into the subquery
+    rest = []
+    where = ends[0] if ends and ends[0].group(1).upper() == "WHERE" else None
+    tail_start = from_end
+    if where:
+        later = _top_level(masked, depths, _CLAUSE_END, where.end())
+        where_end = later[0].start() if later else len(sql)
+        where_conditions = _conjuncts(masked, depths, where.end(), where_end)
+        if where_conditions is None:
+            return sql
+        for start, end in where_conditions:
+            condition = sql[start:end].strip()
+            if filter_ref.search(condition):
+                if fact_ref.search(condition):
+                    return sql
+                filters.append(condition)
+            else:
+                rest.append(condition)
+        tail_start = where_end
+    # The joined relation must not feed the output: no columns of it, and no bare SELECT *
+    elsewhere = sql[select.end():froms[0].start()] + sql[tail_start:]
+    star = re.compile(r"(?<![\w.])\*")
+    if (filter_ref.search(elsewhere) or re.search(rf"(?<![\w.]){re.escape(filter_alias)}\.\*", elsewhere, re.IGNORECASE)
+            or _top_level(masked, depths, star, select.end(), froms[0].start())):
+        return sql
+
+    unqualified = [filter_ref.sub(lambda m: m.group(1), f) for f in filters]
+    if filter_table.split(".")[-1].lower() == "patientdim":
+        needs_current = _PATIENT_KEYS.get(key.lower())
+        if needs_current is None:
+            return sql
+        if needs_current and not any(re.fullmatch(r"IsCurrent\s*=\s*1", f, re.IGNORECASE) for f in unqualified):
+            return sql
+        subquery = f"SELECT {key} FROM {filter_table}" + (f" WHERE {' AND '.join(unqualified)}" if unqualified else "")
+        prefix = sql[:select.start()]
+        notes.append(f"JOIN to {filter_table} replaced with {fact_alias}.{key} IN (subquery)")
+    else:
+        start, body_start, close = ctes[filter_table.lower()]
+        body = sql[body_start:close].strip()
+        body_masked = masked[body_start:close]
+        selected = re.match(r"\s*SELECT\s+DISTINCT\s+(?:TOP\s*\(?\d+\)?\s+)?(?:\w+\.)?(\w+)\s+FROM\b", body_masked,
+                            re.IGNORECASE)
+        if filters or not selected or selected.group(1).lower() != key.lower():
+            return sql
+        subquery = body
+        prefix = sql[:start] + sql[close + 1:select.start()]
+        prefix = "" if not prefix.strip() or prefix.strip().upper() == "WITH" else prefix
+        notes.append(f"CTE {filter_table} joined on {key} inlined as {fact_alias}.{key} IN (subquery)")
+
+    fact_sql = f"{fact_table} {fact_alias}" if aliased else fact_table
+    conditions = [f"{fact_alias}.{key} IN ({subquery})"] + rest
+    return (f"{prefix}{sql[select.start():from_start]} {fact_sql}\nWHERE {' AND '.join(conditions)}"
+            + (" " + sql[tail_start:].lstrip() if sql[tail_start:].strip() else ""))
+
+
+def _bound_rows(sql: str, row_limit: int, notes: list[str]) -> str:
+    """Add TOP (row_limit + 1) to the outermost SELECT when it has no row bound"""
+    masked = _mask(sql)
+    depths = _depths(masked)
+    select = _main_select(masked, depths)
+    if select is None:
+        return sql
+    head = re.compile(r"\s*(?:(DISTINCT|ALL)\s+)?(TOP\b)?", re.IGNORECASE).match(masked, select.end())
+    if head.group(2) or _top_level(masked, depths, re.compile(r"\b(OFFSET|INTO)\b", re.IGNORECASE), select.end()):
+        return sql
+    insert_at = head.end()
+    notes.append(f"TOP {row_limit + 1} added so the server stops after row_limit rows")
+    return f"{sql[:insert_at].rstrip()} TOP {row_limit + 1} {sql[insert_at:]}"
+
+
+def rewrite_query(sql: str, row_limit: Optional[int] = None) -> tuple[str, list[str]]:
+    """Rewrite the CDW's known slow query shapes; returns the SQL to run and what was changed.
+
+    - SELECT TOP n DISTINCT (a syntax error) becomes SELECT DISTINCT TOP n
+    - date conversions of *DateKey columns compared to dates become integer comparisons
+    - a JOIN to PatientDim, or to a CTE of keys, used only as a filter becomes key IN (subquery)
+    - with row_limit, an unbounded outermost SELECT gets TOP (row_limit + 1)
+
+    The original SQL is returned unchanged (with no notes) when nothing applies.
+    """
+    notes: list[str] = []
+    rewritten = _strip_comments(sql) if ("--" in sql or "/*" in sql) else sql
+    masked = _mask(rewritten)
+    swaps = [m for m in _TOP_THEN_DISTINCT.finditer(masked)]
+    if swaps:
+        for m in reversed(swaps):
+            rewritten = (rewritten[:m.start()] + f"SELECT{m.group(1)}DISTINCT{m.group(3)}{rewritten[m.start(2):m.end(2)]}"
+                         + rewritten[m.end():])
+        notes.append("TOP n DISTINCT reordered to DISTINCT TOP n")
+    rewritten = _rewrite_dates(rewritten, notes)
+    rewritten = _semi_join(rewritten, notes)
+    if row_limit is not None:
+        rewritten = _bound_rows(rewritten, row_limit, notes)
+    return (rewritten, notes) if notes else (sql, [])
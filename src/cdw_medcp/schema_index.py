@@ -0,0 +1,140 @@
+"""Inverted token index over the bundled schema reference for ranked schema search"""
+
+import math
+import re
+from bisect import bisect_left
+from collections import defaultdict
+
+# Relative weight of a term hit by the field it was found in
+_FIELD_WEIGHTS = {
+    "table_name": 10.0,
+    "column_name": 4.0,
+    "table_description": 2.0,
+    "column_description": 1.0,
+}
+
+# Ceiling of a term's column hits within one table. Kept below the table_name
+# weight minus table_description, so a table named after the term outranks
+# wide tables that merely mention it in dozens of columns.
+_COLUMN_SCORE_CAP = 6.0
+
+_WORD = re.compile(r"[A-Za-z]+|\d+")
+_CAMEL = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase word tokens, splitting CamelCase and snake_case identifiers.
+
+    "LabComponentResultFact" yields lab, component, result, fact and the
+    whole identifier, so both "labcomponent..." prefixes and single words match.
+    """
+    if not text:
+        return []
+    tokens = []
+    for word in _WORD.findall(text):
+        parts = _CAMEL.findall(word)
+        tokens.extend(p.lower() for p in parts)
+        if len(parts) > 1:
+            tokens.append(word.lower())
+    for ident in re.findall(r"\w+", text):
+        if "_" in ident or (ident != ident.lower() and ident != ident.upper()):
+            tokens.append(ident.lower())
+    return tokens
+
+
+class SchemaIndex:
+    """Token -> posting list index over table names, column names and descriptions.
+
+    A posting is (table, column or None, field). Queries are whitespace-separated
+    terms combined with AND at the table level; each term matches every indexed
+    token it is a prefix of (falling back to substring matches within the
+    vocabulary when no token starts with it). Per term, a table scores its
+    best table_name hit (worth more the larger the share of the name the
+    token covers) and table_description hit, plus its column hits, which
+    saturate at _COLUMN_SCORE_CAP; tables are ranked by the sum over terms.
+    """
+
+    def __init__(self, postings: dict[str, list[tuple]]):
+        self._postings = postings
+        self._vocabulary = sorted(postings)
+
+    @classmethod
+    def build(cls, schema_ref: dict) -> "SchemaIndex":
+        postings: dict[str, set] = defaultdict(set)
+        for table_name, info in schema_ref.items():
+            for token in tokenize(table_name):
+                postings[token].add((table_name, None, "table_name"))
+            for token in tokenize(info.get("description") or ""):
+                postings[token].add((table_name, None, "table_description"))
+            for col in info.get("columns", []):
+                col_name = col.get("name") or ""
+                for token in tokenize(col_name):
+                    postings[token].add((table_name, col_name, "column_name"))
+                for token in tokenize(col.get("description") or ""):
+                    postings[token].add((table_name, col_name, "column_description"))
+        return cls({token: sorted(hits, key=lambda h: (h[0], h[1] or "", h[2])) for token, hits in postings.items()})
+
+    def _expand(self, term: str) -> list[str]:
+        """Vocabulary tokens matched by a query term (prefix, else substring)"""
+        start = bisect_left(self._vocabulary, term)
+        matches = []
+        for token in self._vocabulary[start:]:
+            if not token.startswith(term):
+                break
+            matches.append(token)
+        if not matches:
+            matches = [token for token in self._vocabulary if term in token]
+        return matches
+
+    def search(self, query: str, top_n: int = 20) -> list[dict]:
+        """Rank tables matching every term in the query.
+
+        Returns [{"table_name", "score", "matching_columns": {column: score}}]
+        sorted by descending score.
+        """
+        terms = [t for t in dict.fromkeys(tokenize(query) or query.lower().split())]
+        if not terms:
+            return []
+
+        per_term = []
+        for term in terms:
+            hits: dict[str, dict] = {}
+            for token in self._expand(term):
+                # Exact token matches outrank prefix/substring matches
+                boost = 1.0 if token == term else 0.5
+                for table, column, field in self._postings[token]:
+                    entry = hits.setdefault(table, {"table": {}, "columns": defaultdict(float)})
+                    weight = _FIELD_WEIGHTS[field] * boost
+                    if field == "table_name":
+                        # MedicationDim is more about "medication" than MedicationAdministrationFact
+                        weight *= 1 + len(token) / len(table)
+                    if column is None:
+                        entry["table"][field] = max(entry["table"].get(field, 0.0), weight)
+                    else:
+                        entry["columns"][column] += weight
+            for entry in hits.values():
+                column_hits = sum(entry["columns"].values())
+                entry["score"] = (sum(entry["table"].values())
+                                  + _COLUMN_SCORE_CAP * (1 - math.exp(-column_hits / _COLUMN_SCORE_CAP)))
+            per_term.append(hits)
+
+        tables = set(per_term[0])
+        for hits in per_term[1:]:
+            tables &= set(hits)
+
+        results = []
+        for table in tables:
+            columns: dict[str, float] = defaultdict(float)
+            score = 0.0
+            for hits in per_term:
+                entry = hits[table]
+                score += entry["score"]
+                for column, weight in entry["columns"].items():
+                    columns[column] += weight
+            results.append({
+                "table_name": table,
+                "score": round(score, 2),
+                "matching_columns": dict(sorted(columns.items(), key=lambda kv: kv[1], reverse=True)),
+            })
+        results.sort(key=lambda r: (-r["score"], r["table_name"]))
+        return results[:top_n]
@@ -0,0 +1,105 @@
+"""Compact on-disk schema reference with a table of contents for per-table loads.
+
+Layout (all integers little-endian):
+
+    magic    4 bytes  b"CDWS"
+    version  uint16
+    toc_len  uint32
+    toc      toc_len bytes of compact JSON: a list of per-table summaries, each
+             with "name", "offset" and "length" of its record plus the fields
+             get_database_overview needs (description, flags, key columns,
+             column_count)
+    records  compact JSON objects, one per table, at the TOC offsets
+             (relative to the first byte after the TOC)
+
+Only the header and TOC are parsed on open; a table record is decoded from
+the memory-mapped file the first time it is asked for.
+"""
+
+import json
+import mmap
+import struct
+from pathlib import Path
+from typing import Optional
+
+MAGIC = b"CDWS"
+VERSION = 1
+_HEADER = struct.Struct("<4sHI")
+
+# Table-level fields copied into the TOC so the overview never touches records
+_SUMMARY_FIELDS = ("description", "has_patient_data", "has_encounter_data", "patient_key_column", "encounter_key_column")
+
+
+def write_schema_store(schema: dict, path: str | Path) -> None:
+    """Write a {table_name: table_info} schema reference in the compact format"""
+    toc = []
+    records = []
+    offset = 0
+    for name, info in schema.items():
+        record = json.dumps(info, separators=(",", ":"), default=str).encode("utf-8")
+        entry = {"name": name, "offset": offset, "length": len(record)}
+        for field in _SUMMARY_FIELDS:
+            if field in info:
+                entry[field] = info[field]
+        entry["column_count"] = len(info.get("columns", []))
+        toc.append(entry)
+        records.append(record)
+        offset += len(record)
+    toc_bytes = json.dumps(toc, separators=(",", ":"), default=str).encode("utf-8")
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(toc_bytes)))
+        f.write(toc_bytes)
+        for record in records:
+            f.write(record)
+
+
+class SchemaStore:
+    """Read-only view of a compact schema reference file"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, toc_len = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError(f"{self.path} is not a version {VERSION} schema store")
+        toc_start = _HEADER.size
+        self._data_start = toc_start + toc_len
+        self._toc: list[dict] = json.loads(self._mm[toc_start:self._data_start])
+        self._by_name = {entry["name"]: entry for entry in self._toc}
+        self._by_lower = {name.lower(): name for name in self._by_name}
+
+    def __contains__(self, table_name: str) -> bool:
+        return table_name in self._by_name
+
+    def __len__(self) -> int:
+        return len(self._toc)
+
+    def table_names(self) -> list[str]:
+        return list(self._by_name)
+
+    def summaries(self) -> list[dict]:
+        """TOC entries in file order, without the record offsets"""
+        return [{k: v for k, v in entry.items() if k not in ("offset", "length")} for entry in self._toc]
+
+    def resolve(self, table_name: str) -> Optional[str]:
+        """Exact table name for a possibly differently-cased name, or None"""
+        if table_name in self._by_name:
+            return table_name
+        return self._by_lower.get(table_name.lower())
+
+    def table(self, table_name: str) -> dict:
+        """Decode one table's full record (columns included)"""
+        entry = self._by_name[table_name]
+        start = self._data_start + entry["offset"]
+        return json.loads(self._mm[start:start + entry["length"]])
+
+    def load_all(self) -> dict:
+        """Decode every table record, in file order"""
+        return {name: self.table(name) for name in self._by_name}
+
+    def close(self) -> None:
+        self._mm.close()
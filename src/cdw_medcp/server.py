@@ -1,17 +1,33 @@
 """CDW_MedCP server — creates FastMCP and registers all tool modules"""
 
+import atexit
 import logging
 from typing import Literal, Optional
 
 from fastmcp.server import FastMCP
 
-from cdw_medcp.config import CDWConfig, ClinicalDBConfig
+from cdw_medcp.cache import ResultCache
+from cdw_medcp.codesets import CodeSetStore
+from cdw_medcp.config import (CacheConfig, CDWConfig, ClinicalDBConfig, CostGuardConfig, CursorConfig,
+                              ExecutorConfig, NoteCacheConfig, NotesIndexConfig, PoolConfig, SlowQueryLogConfig,
+                              TerminologyConfig)
+from cdw_medcp.cursors import CursorStore
+from cdw_medcp.db import ConnectionPool
+from cdw_medcp.executor import QueryExecutor
+from cdw_medcp.explain import CostGuard
+from cdw_medcp.metrics import Metrics, MetricsMiddleware
+from cdw_medcp.note_cache import NoteCache
+from cdw_medcp.notes_index import NotesIndex
+from cdw_medcp.patients import PatientResolver
+from cdw_medcp.slowlog import SlowQueryLog
+from cdw_medcp.terminology import TerminologySnapshot
 from cdw_medcp.tools.schema import register_schema_tools
 from cdw_medcp.tools.queries import register_query_tools
 from cdw_medcp.tools.notes import register_notes_tools
 from cdw_medcp.tools.export import register_export_tools
 from cdw_medcp.tools.concepts import register_concept_tools
 from cdw_medcp.tools.stats import register_stats_tools
+from cdw_medcp.tools.diagnostics import register_diagnostics_tools
 
 logger = logging.getLogger("CDW_MedCP")
 
@@ -29,18 +45,35 @@ def create_cdw_server(config: CDWConfig) -> FastMCP:
 
     mcp = FastMCP("CDW_MedCP")
     ns = _format_namespace(config.namespace)
+    slow_log = SlowQueryLog(config.slow_query_log)
+    metrics = Metrics(on_statement=slow_log.record if slow_log.enabled else None)
+    mcp.add_middleware(MetricsMiddleware(metrics, ns))
 
     # Schema tools (bundled reference, no DB connection needed)
     register_schema_tools(mcp, ns)
 
-    # All other tools require DB connection
-    db_config = config.clinical_db
+    # All other tools run on a bounded worker pool with pooled connections
+    pool = ConnectionPool(config.clinical_db, config.pool)
+    executor = QueryExecutor(pool, config.executor)
+    cache = ResultCache(config.cache)
+    cursors = CursorStore(pool, config.cursors)
+    atexit.register(pool.close)
+    atexit.register(executor.shutdown)
+    atexit.register(cursors.close_all)
     schema = config.db_schema
-    register_query_tools(mcp, ns, db_config, schema)
-    register_notes_tools(mcp, ns, db_config, schema)
-    register_export_tools(mcp, ns, db_config)
-    register_concept_tools(mcp, ns, db_config, schema)
-    register_stats_tools(mcp, ns, db_config, schema)
+    patients = PatientResolver(schema)
+    notes_index = NotesIndex(config.notes_index)
+    note_cache = NoteCache(config.note_cache)
+    terminology = TerminologySnapshot(config.terminology)
+    codesets = CodeSetStore()
+    guard = CostGuard(config.cost_guard)
+    register_query_tools(mcp, ns, executor, cache, cursors, patients, codesets, guard, schema)
+    register_notes_tools(mcp, ns, executor, note_cache, notes_index, schema)
+    register_export_tools(mcp, ns, executor, codesets, guard)
+    register_concept_tools(mcp, ns, executor, cache, terminology, codesets, schema)
+    register_stats_tools(mcp, ns, executor, codesets, guard, schema)
+    register_diagnostics_tools(mcp, ns, executor, cache, cursors, patients, notes_index, note_cache,
+                               terminology, codesets, guard, metrics, slow_log)
 
     # MCP Prompts
     @mcp.prompt("clinical_data_exploration")
@@ -84,15 +117,16 @@ def create_cdw_server(config: CDWConfig) -> FastMCP:
             "- SQL Server syntax: SELECT DISTINCT TOP N (not TOP N DISTINCT)\n"
             "- CTE + JOIN also times out — use nested subqueries instead\n"
             "- For multi-fact queries (e.g., diagnosis + medication): use a 2-step approach.\n"
-            "  First use concept search tools to get key values, then use hardcoded IN (...)\n"
-            "  lists instead of nesting subqueries across multiple large fact tables.\n\n"
+            "  First expand the codes with expand_code_set, then filter each fact table with\n"
+            "  DiagnosisKey IN ({{codeset:<handle>}}) (the server inlines the key list) instead of\n"
+            "  nesting subqueries across multiple large fact tables.\n\n"
             "DATE HANDLING:\n"
             "- Date columns (*DateKey) are YYYYMMDD integers (e.g., 20240115)\n"
             "- Convert: CONVERT(DATE, CAST(DateKey AS VARCHAR(8)), 112)\n"
             "- Filter invalid dates: WHERE DateKey > 19000101\n"
             "- Treatment duration: use StartDateKey/EndDateKey span, not just OrderedDateKey\n\n"
             "WORKFLOW:\n"
-            "1. Search diagnosis/medication/procedure codes to find the right terminology keys\n"
+            "1. Search diagnosis/medication/procedure codes, then expand_code_set to get a handle for their keys\n"
             "2. Build a subquery using PatientDurableKey from the relevant fact table\n"
             "3. Use cohort_summary with the patient_key_query to get counts and demographics\n"
             f"4. Retrieve demographics: SELECT ... FROM {schema}.PatientDim WHERE IsCurrent = 1 AND PatientDurableKey IN (subquery)\n"
@@ -136,6 +170,30 @@ def main(
     namespace: str = "CDW",
     schema: str = "deid_uf",
     log_level: str = "INFO",
+    pool_min_size: int = 1,
+    pool_max_size: int = 8,
+    pool_idle_timeout: float = 300.0,
+    max_concurrent_queries: int = 8,
+    max_queued_queries: int = 32,
+    cache_max_mb: int = 64,
+    cache_refresh_time: Optional[str] = None,
+    max_open_cursors: int = 4,
+    cursor_idle_timeout: float = 120.0,
+    notes_index_dir: Optional[str] = None,
+    notes_index_max_mb: int = 1024,
+    notes_index_max_age_hours: float = 24.0,
+    note_cache_dir: Optional[str] = None,
+    note_cache_max_mb: int = 128,
+    terminology_dir: Optional[str] = None,
+    terminology_max_age_hours: float = 168.0,
+    max_query_cost: float = 0.0,
+    max_scan_rows: int = 0,
+    slow_query_dir: Optional[str] = None,
+    slow_query_ms: float = 1000.0,
+    slow_query_max_mb: int = 64,
+    query_timeout: float = 300.0,
+    tool_timeouts: Optional[str] = None,
+    login_timeout: int = 30,
     host: str = "127.0.0.1",
     port: int = 8000,
     path: str = "/mcp/",
@@ -152,6 +210,48 @@ def main(
             username=clinical_records_username,
             password=clinical_records_password,
         ),
+        pool=PoolConfig(
+            min_size=pool_min_size,
+            max_size=pool_max_size,
+            idle_timeout=pool_idle_timeout,
+            login_timeout=login_timeout,
+        ),
+        executor=ExecutorConfig(
+            max_workers=max_concurrent_queries,
+            max_queue=max_queued_queries,
+            default_timeout=query_timeout,
+            timeout_overrides=tool_timeouts or {},
+        ),
+        cache=CacheConfig(
+            max_bytes=cache_max_mb * 1024 * 1024,
+            refresh_time=cache_refresh_time,
+        ),
+        cursors=CursorConfig(
+            max_open=max_open_cursors,
+            idle_timeout=cursor_idle_timeout,
+        ),
+        notes_index=NotesIndexConfig(
+            directory=notes_index_dir,
+            max_disk_mb=notes_index_max_mb,
+            max_age_hours=notes_index_max_age_hours,
+        ),
+        note_cache=NoteCacheConfig(
+            directory=note_cache_dir,
+            max_mb=note_cache_max_mb,
+        ),
+        terminology=TerminologyConfig(
+            directory=terminology_dir,
+            max_age_hours=terminology_max_age_hours,
+        ),
+        cost_guard=CostGuardConfig(
+            max_cost=max_query_cost,
+            max_scan_rows=max_scan_rows,
+        ),
+        slow_query_log=SlowQueryLogConfig(
+            directory=slow_query_dir,
+            threshold_ms=slow_query_ms,
+            max_mb=slow_query_max_mb,
+        ),
         namespace=namespace,
         db_schema=schema,
         log_level=log_level,
@@ -161,12 +261,19 @@ def main(
     logger.info(f"Database: {clinical_records_server}/{clinical_records_database}")
 
     mcp = create_cdw_server(config)
-    mcp.run()
+    if transport == "stdio":
+        mcp.run()
+    else:
+        logger.info(f"Serving {transport} on {host}:{port}{path}; Prometheus metrics at /metrics")
+        mcp.run(transport=transport, host=host, port=port, path=path)
 
 
 if __name__ == "__main__":
     import os
     main(
+        transport=os.getenv("CDW_TRANSPORT", "stdio"),
+        host=os.getenv("CDW_HOST", "127.0.0.1"),
+        port=int(os.getenv("CDW_PORT", "8000")),
         clinical_records_server=os.getenv("CLINICAL_RECORDS_SERVER"),
         clinical_records_database=os.getenv("CLINICAL_RECORDS_DATABASE"),
         clinical_records_username=os.getenv("CLINICAL_RECORDS_USERNAME"),
@@ -174,4 +281,28 @@ if __name__ == "__main__":
         namespace=os.getenv("CDW_NAMESPACE", "CDW"),
         schema=os.getenv("CDW_SCHEMA", "deid_uf"),
         log_level=os.getenv("CDW_LOG_LEVEL", "INFO"),
+        pool_min_size=int(os.getenv("CDW_POOL_MIN_SIZE", "1")),
+        pool_max_size=int(os.getenv("CDW_POOL_MAX_SIZE", "8")),
+        pool_idle_timeout=float(os.getenv("CDW_POOL_IDLE_TIMEOUT", "300")),
+        max_concurrent_queries=int(os.getenv("CDW_MAX_CONCURRENT_QUERIES", "8")),
+        max_queued_queries=int(os.getenv("CDW_MAX_QUEUED_QUERIES", "32")),
+        cache_max_mb=int(os.getenv("CDW_CACHE_MAX_MB", "64")),
+        cache_refresh_time=os.getenv("CDW_CACHE_REFRESH_TIME") or None,
+        max_open_cursors=int(os.getenv("CDW_MAX_OPEN_CURSORS", "4")),
+        cursor_idle_timeout=float(os.getenv("CDW_CURSOR_IDLE_TIMEOUT", "120")),
+        notes_index_dir=os.getenv("CDW_NOTES_INDEX_DIR") or None,
+        notes_index_max_mb=int(os.getenv("CDW_NOTES_INDEX_MAX_MB", "1024")),
+        notes_index_max_age_hours=float(os.getenv("CDW_NOTES_INDEX_MAX_AGE_HOURS", "24")),
+        note_cache_dir=os.getenv("CDW_NOTE_CACHE_DIR") or None,
+        note_cache_max_mb=int(os.getenv("CDW_NOTE_CACHE_MAX_MB", "128")),
+        terminology_dir=os.getenv("CDW_TERMINOLOGY_DIR") or None,
+        terminology_max_age_hours=float(os.getenv("CDW_TERMINOLOGY_MAX_AGE_HOURS", "168")),
+        max_query_cost=float(os.getenv("CDW_MAX_QUERY_COST", "0")),
+        max_scan_rows=int(os.getenv("CDW_MAX_SCAN_ROWS", "0")),
+        slow_query_dir=os.getenv("CDW_SLOW_QUERY_DIR") or None,
+        slow_query_ms=float(os.getenv("CDW_SLOW_QUERY_MS", "1000")),
+        slow_query_max_mb=int(os.getenv("CDW_SLOW_QUERY_MAX_MB", "64")),
+        query_timeout=float(os.getenv("CDW_QUERY_TIMEOUT", "300")),
+        tool_timeouts=os.getenv("CDW_TOOL_TIMEOUTS") or None,
+        login_timeout=int(os.getenv("CDW_LOGIN_TIMEOUT", "30")),
     )
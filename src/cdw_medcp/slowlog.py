@@ -0,0 +1,186 @@
+"""Slow-query log: statements above a latency threshold, fingerprinted, in rotating JSONL files"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from cdw_medcp.config import SlowQueryLogConfig
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Longest statement text kept in a record; inlined code sets can run to megabytes
+MAX_LOGGED_SQL = 8000
+
+_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_STRING = re.compile(r"N?'(?:[^']|'')*'", re.IGNORECASE)
+_NUMBER = re.compile(r"(?<![\w@#$.\]])\d+(?:\.\d+)?(?:e[-+]?\d+)?\b", re.IGNORECASE)
+_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+# col IN (?+) OR col IN (?+) ... as written by chunked code-set inlining
+_LIST_CHAIN = re.compile(r"(\S+ (?:not )?in \(\?\+\))(?: (?:or|and) \1)+")
+
+
+def fingerprint(sql: str) -> str:
+    """Shape of a statement: comments dropped, literals replaced by ?, value lists collapsed to (?+).
+
+    Statements differing only in patient keys, dates, codes or the length of
+    an IN list share a fingerprint.
+    """
+    sql = _COMMENT.sub(" ", sql)
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = re.sub(r"\s+", " ", sql).strip().lower()
+    sql = _VALUE_LIST.sub("(?+)", sql)
+    return _LIST_CHAIN.sub(r"\1", sql)
+
+
+def fingerprint_id(shape: str) -> str:
+    return hashlib.sha256(shape.encode("utf-8")).hexdigest()[:12]
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    return sorted_values[max(0, min(len(sorted_values) - 1, round(q * len(sorted_values) + 0.5) - 1))]
+
+
+class SlowQueryLog:
+    """Append statements slower than threshold_ms to <directory>/slow_queries.jsonl.
+
+    One JSON object per line: timestamp, tool, fingerprint, duration, rows,
+    whether the statement failed (timeouts included) and the SQL as it was
+    sent to the server, i.e. after rewriting and code-set inlining. The file
+    is rotated to slow_queries.jsonl.1 ... .<backups> when it reaches max_mb.
+    report() aggregates the current and rotated files by fingerprint.
+    """
+
+    FILENAME = "slow_queries.jsonl"
+
+    def __init__(self, config: SlowQueryLogConfig | None = None):
+        self._config = config or SlowQueryLogConfig()
+        self._dir = Path(self._config.directory).expanduser() if self._config.directory else None
+        self._lock = threading.Lock()
+        self._stats = {"statements": 0, "logged": 0, "rotations": 0, "write_errors": 0}
+        if self._dir:
+            self._dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self._dir is not None
+
+    def _path(self, generation: int = 0) -> Path:
+        return self._dir / (self.FILENAME if generation == 0 else f"{self.FILENAME}.{generation}")
+
+    def _rotate(self) -> None:
+        """Shift slow_queries.jsonl.N to .N+1, dropping the oldest (caller holds the lock)"""
+        self._path(self._config.backups).unlink(missing_ok=True)
+        for generation in range(self._config.backups - 1, -1, -1):
+            if self._path(generation).exists():
+                os.replace(self._path(generation), self._path(generation + 1))
+        self._stats["rotations"] += 1
+
+    def record(self, tool: str, sql: str, seconds: float, rows: int, failed: bool = False) -> None:
+        """Log one finished statement if it ran for at least the threshold"""
+        with self._lock:
+            self._stats["statements"] += 1
+        duration_ms = seconds * 1000
+        if not self.enabled or duration_ms < self._config.threshold_ms:
+            return
+        shape = fingerprint(sql)
+        line = json.dumps({
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+            "tool": tool,
+            "fingerprint_id": fingerprint_id(shape),
+            "fingerprint": shape[:MAX_LOGGED_SQL],
+            "duration_ms": round(duration_ms, 1),
+            "rows": rows,
+            "error": failed,
+            "sql": sql if len(sql) <= MAX_LOGGED_SQL else sql[:MAX_LOGGED_SQL] + " ...[truncated]",
+        }, separators=(",", ":")) + "\n"
+        with self._lock:
+            try:
+                path = self._path()
+                if path.exists() and path.stat().st_size + len(line) > self._config.max_mb * 1024 * 1024:
+                    self._rotate()
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                self._stats["logged"] += 1
+            except OSError as e:
+                self._stats["write_errors"] += 1
+                logger.warning(f"Could not write the slow-query log: {e}")
+
+    def _records(self):
+        """Logged records, oldest file first; unreadable lines are skipped"""
+        for generation in range(self._config.backups, -1, -1):
+            try:
+                with open(self._path(generation), encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            continue
+            except FileNotFoundError:
+                continue
+
+    def report(self, top: int = 20, tool: Optional[str] = None, since_hours: Optional[float] = None,
+               sort_by: str = "total_ms") -> dict:
+        """Aggregate logged statements by fingerprint: count, p50/p95/max and total time, rows, tools"""
+        since = (time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - since_hours * 3600))
+                 if since_hours else None)
+        groups: dict[str, dict] = {}
+        statements = 0
+        for rec in self._records():
+            if (tool and rec.get("tool") != tool) or (since and rec.get("ts", "") < since):
+                continue
+            statements += 1
+            group = groups.get(rec["fingerprint_id"])
+            if group is None:
+                group = groups[rec["fingerprint_id"]] = {
+                    "fingerprint": rec["fingerprint"], "durations": [], "rows": 0, "errors": 0, "tools": {},
+                }
+            group["durations"].append(rec["duration_ms"])
+            group["rows"] += rec.get("rows") or 0
+            group["errors"] += int(bool(rec.get("error")))
+            group["tools"][rec["tool"]] = group["tools"].get(rec["tool"], 0) + 1
+            group["last_seen"], group["example_sql"] = rec["ts"], rec["sql"]
+
+        shapes = []
+        for shape_id, group in groups.items():
+            durations = sorted(group["durations"])
+            shapes.append({
+                "fingerprint_id": shape_id,
+                "count": len(durations),
+                "total_ms": round(sum(durations), 1),
+                "p50_ms": _percentile(durations, 0.5),
+                "p95_ms": _percentile(durations, 0.95),
+                "max_ms": durations[-1],
+                "avg_rows": round(group["rows"] / len(durations), 1),
+                "errors": group["errors"],
+                "tools": group["tools"],
+                "last_seen": group["last_seen"],
+                "fingerprint": group["fingerprint"],
+                "example_sql": group["example_sql"],
+            })
+        shapes.sort(key=lambda s: s[sort_by], reverse=True)
+        total_ms = sum(s["total_ms"] for s in shapes)
+        for shape in shapes:
+            shape["share_of_time"] = round(shape["total_ms"] / total_ms, 3) if total_ms else 0.0
+        return {
+            "threshold_ms": self._config.threshold_ms,
+            "statements": statements,
+            "fingerprints": len(shapes),
+            "total_ms": round(total_ms, 1),
+            "top": shapes[:top],
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        size = 0
+        if self._dir:
+            size = sum(self._path(g).stat().st_size for g in range(self._config.backups + 1) if self._path(g).exists())
+        return {**stats, "enabled": self.enabled, "threshold_ms": self._config.threshold_ms, "disk_bytes": size}
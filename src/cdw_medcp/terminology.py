@@ -0,0 +1,254 @@
+"""Local snapshot of the terminology dimensions for fast concept search (SQLite FTS5 + code index)"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from cdw_medcp.config import TerminologyConfig
+
+logger = logging.getLogger("CDW_MedCP")
+
+# Rows pulled from the CDW per round trip while building a snapshot
+SNAPSHOT_BATCH_ROWS = 5000
+
+# Concept domains: the CDW select list and FROM clause (shared with the live
+# fallback queries), the output column names, the code column, the name
+# columns indexed for text search, the key fact tables are filtered on and
+# the column naming the code system (ICD-10-CM, SNOMED, CPT, RxNorm, ...).
+DOMAINS = {
+    "diagnosis": {
+        "select": ("dt.DiagnosisTerminologyKey", "dt.DiagnosisKey", "dt.Type", "dt.Value", "dt.DisplayString",
+                   "dd.Name AS DiagnosisName"),
+        "from": "{schema}.DiagnosisTerminologyDim dt JOIN {schema}.DiagnosisDim dd ON dt.DiagnosisKey = dd.DiagnosisKey",
+        "columns": ("DiagnosisTerminologyKey", "DiagnosisKey", "Type", "Value", "DisplayString", "DiagnosisName"),
+        "code": "Value",
+        "names": ("DisplayString", "DiagnosisName"),
+        "key": "DiagnosisKey",
+        "type": "Type",
+    },
+    "medication": {
+        "select": ("mc.MedicationCodeKey", "mc.MedicationKey", "mc.Type", "mc.Code", "mc.MedicationName",
+                   "mc.MedicationGenericName", "mc.MedicationTherapeuticClass"),
+        "from": "{schema}.MedicationCodeDim mc",
+        "columns": ("MedicationCodeKey", "MedicationKey", "Type", "Code", "MedicationName", "MedicationGenericName",
+                    "MedicationTherapeuticClass"),
+        "code": "Code",
+        "names": ("MedicationName", "MedicationGenericName"),
+        "key": "MedicationKey",
+        "type": "Type",
+    },
+    "procedure": {
+        "select": ("pt.ProcedureTerminologyKey", "pt.Code", "pt.Name", "pt.CodeSet"),
+        "from": "{schema}.ProcedureTerminologyDim pt",
+        "columns": ("ProcedureTerminologyKey", "Code", "Name", "CodeSet"),
+        "code": "Code",
+        "names": ("Name",),
+        "key": "ProcedureTerminologyKey",
+        "type": "CodeSet",
+    },
+}
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_code(code) -> str:
+    """Codes compare case-insensitively and without dots, so E119, e11.9 and E11.9 are equal"""
+    return str(code or "").upper().replace(".", "").strip()
+
+
+def is_code_pattern(term: str) -> bool:
+    """Terms without whitespace that contain a digit or end with % are codes; anything else is a name"""
+    term = term.strip()
+    return bool(term) and not any(c.isspace() for c in term) and (term.endswith("%") or any(c.isdigit() for c in term))
+
+
+def _name_query(term: str) -> Optional[str]:
+    """FTS5 query matching names containing every word of term as a word prefix"""
+    tokens = _TOKEN.findall(term)
+    return " ".join(f'"{t}"*' for t in tokens) if tokens else None
+
+
+class TerminologySnapshot:
+    """On-disk snapshot of the diagnosis, medication and procedure terminology dimensions.
+
+    refresh() pulls each dimension once into <directory>/terminology.sqlite:
+    the rows, a B-tree index on the normalized code (so exact and prefix code
+    lookups are range seeks) and an FTS5 index over the name columns (ranked
+    with BM25). Concept tools search the snapshot while it is younger than
+    max_age_hours and fall back to the live CDW otherwise.
+    """
+
+    FILENAME = "terminology.sqlite"
+
+    def __init__(self, config: TerminologyConfig | None = None):
+        self._config = config or TerminologyConfig()
+        self._dir = Path(self._config.directory).expanduser() if self._config.directory else None
+        self._refresh_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stats = {"refreshes": 0, "local_searches": 0, "live_fallbacks": 0}
+        if self._dir:
+            self._dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self._dir is not None
+
+    @property
+    def path(self) -> Optional[Path]:
+        return self._dir / self.FILENAME if self._dir else None
+
+    def built_at(self) -> Optional[float]:
+        try:
+            return self.path.stat().st_mtime if self._dir else None
+        except FileNotFoundError:
+            return None
+
+    def is_fresh(self) -> bool:
+        built = self.built_at()
+        return built is not None and time.time() - built < self._config.max_age_hours * 3600
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._stats[counter] += 1
+
+    def count_fallback(self) -> None:
+        self._count("live_fallbacks")
+
+    def refresh(self, conn, schema: str) -> dict[str, int]:
+        """Rebuild the snapshot from the CDW; returns rows per domain.
+
+        Blocks on the database for as long as the dimensions take to read; run
+        it on an executor worker. The new file replaces the old one atomically,
+        so searches keep using the previous snapshot until it is complete.
+        """
+        with self._refresh_lock:
+            tmp = self.path.with_suffix(".tmp")
+            tmp.unlink(missing_ok=True)
+            db = sqlite3.connect(tmp)
+            counts = {}
+            try:
+                cursor = conn.cursor()
+                for domain, spec in DOMAINS.items():
+                    counts[domain] = self._load_domain(db, cursor, schema, domain, spec)
+                cursor.close()
+                db.commit()
+            except BaseException:
+                db.close()
+                tmp.unlink(missing_ok=True)
+                raise
+            db.close()
+            os.replace(tmp, self.path)
+            self._count("refreshes")
+        logger.info(f"Terminology snapshot refreshed: {counts}")
+        return counts
+
+    @staticmethod
+    def _load_domain(db: sqlite3.Connection, cursor, schema: str, domain: str, spec: dict) -> int:
+        columns = spec["columns"]
+        db.execute(f"CREATE TABLE {domain} (code_norm TEXT, {', '.join(columns)})")
+        db.execute(f"CREATE VIRTUAL TABLE {domain}_names USING fts5(names, content='', "
+                   f"tokenize = 'unicode61 remove_diacritics 2')")
+        cursor.execute(f"SELECT {', '.join(spec['select'])} FROM {spec['from'].format(schema=schema)}")
+        code_index = columns.index(spec["code"])
+        name_indexes = [columns.index(c) for c in spec["names"]]
+        insert = (f"INSERT INTO {domain} (rowid, code_norm, {', '.join(columns)}) "
+                  f"VALUES ({', '.join(['?'] * (len(columns) + 2))})")
+        count = 0
+        while True:
+            rows = cursor.fetchmany(SNAPSHOT_BATCH_ROWS)
+            if not rows:
+                break
+            rows = [tuple(v if v is None or isinstance(v, (str, int, float)) else str(v) for v in row) for row in rows]
+            rowids = range(count + 1, count + len(rows) + 1)
+            db.executemany(insert, [(rowid, normalize_code(row[code_index])) + row for rowid, row in zip(rowids, rows)])
+            db.executemany(
+                f"INSERT INTO {domain}_names (rowid, names) VALUES (?, ?)",
+                [(rowid, " ".join(str(row[j]) for j in name_indexes if row[j])) for rowid, row in zip(rowids, rows)],
+            )
+            count += len(rows)
+        db.execute(f"CREATE INDEX {domain}_code ON {domain} (code_norm)")
+        return count
+
+    def search(self, domain: str, term: str, limit: int) -> list[tuple]:
+        """Exact code hits, then code-prefix hits, then BM25-ranked name matches, without duplicates.
+
+        A trailing % (e.g. G35%) asks for code prefixes only.
+        """
+        columns = ", ".join(DOMAINS[domain]["columns"])
+        prefix_only = term.endswith("%")
+        code = normalize_code(term.rstrip("%"))
+        db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            rows: dict[int, tuple] = {}
+            if code and " " not in code:
+                if not prefix_only:
+                    for rowid, *row in db.execute(
+                            f"SELECT rowid, {columns} FROM {domain} WHERE code_norm = ? LIMIT ?", (code, limit)):
+                        rows.setdefault(rowid, tuple(row))
+                # Range scan on the code index: every code starting with the prefix
+                upper = code[:-1] + chr(ord(code[-1]) + 1)
+                for rowid, *row in db.execute(
+                        f"SELECT rowid, {columns} FROM {domain} WHERE code_norm >= ? AND code_norm < ? "
+                        f"ORDER BY code_norm LIMIT ?", (code, upper, limit)):
+                    rows.setdefault(rowid, tuple(row))
+            query = None if prefix_only else _name_query(term)
+            if query and len(rows) < limit:
+                for rowid, *row in db.execute(
+                        f"SELECT t.rowid, {', '.join('t.' + c for c in DOMAINS[domain]['columns'])} "
+                        f"FROM {domain}_names n JOIN {domain} t ON t.rowid = n.rowid "
+                        f"WHERE {domain}_names MATCH ? ORDER BY n.rank LIMIT ?", (query, limit)):
+                    rows.setdefault(rowid, tuple(row))
+        finally:
+            db.close()
+        self._count("local_searches")
+        return list(rows.values())[:limit]
+
+    def expand(self, domain: str, pattern: str, code_type: Optional[str], limit: int) -> list:
+        """Distinct fact-table keys of every concept matching pattern, unranked, at most limit.
+
+        Code patterns match every code starting with them, so an ICD-10 category
+        (E11) brings in all of its subcodes; names match as in search().
+        code_type keeps only code systems starting with it (e.g. ICD-10).
+        """
+        spec = DOMAINS[domain]
+        key, type_column = spec["key"], spec["type"]
+        type_filter = f" AND t.{type_column} LIKE ?" if code_type else ""
+        type_args = (code_type.rstrip("%") + "%",) if code_type else ()
+        db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            if is_code_pattern(pattern):
+                code = normalize_code(pattern.rstrip("%"))
+                if not code:
+                    return []
+                upper = code[:-1] + chr(ord(code[-1]) + 1)
+                rows = db.execute(
+                    f"SELECT DISTINCT t.{key} FROM {domain} t WHERE t.code_norm >= ? AND t.code_norm < ?"
+                    f"{type_filter} LIMIT ?", (code, upper, *type_args, limit)).fetchall()
+            else:
+                query = _name_query(pattern)
+                if not query:
+                    return []
+                rows = db.execute(
+                    f"SELECT DISTINCT t.{key} FROM {domain}_names n JOIN {domain} t ON t.rowid = n.rowid "
+                    f"WHERE {domain}_names MATCH ?{type_filter} LIMIT ?", (query, *type_args, limit)).fetchall()
+        finally:
+            db.close()
+        self._count("local_searches")
+        return [row[0] for row in rows if row[0] is not None]
+
+    def stats(self) -> dict:
+        built = self.built_at()
+        with self._lock:
+            counters = dict(self._stats)
+        return {
+            **counters,
+            "enabled": self.enabled,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(built)) if built else None,
+            "fresh": self.is_fresh(),
+            "max_age_hours": self._config.max_age_hours,
+        }
@@ -1,6 +1,9 @@
 """Concept mapping and relationship discovery tools"""
 
+import asyncio
+import json
 import logging
+from typing import Optional
 
 from pydantic import Field
 from fastmcp.exceptions import ToolError
@@ -8,36 +11,104 @@ from fastmcp.server import FastMCP
 from fastmcp.tools.tool import ToolResult, TextContent
 from mcp.types import ToolAnnotations
 
-from cdw_medcp.config import ClinicalDBConfig
-from cdw_medcp.db import get_connection
+from cdw_medcp.cache import ResultCache
+from cdw_medcp.codesets import MAX_CODESET_KEYS, CodeSetStore, placeholder
+from cdw_medcp.executor import QueryExecutor
+from cdw_medcp.metrics import statement, timed
+from cdw_medcp.patients import quote_literal
+from cdw_medcp.rendering import BoundedCSV, cursor_to_csv
+from cdw_medcp.terminology import DOMAINS, TerminologySnapshot, is_code_pattern
 from cdw_medcp.validation import ClinicalQueryValidator
 
 logger = logging.getLogger("CDW_MedCP")
 
+# Patterns accepted by one expand_code_set call, and keys shown in its summary
+MAX_CODESET_PATTERNS = 50
+CODESET_SAMPLE_KEYS = 20
 
-def _run_query(config: ClinicalDBConfig, sql: str) -> str:
+
+def _run_query(conn, sql: str) -> str:
     """Run a validated query and return CSV"""
     if not ClinicalQueryValidator.is_read_only_clinical_query(sql):
         raise ToolError("Only SELECT queries are allowed.")
-    conn = get_connection(config)
-    try:
-        cursor = conn.cursor()
+    cursor = conn.cursor()
+    with statement(sql):
+        with timed("execute"):
+            cursor.execute(sql)
+        result = cursor_to_csv(cursor)
+    cursor.close()
+    if result is None:
+        return "No results found."
+    return result
+
+
+def _column(spec: dict, name: str) -> str:
+    """CDW expression for one of a domain's output columns"""
+    return spec["select"][spec["columns"].index(name)].split(" AS ")[0]
+
+
+def _live_sql(schema: str, domain: str, search_term: str, row_limit: int) -> str:
+    """Substring search of one domain's code and name columns on the CDW"""
+    spec = DOMAINS[domain]
+    pattern = quote_literal(f"%{search_term}%")
+    searched = [_column(spec, spec["code"])] + [_column(spec, name) for name in spec["names"]]
+    return (f"SELECT TOP {row_limit} {', '.join(spec['select'])} "
+            f"FROM {spec['from'].format(schema=schema)} "
+            f"WHERE {' OR '.join(f'{column} LIKE {pattern}' for column in searched)}")
+
+
+def _expansion_sql(schema: str, domain: str, patterns: list[str], code_type: Optional[str], limit: int) -> str:
+    """Distinct keys per pattern on the CDW: code patterns by code prefix, names by substring"""
+    spec = DOMAINS[domain]
+    key = _column(spec, spec["key"])
+    selects = []
+    for index, pattern in enumerate(patterns):
+        if is_code_pattern(pattern):
+            condition = f"{_column(spec, spec['code'])} LIKE {quote_literal(pattern.rstrip('%') + '%')}"
+        else:
+            name_pattern = quote_literal(f"%{pattern}%")
+            condition = "(" + " OR ".join(f"{_column(spec, name)} LIKE {name_pattern}" for name in spec["names"]) + ")"
+        if code_type:
+            condition += f" AND {_column(spec, spec['type'])} LIKE {quote_literal(code_type.rstrip('%') + '%')}"
+        selects.append(f"SELECT DISTINCT TOP {limit} {index} AS pattern, {key} "
+                       f"FROM {spec['from'].format(schema=schema)} WHERE {condition} AND {key} IS NOT NULL")
+    return "\nUNION ALL\n".join(selects)
+
+
+def _fetch_expansion(conn, sql: str, pattern_count: int) -> list[list]:
+    """Keys of each pattern from an _expansion_sql query, in pattern order"""
+    cursor = conn.cursor()
+    found = [[] for _ in range(pattern_count)]
+    with statement(sql) as current:
         cursor.execute(sql)
-        columns = [desc[0] for desc in cursor.description] if cursor.description else []
         rows = cursor.fetchall()
-        cursor.close()
-    finally:
-        conn.close()
-    if not columns:
-        return "No results found."
-    csv_lines = [",".join(columns)]
-    csv_lines.extend([",".join(str(v) if v is not None else "" for v in row) for row in rows])
-    return "\n".join(csv_lines)
+        current["rows"] = len(rows)
+    for index, key in rows:
+        found[index].append(key)
+    cursor.close()
+    return found
 
 
-def register_concept_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: ClinicalDBConfig, schema: str = "deid_uf"):
+def register_concept_tools(mcp: FastMCP, namespace_prefix: str, executor: QueryExecutor, cache: ResultCache,
+                           terminology: TerminologySnapshot, codesets: CodeSetStore, schema: str = "deid_uf"):
     """Register concept mapping and relationship tools"""
 
+    async def _search(tool: str, domain: str, search_term: str, row_limit: int) -> str:
+        """Search the local terminology snapshot when it is fresh, the live CDW otherwise"""
+        if terminology.is_fresh():
+            rows = await asyncio.to_thread(terminology.search, domain, search_term.strip(), row_limit)
+            if not rows:
+                return "No results found."
+            builder = BoundedCSV(list(DOMAINS[domain]["columns"]))
+            for row in rows:
+                if not builder.add(row):
+                    break
+            return builder.text()
+        if terminology.enabled:
+            terminology.count_fallback()
+        sql = _live_sql(schema, domain, search_term, row_limit)
+        return await cache.fetch(tool, sql, row_limit, lambda: executor.run(tool, _run_query, sql))
+
     @mcp.tool(
         name=f"{namespace_prefix}search_diagnoses_by_code",
         annotations=ToolAnnotations(
@@ -48,22 +119,19 @@ def register_concept_tools(mcp: FastMCP, namespace_prefix: str, clinical_config:
             openWorldHint=False
         )
     )
-    def search_diagnoses_by_code(
+    async def search_diagnoses_by_code(
         search_term: str = Field(..., description="ICD/SNOMED code or diagnosis name to search for"),
         row_limit: int = Field(50, description="Maximum results to return")
     ) -> ToolResult:
         """Search diagnoses matching a code or name.
         Joins DiagnosisTerminologyDim (codes) with DiagnosisDim (names).
-        Returns diagnosis keys, names, codes, and terminology types (ICD-9, ICD-10, SNOMED, etc.)."""
-        sql = (
-            f"SELECT TOP {row_limit} dt.DiagnosisTerminologyKey, dt.DiagnosisKey, "
-            f"dt.Type, dt.Value, dt.DisplayString, dd.Name AS DiagnosisName "
-            f"FROM {schema}.DiagnosisTerminologyDim dt "
-            f"JOIN {schema}.DiagnosisDim dd ON dt.DiagnosisKey = dd.DiagnosisKey "
-            f"WHERE dt.Value LIKE '%{search_term}%' OR dt.DisplayString LIKE '%{search_term}%' "
-            f"OR dd.Name LIKE '%{search_term}%'"
-        )
-        result = _run_query(clinical_config, sql)
+        Returns diagnosis keys, names, codes, and terminology types (ICD-9, ICD-10, SNOMED, etc.).
+
+        With a terminology snapshot loaded, exact code matches come first, then codes
+        starting with the term (end it with % for code prefixes only, e.g. G35%), then
+        names containing every word of the term as a word prefix, best match first.
+        Without one, codes and names containing the term are returned."""
+        result = await _search("search_diagnoses_by_code", "diagnosis", search_term, row_limit)
         return ToolResult(content=[TextContent(type="text", text=result)])
 
     @mcp.tool(
@@ -76,21 +144,18 @@ def register_concept_tools(mcp: FastMCP, namespace_prefix: str, clinical_config:
             openWorldHint=False
         )
     )
-    def search_medications_by_code(
+    async def search_medications_by_code(
         search_term: str = Field(..., description="Drug code, brand name, or generic name to search for"),
         row_limit: int = Field(50, description="Maximum results to return")
     ) -> ToolResult:
         """Search MedicationCodeDim for medications matching a code or name.
-        Returns medication keys, names, codes, generic names, and therapeutic classes."""
-        sql = (
-            f"SELECT TOP {row_limit} mc.MedicationCodeKey, mc.MedicationKey, "
-            f"mc.Type, mc.Code, mc.MedicationName, mc.MedicationGenericName, "
-            f"mc.MedicationTherapeuticClass "
-            f"FROM {schema}.MedicationCodeDim mc "
-            f"WHERE mc.Code LIKE '%{search_term}%' OR mc.MedicationName LIKE '%{search_term}%' "
-            f"OR mc.MedicationGenericName LIKE '%{search_term}%'"
-        )
-        result = _run_query(clinical_config, sql)
+        Returns medication keys, names, codes, generic names, and therapeutic classes.
+
+        With a terminology snapshot loaded, exact code matches come first, then codes
+        starting with the term (end it with % for code prefixes only), then
+        names containing every word of the term as a word prefix, best match first.
+        Without one, codes and names containing the term are returned."""
+        result = await _search("search_medications_by_code", "medication", search_term, row_limit)
         return ToolResult(content=[TextContent(type="text", text=result)])
 
     @mcp.tool(
@@ -103,17 +168,120 @@ def register_concept_tools(mcp: FastMCP, namespace_prefix: str, clinical_config:
             openWorldHint=False
         )
     )
-    def search_procedures_by_code(
+    async def search_procedures_by_code(
         search_term: str = Field(..., description="CPT/HCPCS code or procedure name to search for"),
         row_limit: int = Field(50, description="Maximum results to return")
     ) -> ToolResult:
         """Search ProcedureTerminologyDim for procedures matching a code or name.
-        Returns procedure keys, codes, names, and code set types."""
-        sql = (
-            f"SELECT TOP {row_limit} pt.ProcedureTerminologyKey, "
-            f"pt.Code, pt.Name, pt.CodeSet "
-            f"FROM {schema}.ProcedureTerminologyDim pt "
-            f"WHERE pt.Code LIKE '%{search_term}%' OR pt.Name LIKE '%{search_term}%'"
-        )
-        result = _run_query(clinical_config, sql)
+        Returns procedure keys, codes, names, and code set types.
+
+        With a terminology snapshot loaded, exact code matches come first, then codes
+        starting with the term (end it with % for code prefixes only, e.g. 992%), then
+        names containing every word of the term as a word prefix, best match first.
+        Without one, codes and names containing the term are returned."""
+        result = await _search("search_procedures_by_code", "procedure", search_term, row_limit)
         return ToolResult(content=[TextContent(type="text", text=result)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}expand_code_set",
+        annotations=ToolAnnotations(
+            title="Expand Code Set",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def expand_code_set(
+        domain: str = Field(..., description="Concept domain: diagnosis, medication or procedure"),
+        patterns: list[str] = Field(..., description=(
+            "Codes, code prefixes or names, e.g. [\"E11\", \"E13.9\", \"250%\"] or [\"metformin\"]. "
+            "Codes expand to every code beneath them (E11 covers E11.0-E11.9)."
+        )),
+        code_type: Optional[str] = Field(None, description=(
+            "Only keep codes of this code system, matched as a prefix of the terminology type "
+            "(e.g. ICD-10, ICD-9, SNOMED, CPT, RxNorm)"
+        ))
+    ) -> ToolResult:
+        """Expand code patterns or names into the complete set of fact-table keys and
+        return a reusable handle for them.
+
+        Keys are DiagnosisKey (diagnosis), MedicationKey (medication) or
+        ProcedureTerminologyKey (procedure). A pattern with a digit or a trailing %
+        (E11, E11.9, 250%, 99213) is a code and matches every code starting with it,
+        so an ICD category brings in its whole hierarchy; anything else is matched
+        against concept names.
+
+        Instead of pasting keys into SQL, write col IN ({{codeset:<handle>}}) (or
+        NOT IN) in query, export_query_to_csv or cohort_summary; the server inlines
+        the keys as chunked IN lists. Example:
+          SELECT DISTINCT PatientDurableKey FROM deid_uf.DiagnosisEventFact
+          WHERE DiagnosisKey IN ({{codeset:cs_1a2b3c4d5e6f}})
+        Handles are deterministic and kept in memory; expanding the same patterns
+        again returns the same handle with fresh keys."""
+        if domain not in DOMAINS:
+            raise ToolError(f"domain must be one of: {', '.join(DOMAINS)}")
+        patterns = list(dict.fromkeys(p.strip() for p in patterns if p and p.strip()))
+        if not patterns:
+            raise ToolError("patterns must contain at least one code or name")
+        if len(patterns) > MAX_CODESET_PATTERNS:
+            raise ToolError(f"At most {MAX_CODESET_PATTERNS} patterns per code set; got {len(patterns)}.")
+        code_type = code_type.strip() if code_type and code_type.strip() else None
+
+        # Ask for one key more than allowed so an oversized pattern is detected, not truncated
+        limit = MAX_CODESET_KEYS + 1
+        if terminology.is_fresh():
+            source = "snapshot"
+            found = await asyncio.to_thread(
+                lambda: [terminology.expand(domain, pattern, code_type, limit) for pattern in patterns])
+        else:
+            if terminology.enabled:
+                terminology.count_fallback()
+            source = "live"
+            sql = _expansion_sql(schema, domain, patterns, code_type, limit)
+            found = await executor.run("expand_code_set", _fetch_expansion, sql, len(patterns), heavy=True)
+        oversized = [pattern for pattern, keys in zip(patterns, found) if len(keys) > MAX_CODESET_KEYS]
+        if oversized:
+            raise ToolError(f"Patterns {oversized} match more than {MAX_CODESET_KEYS} keys; use more specific codes.")
+
+        total = len({key for keys in found for key in keys})
+        if total > MAX_CODESET_KEYS:
+            raise ToolError(f"The patterns together match {total} keys (limit {MAX_CODESET_KEYS}); "
+                            f"split them into several code sets.")
+
+        key_column = DOMAINS[domain]["key"]
+        entry = codesets.put(domain, patterns, code_type, key_column, dict(zip(patterns, found)), source)
+        handle = entry["handle"]
+        summary = {
+            "handle": handle,
+            "placeholder": placeholder(handle),
+            "domain": domain,
+            "code_type": code_type,
+            "key_column": key_column,
+            "key_count": len(entry["keys"]),
+            "pattern_counts": entry["pattern_counts"],
+            "source": source,
+            "sample_keys": entry["keys"][:CODESET_SAMPLE_KEYS],
+            "usage": f"WHERE {key_column} IN ({placeholder(handle)})",
+        }
+        return ToolResult(content=[TextContent(type="text", text=json.dumps(summary, indent=2, default=str))])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}refresh_terminology_snapshot",
+        annotations=ToolAnnotations(
+            title="Refresh Terminology Snapshot",
+            readOnlyHint=False,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def refresh_terminology_snapshot() -> ToolResult:
+        """Reload the local snapshot of DiagnosisTerminologyDim/DiagnosisDim, MedicationCodeDim
+        and ProcedureTerminologyDim used by the concept search tools. Takes a while; call it
+        when concept searches report a missing or stale snapshot or after a terminology
+        update. Searches keep using the previous snapshot until the new one is complete."""
+        if not terminology.enabled:
+            raise ToolError("Terminology snapshots are disabled on this server (set CDW_TERMINOLOGY_DIR).")
+        counts = await executor.run("refresh_terminology_snapshot", terminology.refresh, schema, heavy=True)
+        return ToolResult(content=[TextContent(type="text", text=json.dumps({"rows": counts, **terminology.stats()}, indent=2))])
@@ -0,0 +1,152 @@
+"""Server diagnostics tools — pool, worker, cache statistics and cache control"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Literal, Optional
+
+from pydantic import Field
+from fastmcp.exceptions import ToolError
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+from fastmcp.server import FastMCP
+from fastmcp.tools.tool import ToolResult, TextContent
+from mcp.types import ToolAnnotations
+
+from cdw_medcp.cache import ResultCache
+from cdw_medcp.codesets import CodeSetStore
+from cdw_medcp.cursors import CursorStore
+from cdw_medcp.executor import QueryExecutor
+from cdw_medcp.explain import CostGuard
+from cdw_medcp.metrics import Metrics, timed
+from cdw_medcp.note_cache import NoteCache
+from cdw_medcp.notes_index import NotesIndex
+from cdw_medcp.patients import PatientResolver
+from cdw_medcp.slowlog import SlowQueryLog
+from cdw_medcp.terminology import TerminologySnapshot
+
+logger = logging.getLogger("CDW_MedCP")
+
+
+def register_diagnostics_tools(mcp: FastMCP, namespace_prefix: str, executor: QueryExecutor, cache: ResultCache,
+                               cursors: CursorStore, patients: PatientResolver, notes_index: NotesIndex,
+                               note_cache: NoteCache, terminology: TerminologySnapshot, codesets: CodeSetStore,
+                               guard: CostGuard, metrics: Metrics, slow_log: SlowQueryLog):
+    """Register server diagnostics tools, and the /metrics endpoint when served over HTTP"""
+
+    @mcp.custom_route("/metrics", methods=["GET"], include_in_schema=False)
+    async def prometheus_metrics(request: Request) -> PlainTextResponse:
+        pool = executor.pool.stats()
+        lanes = executor.stats()["lanes"]
+        gauges = {
+            "cdw_pool_connections": {(("state", state),): pool[state] for state in ("open", "idle", "in_use")},
+            "cdw_executor_active": {(("lane", lane),): stats["active"] for lane, stats in lanes.items()},
+            "cdw_executor_queued": {(("lane", lane),): stats["queued"] for lane, stats in lanes.items()},
+            "cdw_cache_bytes": {(): cache.stats()["bytes"]},
+        }
+        return PlainTextResponse(metrics.prometheus(gauges), media_type="text/plain; version=0.0.4")
+
+    @mcp.tool(
+        name=f"{namespace_prefix}server_stats",
+        annotations=ToolAnnotations(
+            title="Server Statistics",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=False,
+            openWorldHint=False
+        )
+    )
+    def server_stats() -> ToolResult:
+        """Report runtime statistics for tuning the server.
+        pool: open/idle/in-use connection counts, connects and reconnects,
+        idle evictions, and checkout wait times (total/avg/max in ms).
+        executor: active/queued/rejected database calls, and per tool the time spent
+        waiting for a worker (queue_ms) separately from execution time (exec_ms).
+        cache: result cache hits/misses/evictions, entry count and bytes used.
+        cursors: paged query results currently held open and how earlier ones were released.
+        patients: cached patient identifier resolutions (hits, lookups, unknown identifiers).
+        notes_index: local note index builds, searches, evictions and disk use.
+        note_cache: cached note hits/misses, compressed bytes used and compression ratio.
+        terminology: concept searches served from the local snapshot vs. the live CDW, and its age.
+        codesets: expanded code sets held in memory and how often handles were inlined into SQL.
+        cost_guard: estimated plans fetched, queries checked and rejected, and the cost limits.
+        metrics: per tool, calls, errors, rows, response bytes and cache hits, with p50/p95/max
+        latency of each phase: total, queue, checkout/connect, db, execute, fetch and render.
+        slow_queries: statements seen and logged as slow, and the log's threshold and disk use."""
+        stats = {
+            "pool": executor.pool.stats(),
+            "executor": executor.stats(),
+            "cache": cache.stats(),
+            "cursors": cursors.stats(),
+            "patients": patients.stats(),
+            "notes_index": notes_index.stats(),
+            "note_cache": note_cache.stats(),
+            "terminology": terminology.stats(),
+            "codesets": codesets.stats(),
+            "cost_guard": guard.stats(),
+            "metrics": metrics.stats(),
+            "slow_queries": slow_log.stats(),
+        }
+        with timed("render"):
+            text = json.dumps(stats, indent=2)
+        return ToolResult(content=[TextContent(type="text", text=text)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}slow_query_report",
+        annotations=ToolAnnotations(
+            title="Slow Query Report",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=False,
+            openWorldHint=False
+        )
+    )
+    async def slow_query_report(
+        top: int = Field(20, ge=1, le=100, description="Number of query shapes to return"),
+        tool: Optional[str] = Field(None, description="Only statements issued by this tool (e.g. query, cohort_summary)"),
+        since_hours: Optional[float] = Field(None, gt=0, description="Only statements logged in the last N hours"),
+        sort_by: Literal["total_ms", "count", "p95_ms", "max_ms"] = Field(
+            "total_ms", description="Rank shapes by total time (CDW load), frequency, p95 or worst-case latency"),
+    ) -> ToolResult:
+        """Rank the query shapes that dominate CDW load, from the slow-query log.
+        Statements slower than the configured threshold are grouped by fingerprint
+        (the SQL with literals replaced by ? and IN lists collapsed), and each shape
+        reports count, total/p50/p95/max milliseconds, share of logged time, average
+        rows, the tools that issued it and an example statement. Use it to decide
+        which queries to cache, precompute or rewrite."""
+        if not slow_log.enabled:
+            raise ToolError("The slow-query log is disabled. Set CDW_SLOW_QUERY_DIR to enable it.")
+        report = await asyncio.to_thread(slow_log.report, top, tool, since_hours, sort_by)
+        return ToolResult(content=[TextContent(type="text", text=json.dumps(report, indent=2))])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}invalidate_cache",
+        annotations=ToolAnnotations(
+            title="Invalidate Result Cache",
+            readOnlyHint=False,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    def invalidate_cache(
+        refreshed_at: Optional[str] = Field(None, description=(
+            "ISO timestamp of the latest CDW refresh (e.g. 2026-03-01T02:00). "
+            "Results cached before it are discarded. Defaults to now (drop everything)."
+        ))
+    ) -> ToolResult:
+        """Invalidate cached tool results after a CDW data refresh.
+        Call this when the warehouse has been reloaded so idempotent tools stop
+        serving results computed from the previous snapshot."""
+        cutoff = None
+        if refreshed_at:
+            try:
+                cutoff = datetime.fromisoformat(refreshed_at).timestamp()
+            except ValueError:
+                raise ToolError(f"Invalid refreshed_at timestamp: {refreshed_at}")
+        dropped = cache.invalidate_all(cutoff)
+        notes = note_cache.invalidate(cutoff)
+        text = f"Invalidated {dropped} cached results and {notes} cached notes."
+        return ToolResult(content=[TextContent(type="text", text=text)])
@@ -1,25 +1,327 @@
-"""Data export tools — CSV extraction"""
+"""Data export tools — streaming extraction to CSV, compressed and columnar files"""
 
-import csv
+import asyncio
+import datetime
+import decimal
+import hashlib
 import logging
+import re
+import time
 from pathlib import Path
+from typing import Optional
 
+import pymssql
 from pydantic import Field
 from fastmcp.exceptions import ToolError
 from fastmcp.server import FastMCP
 from fastmcp.tools.tool import ToolResult, TextContent
 from mcp.types import ToolAnnotations
 
-from cdw_medcp.config import ClinicalDBConfig
-from cdw_medcp.db import get_connection
+from cdw_medcp.cache import normalize_sql
+from cdw_medcp.codesets import CodeSetStore
+from cdw_medcp.executor import QueryExecutor
+from cdw_medcp.explain import CostGuard
+from cdw_medcp.export_writers import (
+    FORMATS, ShardedExportWriter, checkpoint_path, file_sha256, load_checkpoint, output_base, resolve_format,
+    save_checkpoint, write_manifest,
+)
 from cdw_medcp.validation import ClinicalQueryValidator
 
 logger = logging.getLogger("CDW_MedCP")
 
+# Rows fetched from the cursor per round trip; bounds memory per export
+FETCH_BATCH_ROWS = 5000
 
-def register_export_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: ClinicalDBConfig):
+MAX_EXPORT_PARTITIONS = 16
+
+# Checkpointed exports resume from the last completed file, so they are always
+# split into files; this is the file size used when max_file_mb is not set
+DEFAULT_CHECKPOINT_FILE_MB = 256
+
+# Automatic resumes after a dropped connection, and the pause before each
+EXPORT_RETRIES = 2
+EXPORT_RETRY_DELAY_SECONDS = 5
+
+_IDENTIFIER = re.compile(r"^\w+$")
+_TRAILING_ORDER_BY = re.compile(r"\s+ORDER\s+BY\s+[^()']*$", re.IGNORECASE)
+_TOP_OR_CTE = re.compile(r"^\s*(WITH\b|SELECT\s+(DISTINCT\s+)?TOP\b)", re.IGNORECASE)
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def _partitionable_sql(sql: str, mode: str = "partition_column") -> str:
+    """The query as a derived table body: no trailing semicolon or top-level ORDER BY.
+
+    mode names the export parameter that needs the wrapping, for the error message.
+    """
+    if _TOP_OR_CTE.match(sql):
+        kind = "Keyset" if mode == "keyset_column" else "Partitioned"
+        raise ToolError(
+            f"{kind} export wraps the query in a subquery, so it cannot handle TOP queries or CTEs. "
+            f"Rewrite the query without them, or export without {mode}."
+        )
+    sql = sql.strip().rstrip(";").strip()
+    return _TRAILING_ORDER_BY.sub("", sql)
+
+
+def _sql_literal(value) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return f"'{value.isoformat(timespec='milliseconds')}'"
+    if isinstance(value, datetime.date):
+        return f"'{value.isoformat()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _range_boundaries(cursor, inner_sql: str, column: str, partitions: int) -> list:
+    """Inclusive upper bounds that split the column's values into at most `partitions` ranges.
+
+    Bounds are NTILE quantiles over the rows, for every column type, so each
+    range holds about the same number of rows. Equal-width ranges from MIN/MAX
+    put nearly every row in one range for *DateKey columns, whose unknown
+    dates are stored as -1, 0 or 19000101. Repeated values collapse ranges.
+    """
+    cursor.execute(
+        f"SELECT MAX(v) FROM (SELECT q.[{column}] AS v, NTILE({partitions}) OVER (ORDER BY q.[{column}]) AS tile "
+        f"FROM ({inner_sql}) AS q WHERE q.[{column}] IS NOT NULL) t "
+        "GROUP BY tile ORDER BY 1"
+    )
+    bounds = [row[0] for row in cursor.fetchall()]
+    if not bounds:
+        return []
+    # The last tile ends at the column's maximum; anything above it needs no upper bound
+    high = bounds[-1]
+    return sorted(set(b for b in bounds[:-1] if b < high))
+
+
+def _partition_predicates(column: str, bounds: list) -> list[str]:
+    """WHERE clauses covering every row exactly once; NULLs go to the first range"""
+    col = f"q.[{column}]"
+    if not bounds:
+        return ["1 = 1"]
+    literals = [_sql_literal(b) for b in bounds]
+    predicates = [f"({col} <= {literals[0]} OR {col} IS NULL)"]
+    for lower, upper in zip(literals, literals[1:]):
+        predicates.append(f"{col} > {lower} AND {col} <= {upper}")
+    predicates.append(f"{col} > {literals[-1]}")
+    return predicates
+
+
+def _stream_to_writer(cursor, base: Path, fmt: str, max_shard_bytes: int) -> ShardedExportWriter | None:
+    """Write every remaining row of an executed cursor; None if it produced no result set"""
+    if not cursor.description:
+        return None
+    columns = [desc[0] for desc in cursor.description]
+    column_types = [desc[1] for desc in cursor.description]
+
+    writer = ShardedExportWriter(base, fmt, columns, column_types, max_shard_bytes)
+    try:
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_ROWS)
+            if not rows:
+                break
+            writer.write(rows)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer
+
+
+def _resume_predicate(column: str, state: dict) -> str:
+    """WHERE clause selecting the rows after the checkpoint, in keyset order"""
+    if not state["rows_written"]:
+        return ""
+    if state["last_key_sql"] is None:
+        # NULLs sort first, so a NULL checkpoint key means only the NULL rows were written
+        return f" WHERE q.[{column}] IS NOT NULL"
+    return f" WHERE q.[{column}] > {state['last_key_sql']}"
+
+
+def _verify_checkpoint(state: dict, base: Path, query_sha256: str, fmt: str, keyset_column: str) -> None:
+    if state["query_sha256"] != query_sha256:
+        raise ToolError("The checkpoint was written for a different query. Re-run the original query, or start over with resume=false.")
+    if state["format"] != fmt or state["keyset_column"] != keyset_column:
+        raise ToolError(
+            f"The checkpoint was written with format={state['format']} and keyset_column={state['keyset_column']}; "
+            "resume with the same options."
+        )
+    for shard in state["shards"]:
+        path = base.with_name(shard["file"])
+        if not path.exists() or file_sha256(path) != shard["sha256"]:
+            raise ToolError(f"{path} is missing or changed since the checkpoint; start over with resume=false.")
+
+
+def _stream_checkpointed(cursor, writer: ShardedExportWriter, key_index: int, checkpoint) -> None:
+    """Write rows fetched in keyset order, ending files only between distinct keys.
+
+    A file is closed (and checkpoint(last_key) called) only right after a row
+    whose key differs from the next one, so resuming with key > last_key
+    neither skips nor repeats rows even when keys are not unique.
+    """
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH_ROWS)
+        if not rows:
+            break
+        # Rows sharing the batch's last key may continue into the next batch
+        last = rows[-1][key_index]
+        split = len(rows)
+        while split and rows[split - 1][key_index] == last:
+            split -= 1
+        if split:
+            writer.write(rows[:split])
+            if writer.shard_full:
+                writer.rotate()
+                checkpoint(rows[split - 1][key_index])
+        writer.write(rows[split:])
+    writer.close()
+
+
+def register_export_tools(mcp: FastMCP, namespace_prefix: str, executor: QueryExecutor, codesets: CodeSetStore,
+                          guard: CostGuard):
     """Register data export tools"""
 
+    async def _partitioned_export(sql_query: str, base: Path, fmt: str, max_shard_bytes: int,
+                                  partition_column: str, partitions: int) -> tuple[list[dict], list[dict]]:
+        """Run range-restricted copies of the query concurrently, one connection each.
+
+        Returns (partition reports, shards across all partitions in range order).
+        """
+        inner_sql = _partitionable_sql(sql_query)
+
+        def _discover(conn) -> list:
+            cursor = conn.cursor()
+            bounds = _range_boundaries(cursor, inner_sql, partition_column, partitions)
+            cursor.close()
+            return bounds
+
+        try:
+            bounds = await executor.run("export_query_to_csv", _discover, heavy=True)
+        except ToolError:
+            raise
+        except Exception as e:
+            raise ToolError(f"Could not determine ranges for partition column '{partition_column}': {e}")
+        predicates = _partition_predicates(partition_column, bounds)
+
+        def _export_partition(conn, number: int, predicate: str) -> dict:
+            started = time.perf_counter()
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT * FROM ({inner_sql}) AS q WHERE {predicate}")
+            part_base = base.with_name(f"{base.name}-p{number:02d}")
+            writer = _stream_to_writer(cursor, part_base, fmt, max_shard_bytes)
+            cursor.close()
+            return {
+                "partition": number,
+                "predicate": predicate.replace("q.", ""),
+                "rows": writer.rows if writer else 0,
+                "elapsed_ms": _elapsed_ms(started),
+                "columns": writer.columns if writer else [],
+                "shards": writer.shards if writer else [],
+            }
+
+        results = await asyncio.gather(
+            *(executor.run("export_query_to_csv", _export_partition, number, predicate, heavy=True)
+              for number, predicate in enumerate(predicates, start=1)),
+            return_exceptions=True,
+        )
+        failures = [f"partition {n}: {r}" for n, r in enumerate(results, start=1) if isinstance(r, BaseException)]
+        if failures:
+            raise ToolError("Partitioned export failed; completed partitions were left on disk. " + "; ".join(failures))
+
+        shards = []
+        for report in results:
+            for shard in report.pop("shards"):
+                shards.append({"partition": report["partition"], **shard})
+        return results, shards
+
+    async def _checkpointed_export(sql_query: str, base: Path, fmt: str, max_shard_bytes: int,
+                                   keyset_column: str, resume: bool) -> tuple[ShardedExportWriter | None, int, int]:
+        """Export in keyset order, checkpointing after every completed file.
+
+        Returns (writer, expected row count, number of automatic resumes).
+        """
+        inner_sql = _partitionable_sql(sql_query, "keyset_column")
+        query_sha256 = hashlib.sha256(normalize_sql(sql_query).encode("utf-8")).hexdigest()
+
+        if resume:
+            state = load_checkpoint(base)
+            if state is None:
+                raise ToolError(f"No checkpoint found at {checkpoint_path(base)}")
+            _verify_checkpoint(state, base, query_sha256, fmt, keyset_column)
+            logger.info(f"Resuming export to {base} after {state['rows_written']} rows")
+        else:
+            state = {
+                "query_sha256": query_sha256,
+                "format": fmt,
+                "keyset_column": keyset_column,
+                "max_shard_bytes": max_shard_bytes or DEFAULT_CHECKPOINT_FILE_MB * 1024 * 1024,
+                "rows_written": 0,
+                "last_key": None,
+                "last_key_sql": None,
+                "shards": [],
+            }
+
+        def _export(conn, state: dict):
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT * FROM ({inner_sql}) AS q{_resume_predicate(keyset_column, state)} "
+                f"ORDER BY q.[{keyset_column}]"
+            )
+            if not cursor.description:
+                return None, 0
+            columns = [desc[0] for desc in cursor.description]
+            matches = [i for i, c in enumerate(columns) if c.lower() == keyset_column.lower()]
+            if not matches:
+                raise ToolError(f"keyset_column '{keyset_column}' is not a column of the query result")
+
+            writer = ShardedExportWriter(
+                base, fmt, columns, [desc[1] for desc in cursor.description], state["max_shard_bytes"],
+                shards=state["shards"], auto_rotate=False,
+            )
+            writer.discard_unrecorded()
+
+            def checkpoint(last_key) -> None:
+                state.update(
+                    rows_written=writer.rows,
+                    last_key=None if last_key is None else str(last_key),
+                    last_key_sql=None if last_key is None else _sql_literal(last_key),
+                    shards=list(writer.shards),
+                    updated_at=datetime.datetime.now().isoformat(timespec="seconds"),
+                )
+                save_checkpoint(base, state)
+
+            if not state["rows_written"]:
+                checkpoint(None)
+            try:
+                _stream_checkpointed(cursor, writer, matches[0], checkpoint)
+            except Exception:
+                writer.abort()
+                raise
+
+            # Integrity check: every row of the query is in exactly one file
+            cursor.execute(f"SELECT COUNT_BIG(*) FROM ({inner_sql}) AS q")
+            expected = cursor.fetchone()[0]
+            cursor.close()
+            return writer, expected
+
+        for attempt in range(EXPORT_RETRIES + 1):
+            try:
+                writer, expected = await executor.run("export_query_to_csv", _export, state, heavy=True)
+                return writer, expected, attempt
+            except (pymssql.OperationalError, pymssql.InterfaceError) as e:
+                if attempt == EXPORT_RETRIES:
+                    raise ToolError(
+                        f"Export interrupted after {state['rows_written']} checkpointed rows: {e}. "
+                        "Re-run with resume=true to continue from the checkpoint."
+                    )
+                logger.warning(f"Export to {base} interrupted ({e}); resuming from row {state['rows_written']}")
+                await asyncio.sleep(EXPORT_RETRY_DELAY_SECONDS)
+
     @mcp.tool(
         name=f"{namespace_prefix}export_query_to_csv",
         annotations=ToolAnnotations(
@@ -30,44 +332,132 @@ def register_export_tools(mcp: FastMCP, namespace_prefix: str, clinical_config:
             openWorldHint=False
         )
     )
-    def export_query_to_csv(
+    async def export_query_to_csv(
         sql_query: str = Field(..., description="Read-only SQL SELECT query to export"),
-        filepath: str = Field(..., description="Full file path where the CSV should be saved (e.g., /Users/me/exports/results.csv)")
+        filepath: str = Field(..., description="Full file path where the export should be saved (e.g., /Users/me/exports/results.csv)"),
+        format: str = Field("csv", description="Output format: csv, csv.gz, ndjson, ndjson.gz or parquet (parquet needs pyarrow; falls back to ndjson.gz)"),
+        max_file_mb: int = Field(0, description="Start a new numbered file whenever the current one reaches this size in MB (0 = single file)"),
+        partition_column: Optional[str] = Field(None, description="Output column to split the export on (e.g. PatientDurableKey or a *DateKey); ranges are exported in parallel on separate connections"),
+        partitions: int = Field(4, description=f"Number of value ranges for a partitioned export (1-{MAX_EXPORT_PARTITIONS})"),
+        keyset_column: Optional[str] = Field(None, description="Output column to order by and checkpoint on (e.g. PatientDurableKey); makes the export resumable"),
+        resume: bool = Field(False, description="Continue an interrupted keyset_column export from its checkpoint instead of starting over")
     ) -> ToolResult:
-        """Execute a read-only SQL query and save results to a CSV file at the specified path.
-        The directory must already exist. Returns the number of rows exported and the file path."""
+        """Execute a read-only SQL query and stream the results to a file at the specified path.
+        The directory must already exist. The file extension is set from the format
+        (e.g. results.csv becomes results.csv.gz for format=csv.gz). With max_file_mb set,
+        output is split into numbered files (results-00001.csv.gz, ...). A manifest
+        (<name>.manifest.json) lists every file with its row count and SHA-256 checksum.
+
+        For large extracts, set partition_column to a column in the query's output.
+        The value range of that column is split into `partitions` ranges, which are
+        exported concurrently into per-partition files (results-p01.csv, results-p02.csv, ...).
+        The manifest lists them in range order, so concatenating them in that order
+        merges the export. Partitioned exports cannot use TOP or CTEs, and a trailing
+        ORDER BY is dropped.
+
+        For long extracts that must survive dropped connections, set keyset_column.
+        Rows are exported in that column's order into files of max_file_mb
+        (default 256 MB), and progress is checkpointed to <name>.checkpoint.json after
+        each completed file. A dropped connection is resumed automatically a few times;
+        after that, call again with the same query and resume=true. The final row count
+        is verified against COUNT_BIG(*) of the query. Like partitioned exports, keyset
+        exports cannot use TOP or CTEs, and a trailing ORDER BY is dropped.
+        Code-set handles ({{codeset:<handle>}} from expand_code_set) are inlined as key lists.
+        Queries whose estimated plan exceeds the server's cost limits are rejected before
+        anything is written (see explain_query).
+        Returns the number of rows exported and the files written."""
+        sql_query = codesets.expand_sql(sql_query)
         if not ClinicalQueryValidator.is_read_only_clinical_query(sql_query):
             raise ToolError("Only SELECT queries are allowed for export.")
+        if format not in FORMATS:
+            raise ToolError(f"Unknown format '{format}'. Choose one of: {', '.join(FORMATS)}")
+        if max_file_mb < 0:
+            raise ToolError("max_file_mb must be 0 or a positive number of megabytes")
+        if partition_column is not None and not _IDENTIFIER.match(partition_column):
+            raise ToolError(f"Invalid partition column name: '{partition_column}'")
+        if not 1 <= partitions <= MAX_EXPORT_PARTITIONS:
+            raise ToolError(f"partitions must be between 1 and {MAX_EXPORT_PARTITIONS}")
+        if keyset_column is not None and not _IDENTIFIER.match(keyset_column):
+            raise ToolError(f"Invalid keyset column name: '{keyset_column}'")
+        if keyset_column and partition_column:
+            raise ToolError("Use either partition_column or keyset_column, not both.")
+        if resume and not keyset_column:
+            raise ToolError("resume requires the keyset_column the export was started with.")
 
         output_path = Path(filepath)
         if not output_path.parent.exists():
             raise ToolError(f"Directory does not exist: {output_path.parent}")
+        if guard.enabled:
+            await executor.run("export_query_to_csv", guard.check, sql_query, heavy=True)
+        base = output_base(output_path)
+        written_format = resolve_format(format)
+        max_shard_bytes = max_file_mb * 1024 * 1024
+        extra = {"requested_format": format} if written_format != format else {}
 
-        conn = get_connection(clinical_config)
-        try:
-            cursor = conn.cursor()
-            cursor.execute(sql_query)
-            columns = [desc[0] for desc in cursor.description] if cursor.description else []
-
+        if keyset_column:
+            writer, expected, retries = await _checkpointed_export(
+                sql_query, base, written_format, max_shard_bytes, keyset_column, resume
+            )
+            if writer is None:
+                return ToolResult(content=[TextContent(type="text", text="Query returned no results. No file created.")])
+            verified = writer.rows == expected
+            manifest_path = writer.write_manifest(
+                keyset_column=keyset_column, expected_rows=expected, row_count_verified=verified, **extra
+            )
+            if verified:
+                checkpoint_path(base).unlink(missing_ok=True)
+            lines = [f"Exported {writer.rows} rows to {len(writer.shards)} files in {base.parent}, ordered by {keyset_column}"]
+            if retries:
+                lines.append(f"Resumed automatically {retries} time(s) after dropped connections")
+            if verified:
+                lines.append(f"Row count verified against COUNT_BIG(*): {expected}")
+            else:
+                lines.append(
+                    f"WARNING: wrote {writer.rows} rows but the query now counts {expected}. "
+                    f"The data may have changed during the export; the checkpoint was kept at {checkpoint_path(base)}."
+                )
+        elif partition_column:
+            started = time.perf_counter()
+            reports, shards = await _partitioned_export(
+                sql_query, base, written_format, max_shard_bytes, partition_column, partitions
+            )
+            columns = next((r["columns"] for r in reports if r["columns"]), [])
+            for report in reports:
+                del report["columns"]
             if not columns:
                 return ToolResult(content=[TextContent(type="text", text="Query returned no results. No file created.")])
+            manifest_path = write_manifest(
+                base, written_format, columns, shards,
+                partition_column=partition_column, partitions=reports, **extra
+            )
+            total = sum(r["rows"] for r in reports)
+            lines = [
+                f"Exported {total} rows in {len(reports)} partitions on {partition_column} "
+                f"({len(shards)} files in {base.parent}, {_elapsed_ms(started)} ms)"
+            ]
+            for r in reports:
+                lines.append(f"  p{r['partition']:02d} {r['predicate']}: {r['rows']} rows, {r['elapsed_ms']} ms")
+        else:
+            def _export(conn) -> ShardedExportWriter | None:
+                cursor = conn.cursor()
+                cursor.execute(sql_query)
+                writer = _stream_to_writer(cursor, base, written_format, max_shard_bytes)
+                cursor.close()
+                return writer
 
-            row_count = 0
-            with open(output_path, "w", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(columns)
-                while True:
-                    rows = cursor.fetchmany(5000)
-                    if not rows:
-                        break
-                    writer.writerows(rows)
-                    row_count += len(rows)
+            writer = await executor.run("export_query_to_csv", _export, heavy=True)
+            if writer is None:
+                return ToolResult(content=[TextContent(type="text", text="Query returned no results. No file created.")])
 
-            cursor.close()
-        finally:
-            conn.close()
+            manifest_path = writer.write_manifest(**extra)
+            directory = base.parent
+            if len(writer.shards) == 1:
+                lines = [f"Exported {writer.rows} rows to {directory / writer.shards[0]['file']}"]
+            else:
+                lines = [f"Exported {writer.rows} rows to {len(writer.shards)} files in {directory}: "
+                         f"{writer.shards[0]['file']} ... {writer.shards[-1]['file']}"]
 
-        return ToolResult(content=[TextContent(
-            type="text",
-            text=f"Exported {row_count} rows to {output_path}"
-        )])
+        lines.append(f"Manifest: {manifest_path}")
+        if written_format != format:
+            lines.append(f"Note: pyarrow is not installed, so {written_format} was written instead of {format}.")
+        return ToolResult(content=[TextContent(type="text", text="\n".join(lines))])
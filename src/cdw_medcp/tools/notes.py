@@ -1,5 +1,6 @@
 """Clinical notes search and retrieval tools"""
 
+import asyncio
 import logging
 
 from pydantic import Field
@@ -8,36 +9,125 @@ from fastmcp.server import FastMCP
 from fastmcp.tools.tool import ToolResult, TextContent
 from mcp.types import ToolAnnotations
 
-from cdw_medcp.config import ClinicalDBConfig
-from cdw_medcp.db import get_connection
+from cdw_medcp.executor import QueryExecutor
+from cdw_medcp.metrics import statement, timed
+from cdw_medcp.note_cache import NOTE_COLUMNS, NoteCache
+from cdw_medcp.notes_index import RESULT_COLUMNS, NotesIndex
+from cdw_medcp.patients import quote_literal
+from cdw_medcp.rendering import MAX_RESPONSE_BYTES, BoundedCSV, cursor_to_csv
 from cdw_medcp.validation import ClinicalQueryValidator
 
 logger = logging.getLogger("CDW_MedCP")
 
+# search_notes: keywords per call and the allowed snippet window (characters)
+MAX_SEARCH_KEYWORDS = 5
+MIN_SNIPPET_CHARS = 50
+MAX_SNIPPET_CHARS = 2000
 
-def _query_to_csv(config: ClinicalDBConfig, sql: str) -> str:
+# get_notes: keys per call, keys per IN list, and the default per-note text cap
+MAX_NOTES_PER_CALL = 100
+NOTE_FETCH_CHUNK = 50
+DEFAULT_MAX_NOTE_CHARS = 20_000
+# Allowance for a row's metadata columns when sharing the response budget among notes
+_NOTE_ROW_OVERHEAD = 300
+_NOTE_SELECT = ", ".join([f"nm.{c}" for c in NOTE_COLUMNS[:-1]] + ["nt.note_text"])
+
+
+def _query_to_csv(conn, sql: str) -> str:
     """Execute validated query and return CSV"""
     if not ClinicalQueryValidator.is_read_only_clinical_query(sql):
         raise ToolError("Only SELECT queries are allowed.")
-    conn = get_connection(config)
-    try:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        columns = [desc[0] for desc in cursor.description] if cursor.description else []
-        rows = cursor.fetchall()
-        cursor.close()
-    finally:
-        conn.close()
-    if not columns:
+    cursor = conn.cursor()
+    with statement(sql):
+        with timed("execute"):
+            cursor.execute(sql)
+        result = cursor_to_csv(cursor)
+    cursor.close()
+    if result is None:
         return "No results found."
-    csv_lines = [",".join(columns)]
-    csv_lines.extend([",".join(str(v) if v is not None else "" for v in row) for row in rows])
-    return "\n".join(csv_lines)
+    return result
+
+
+def _search_notes_sql(schema: str, durable_key: str, keywords: list[str], match_all: bool,
+                      snippet_chars: int, row_limit: int) -> str:
+    """Keyword search returning, per note, hit counts and a snippet centered on each keyword's first match.
+
+    CHARINDEX positions are computed once per note in a CROSS APPLY and reused
+    for filtering and for the snippets, so only the windows around the hits
+    leave the server. Matching is literal (no LIKE wildcards) and follows the
+    column collation, as LIKE did.
+    """
+    half = snippet_chars // 2
+    multi = len(keywords) > 1
+    positions, hit_counts, columns = [], [], []
+    for i, keyword in enumerate(keywords):
+        literal = quote_literal(keyword)
+        positions.append(f"CHARINDEX({literal}, nt.note_text) AS p{i}")
+        hits = f"(LEN(nt.note_text) - LEN(REPLACE(nt.note_text, {literal}, ''))) / LEN({literal})"
+        window_start = f"CASE WHEN pos.p{i} > {half} THEN pos.p{i} - {half} ELSE 1 END"
+        snippet = f"CASE WHEN pos.p{i} > 0 THEN SUBSTRING(nt.note_text, {window_start}, {snippet_chars}) END"
+        label = keyword.replace("]", "]]")
+        hit_counts.append(hits)
+        columns += [f"{hits} AS [{label} hits]", f"{snippet} AS [{label} snippet]"] if multi else \
+                   [f"{hits} AS hits", f"{snippet} AS snippet"]
+    if multi:
+        columns.insert(0, f"{' + '.join(hit_counts)} AS hits")
+    matched = f" {'AND' if match_all else 'OR'} ".join(f"pos.p{i} > 0" for i in range(len(keywords)))
+    return (
+        f"SELECT TOP {row_limit} nm.deid_note_key, nm.note_type, nm.encounter_type, "
+        f"nm.enc_dept_specialty, nm.deid_service_date, {', '.join(columns)} "
+        f"FROM {schema}.note_metadata nm "
+        f"JOIN {schema}.note_text nt ON nm.deid_note_key = nt.deid_note_key "
+        f"CROSS APPLY (SELECT {', '.join(positions)}) AS pos "
+        f"WHERE nm.PatientDurableKey = {quote_literal(durable_key)} AND ({matched}) "
+        f"ORDER BY nm.deid_service_date DESC"
+    )
+
+
+def _fetch_notes(conn, schema: str, note_keys: list[str]) -> dict[str, list]:
+    """Note rows (NOTE_COLUMNS order) for note_keys, in IN-list chunks on one connection.
+
+    Keys are inlined as varchar literals: str parameters go out as nvarchar and
+    would turn the key lookup on note_metadata into a scan.
+    """
+    found = {}
+    cursor = conn.cursor()
+    for i in range(0, len(note_keys), NOTE_FETCH_CHUNK):
+        chunk = note_keys[i:i + NOTE_FETCH_CHUNK]
+        cursor.execute(
+            f"SELECT {_NOTE_SELECT} "
+            f"FROM {schema}.note_metadata nm "
+            f"JOIN {schema}.note_text nt ON nm.deid_note_key = nt.deid_note_key "
+            f"WHERE nm.deid_note_key IN ({', '.join(quote_literal(key) for key in chunk)})"
+        )
+        for row in cursor.fetchall():
+            found[str(row[0])] = list(row)
+    cursor.close()
+    return found
 
 
-def register_notes_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: ClinicalDBConfig, schema: str = "deid_uf"):
+def _clip_note(row: list, max_chars: int) -> list:
+    """Row with note_text cut to max_chars and a marker saying how much was dropped"""
+    text = row[-1] or ""
+    if len(text) <= max_chars:
+        return row
+    return row[:-1] + [text[:max_chars] + f" ...[truncated: {max_chars} of {len(text)} characters]"]
+
+
+def register_notes_tools(mcp: FastMCP, namespace_prefix: str, executor: QueryExecutor, note_cache: NoteCache,
+                         notes_index: NotesIndex, schema: str = "deid_uf"):
     """Register clinical notes tools"""
 
+    async def _notes(tool: str, note_keys: list[str]) -> dict[str, list]:
+        """Note rows for note_keys from the note cache, fetching only the misses from the CDW"""
+        found = await asyncio.to_thread(note_cache.get_many, note_keys)
+        missing = [k for k in note_keys if k not in found]
+        if missing:
+            fetched = await executor.run(tool, _fetch_notes, schema, missing)
+            await asyncio.to_thread(note_cache.put_many, fetched)
+            found.update(fetched)
+        return found
+
     @mcp.tool(
         name=f"{namespace_prefix}search_notes",
         annotations=ToolAnnotations(
@@ -48,30 +138,80 @@ def register_notes_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def search_notes(
+    async def search_notes(
         patient_durable_key: str = Field(..., description="The PatientDurableKey to search notes for"),
-        keyword: str = Field(..., description="Keyword or phrase to search for in note text"),
-        row_limit: int = Field(50, description="Maximum notes to return (default 50)")
+        keyword: str | list[str] = Field(..., description="Keyword or phrase to search for in note text, or a list of up to 5"),
+        row_limit: int = Field(50, description="Maximum notes to return (default 50)"),
+        match_all: bool = Field(False, description="With several keywords, only return notes containing all of them (default: any)"),
+        snippet_chars: int = Field(300, description="Characters of context returned around each keyword's first match (50-2000)")
     ) -> ToolResult:
-        """Search clinical notes for a patient by keyword. Returns matching note metadata
-        and text snippets. Use get_note() to retrieve the full text of a specific note.
+        """Search clinical notes for a patient by keyword. Returns matching note metadata,
+        per-note hit counts, and a snippet centered on the first match of each keyword,
+        so the match can usually be read without fetching the note. Use get_note() to
+        retrieve the full text of a specific note.
+
+        Pass several keywords as a list to search for any of them (or all, with
+        match_all=true) in one call; each keyword gets its own hits and snippet columns
+        and a total hits column is added. Matching is a literal, case-insensitive substring.
 
         IMPORTANT: Notes use PatientDurableKey (not PatientKey). To find a patient's
         PatientDurableKey, query PatientDim first: SELECT PatientDurableKey FROM deid_uf.PatientDim
         WHERE PatientKey = '...' AND IsCurrent = 1."""
-        sql = (
-            f"SELECT TOP {row_limit} nm.deid_note_key, nm.note_type, nm.encounter_type, "
-            f"nm.enc_dept_specialty, nm.deid_service_date, "
-            f"SUBSTRING(nt.note_text, 1, 500) AS note_snippet "
-            f"FROM {schema}.note_metadata nm "
-            f"JOIN {schema}.note_text nt ON nm.deid_note_key = nt.deid_note_key "
-            f"WHERE nm.PatientDurableKey = '{patient_durable_key}' "
-            f"AND nt.note_text LIKE '%{keyword}%' "
-            f"ORDER BY nm.deid_service_date DESC"
-        )
-        result = _query_to_csv(clinical_config, sql)
+        keywords = list(dict.fromkeys(k.strip() for k in ([keyword] if isinstance(keyword, str) else keyword) if k.strip()))
+        if not keywords:
+            raise ToolError("keyword must not be empty")
+        if len(keywords) > MAX_SEARCH_KEYWORDS:
+            raise ToolError(f"At most {MAX_SEARCH_KEYWORDS} keywords per search")
+        if not MIN_SNIPPET_CHARS <= snippet_chars <= MAX_SNIPPET_CHARS:
+            raise ToolError(f"snippet_chars must be between {MIN_SNIPPET_CHARS} and {MAX_SNIPPET_CHARS}")
+        sql = _search_notes_sql(schema, patient_durable_key.strip(), keywords, match_all, snippet_chars, row_limit)
+        result = await executor.run("search_notes", _query_to_csv, sql, heavy=True)
         return ToolResult(content=[TextContent(type="text", text=result)])
 
+    @mcp.tool(
+        name=f"{namespace_prefix}search_notes_indexed",
+        annotations=ToolAnnotations(
+            title="Ranked Search of a Patient's Notes",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def search_notes_indexed(
+        patient_durable_key: str = Field(..., description="The PatientDurableKey to search notes for"),
+        query: str = Field(..., description='Search terms, e.g. sepsis "blood culture" NOT negative'),
+        row_limit: int = Field(20, description="Maximum notes to return, best match first (default 20)")
+    ) -> ToolResult:
+        """Ranked full-text search of one patient's notes from a local index.
+        The first call for a patient pulls all of their notes once (this can take a while);
+        later searches for the same patient return in milliseconds, so try as many
+        queries as needed.
+
+        Query syntax: several words match notes containing all of them; "double quotes"
+        match an exact phrase; combine with AND, OR, NOT and parentheses; word* matches
+        a prefix. Words are stemmed (infection matches infections). Results are ranked
+        by BM25 relevance (higher score is better) with a snippet marking hits in [brackets].
+        Use get_note() for the full text."""
+        if not notes_index.enabled:
+            raise ToolError("Indexed note search is disabled on this server (set CDW_NOTES_INDEX_DIR). Use search_notes.")
+        if row_limit < 1:
+            raise ToolError("row_limit must be at least 1")
+        key = patient_durable_key.strip()
+        if not notes_index.is_fresh(key):
+            await executor.run("search_notes_indexed", notes_index.build, schema, key, heavy=True)
+        rows = await asyncio.to_thread(notes_index.search, key, query, row_limit)
+        if not rows:
+            return ToolResult(content=[TextContent(type="text", text="No results found.")])
+        builder = BoundedCSV(RESULT_COLUMNS)
+        for row in rows:
+            if not builder.add(row):
+                break
+        text = builder.text()
+        if builder.rows < len(rows):
+            text += f"\n[truncated: response budget reached after {builder.rows} notes; lower row_limit]"
+        return ToolResult(content=[TextContent(type="text", text=text)])
+
     @mcp.tool(
         name=f"{namespace_prefix}get_note",
         annotations=ToolAnnotations(
@@ -82,16 +222,68 @@ def register_notes_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def get_note(
+    async def get_note(
         note_key: str = Field(..., description="The deid_note_key to retrieve")
     ) -> ToolResult:
         """Retrieve the full text of a specific clinical note by its deid_note_key."""
-        sql = (
-            f"SELECT nm.deid_note_key, nm.note_type, nm.encounter_type, "
-            f"nm.enc_dept_specialty, nm.deid_service_date, nt.note_text "
-            f"FROM {schema}.note_metadata nm "
-            f"JOIN {schema}.note_text nt ON nm.deid_note_key = nt.deid_note_key "
-            f"WHERE nm.deid_note_key = '{note_key}'"
+        key = note_key.strip()
+        row = (await _notes("get_note", [key])).get(key)
+        if row is None:
+            return ToolResult(content=[TextContent(type="text", text="No results found.")])
+        builder = BoundedCSV(NOTE_COLUMNS)
+        builder.add(row)
+        text = builder.text()
+        if builder.clipped_columns:
+            text += f"\n[truncated: note_text clipped to fit the {MAX_RESPONSE_BYTES // 1024} KB response budget]"
+        return ToolResult(content=[TextContent(type="text", text=text)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}get_notes",
+        annotations=ToolAnnotations(
+            title="Get Clinical Notes",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
         )
-        result = _query_to_csv(clinical_config, sql)
-        return ToolResult(content=[TextContent(type="text", text=result)])
+    )
+    async def get_notes(
+        note_keys: list[str] = Field(..., description=f"deid_note_keys to retrieve (up to {MAX_NOTES_PER_CALL})"),
+        max_chars_per_note: int = Field(DEFAULT_MAX_NOTE_CHARS, description="Longest note text returned per note; longer notes are truncated (default 20000)")
+    ) -> ToolResult:
+        """Retrieve the text of several clinical notes in one call, in the order given.
+        Use this instead of calling get_note repeatedly, e.g. to summarize the notes
+        found by search_notes.
+
+        The response is capped at the server's response budget, shared evenly between
+        the notes: each note_text is cut to the smaller of max_chars_per_note and its
+        share, with a marker giving the full length (also in the note_chars column).
+        Fetch a truncated note alone with get_note to read all of it. Notes already
+        retrieved are served from a local cache without querying the CDW."""
+        keys = list(dict.fromkeys(k.strip() for k in note_keys if k and k.strip()))
+        if not keys:
+            raise ToolError("note_keys must contain at least one deid_note_key")
+        if len(keys) > MAX_NOTES_PER_CALL:
+            raise ToolError(f"At most {MAX_NOTES_PER_CALL} notes per call; got {len(keys)}. Split the list.")
+        if max_chars_per_note < 1:
+            raise ToolError("max_chars_per_note must be at least 1")
+        found = await _notes("get_notes", keys)
+
+        present = [k for k in keys if k in found]
+        share = max(MAX_RESPONSE_BYTES // max(len(present), 1) - _NOTE_ROW_OVERHEAD, 1)
+        limit = min(max_chars_per_note, share)
+        builder = BoundedCSV(NOTE_COLUMNS[:-1] + ["note_chars", "note_text"])
+        shown = 0
+        for key in present:
+            row = found[key]
+            if not builder.add(row[:-1] + [len(row[-1] or "")] + _clip_note(row, limit)[-1:]):
+                break
+            shown += 1
+        text = builder.text() if present else "No results found."
+        not_found = [k for k in keys if k not in found]
+        if not_found:
+            text += f"\n[not found: {', '.join(not_found)}]"
+        if shown < len(present):
+            text += (f"\n[truncated: response budget reached after {shown} notes; "
+                     f"request the remaining {len(present) - shown} separately or lower max_chars_per_note]")
+        return ToolResult(content=[TextContent(type="text", text=text)])
@@ -1,6 +1,12 @@
 """SQL execution and canned clinical query tools"""
 
+import asyncio
+import datetime
+import heapq
+import itertools
+import json
 import logging
+from typing import Optional
 
 from pydantic import Field
 from fastmcp.exceptions import ToolError
@@ -8,41 +14,270 @@ from fastmcp.server import FastMCP
 from fastmcp.tools.tool import ToolResult, TextContent
 from mcp.types import ToolAnnotations
 
-from cdw_medcp.config import ClinicalDBConfig
-from cdw_medcp.db import get_connection
+from cdw_medcp.cache import ResultCache
+from cdw_medcp.codesets import CodeSetStore
+from cdw_medcp.cursors import CursorStore
+from cdw_medcp.executor import QueryExecutor
+from cdw_medcp.explain import CostGuard
+from cdw_medcp.metrics import count, statement, timed
+from cdw_medcp.patients import PatientResolver, quote_literal
+from cdw_medcp.rendering import MAX_RESPONSE_BYTES, BoundedCSV, cursor_to_csv
+from cdw_medcp.rewriter import rewrite_query
 from cdw_medcp.validation import ClinicalQueryValidator
 
 logger = logging.getLogger("CDW_MedCP")
 
 DEFAULT_ROW_LIMIT = 1000
 
+# Batch patient tools: patients per IN list, chunks in flight at once, and limits
+BATCH_CHUNK_SIZE = 100
+BATCH_CONCURRENCY = 4
+MAX_BATCH_PATIENTS = 1000
+DEFAULT_ROWS_PER_PATIENT = 100
+MAX_ROWS_PER_PATIENT = 1000
 
-def _execute_readonly_query(config: ClinicalDBConfig, sql: str, row_limit: int = DEFAULT_ROW_LIMIT) -> str:
+# get_patient_timeline sources: event type -> (table, YYYYMMDD date column, key column,
+# description columns, detail columns). note_metadata has a datetime instead of a
+# date key, so its date is derived and its window is applied to deid_service_date.
+_TIMELINE_SOURCES = {
+    "encounter": ("EncounterFact", "DateKey", "EncounterKey",
+                  ("Type", "DepartmentName"), ("PatientClass", "PrimaryDiagnosisName")),
+    "medication": ("MedicationOrderFact", "OrderedDateKey", "MedicationOrderKey",
+                   ("MedicationName",), ("MedicationRoute", "Frequency")),
+    "diagnosis": ("DiagnosisEventFact", "StartDateKey", "DiagnosisEventKey",
+                  ("DiagnosisName",), ("Type", "Status")),
+    "lab": ("LabComponentResultFact", "ResultDateKey", "LabComponentResultKey",
+            ("ComponentName",), ("Value", "Unit", "Flag")),
+    "note": ("note_metadata", None, "deid_note_key",
+             ("note_type",), ("encounter_type", "enc_dept_specialty")),
+}
+_NOTE_DATE_KEY = "CONVERT(INT, CONVERT(CHAR(8), deid_service_date, 112))"
+
+
+def _execute_readonly_query(conn, sql: str, row_limit: int = DEFAULT_ROW_LIMIT) -> str:
     """Execute a validated read-only query and return CSV-formatted results"""
     if not ClinicalQueryValidator.is_read_only_clinical_query(sql):
         raise ToolError("Only SELECT queries are allowed. Write operations are blocked for security.")
 
-    conn = get_connection(config)
+    cursor = conn.cursor()
+    with statement(sql):
+        with timed("execute"):
+            cursor.execute(sql)
+        result = cursor_to_csv(cursor, max_rows=row_limit)
+    cursor.close()
+
+    if result is None:
+        return "Query executed successfully (no results returned)"
+    return result
+
+
+def _batch_sql(schema: str, table: str, order_column: str, patient_ids: list[str], rows_per_patient: int) -> str:
+    """Query for up to rows_per_patient most recent rows of each patient.
+
+    The keys are inlined as varchar literals: pymssql sends str parameters as
+    nvarchar, and comparing those with the varchar PatientDurableKey converts
+    the indexed column and turns the seek into a scan.
+    """
+    placeholders = ", ".join(quote_literal(p) for p in patient_ids)
+    return (f"SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY PatientDurableKey "
+            f"ORDER BY {order_column} DESC) AS PatientRowNumber "
+            f"FROM {schema}.{table} WHERE PatientDurableKey IN ({placeholders})) AS ranked "
+            f"WHERE PatientRowNumber <= {rows_per_patient} ORDER BY PatientDurableKey, PatientRowNumber")
+
+
+def _fetch_batch_chunk(conn, sql: str) -> tuple[list[str], dict[str, list]]:
+    """Run one batch chunk and group its rows by PatientDurableKey (row number column dropped)"""
+    cursor = conn.cursor()
+    grouped: dict[str, list] = {}
+    with statement(sql):
+        with timed("execute"):
+            cursor.execute(sql)
+        columns = [desc[0] for desc in cursor.description][:-1]
+        key_index = columns.index("PatientDurableKey")
+        with timed("fetch"):
+            while True:
+                rows = cursor.fetchmany(BATCH_CHUNK_SIZE * 10)
+                if not rows:
+                    break
+                count("rows", len(rows))
+                for row in rows:
+                    grouped.setdefault(str(row[key_index]), []).append(row[:-1])
+    cursor.close()
+    return columns, grouped
+
+
+def _render_batch(patient_ids: list[str], columns: list[str], grouped: dict[str, list], rows_per_patient: int) -> str:
+    """CSV grouped by patient in request order, with a summary and truncation trailer"""
+    builder = BoundedCSV(columns)
+    stopped_at = None
+    for index, patient_id in enumerate(patient_ids):
+        if not all(builder.add(row) for row in grouped.get(patient_id, ())):
+            stopped_at = index
+            break
+    with_rows = sum(1 for p in patient_ids if grouped.get(p))
+    capped = sum(1 for p in patient_ids if len(grouped.get(p, ())) >= rows_per_patient)
+    summary = f"[{len(patient_ids)} patients requested, {with_rows} with rows"
+    if capped:
+        summary += f", {capped} capped at {rows_per_patient} rows"
+    text = builder.text() + "\n\n" + summary + "]"
+    if stopped_at is not None:
+        remaining = len(patient_ids) - stopped_at
+        text += (f"\n[truncated: response budget of {MAX_RESPONSE_BYTES // 1024} KB reached at patient "
+                 f"{patient_ids[stopped_at]}; call again with the remaining {remaining} patients starting there, "
+                 f"or lower rows_per_patient]")
+    return text
+
+
+def _parse_date_key(value: Optional[str], name: str) -> Optional[int]:
+    """YYYYMMDD integer for a YYYY-MM-DD or YYYYMMDD date string"""
+    if not value:
+        return None
     try:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        columns = [desc[0] for desc in cursor.description] if cursor.description else []
-        rows = cursor.fetchmany(row_limit)
-        cursor.close()
-    finally:
-        conn.close()
-
-    if not columns:
+        return int(datetime.datetime.strptime(value.replace("-", ""), "%Y%m%d").strftime("%Y%m%d"))
+    except ValueError:
+        raise ToolError(f"Invalid {name} {value!r}; use YYYY-MM-DD")
+
+
+def _format_date_key(date_key: int) -> str:
+    return f"{date_key // 10000:04d}-{date_key // 100 % 100:02d}-{date_key % 100:02d}" if date_key else ""
+
+
+def _timeline_sql(schema: str, event_type: str, durable: str, start: Optional[int], end: Optional[int],
+                  row_limit: int) -> str:
+    """Most recent row_limit events of one type in the window, as (date key, key, columns...)"""
+    table, date_column, key_column, description, detail = _TIMELINE_SOURCES[event_type]
+    conditions = [f"PatientDurableKey = {durable}"]
+    if date_column is None:
+        date_expr, order_column = _NOTE_DATE_KEY, "deid_service_date"
+        if start:
+            conditions.append(f"deid_service_date >= '{start}'")
+        if end:
+            conditions.append(f"deid_service_date < DATEADD(DAY, 1, '{end}')")
+    else:
+        date_expr = order_column = date_column
+        conditions.append(f"{date_column} > 19000101")
+        if start:
+            conditions.append(f"{date_column} >= {start}")
+        if end:
+            conditions.append(f"{date_column} <= {end}")
+    columns = ", ".join((f"{date_expr} AS EventDateKey", key_column) + description + detail)
+    return (f"SELECT TOP {row_limit} {columns} FROM {schema}.{table} "
+            f"WHERE {' AND '.join(conditions)} ORDER BY {order_column} DESC")
+
+
+def _fetch_timeline_events(conn, sql: str, event_type: str) -> list[tuple]:
+    """Run one timeline source and compact its rows into (date key, type, description, detail, key)"""
+    n_description = len(_TIMELINE_SOURCES[event_type][3])
+    cursor = conn.cursor()
+    with statement(sql):
+        with timed("execute"):
+            cursor.execute(sql)
+        with timed("fetch"):
+            rows = cursor.fetchall()
+        count("rows", len(rows))
+    events = []
+    for row in rows:
+        date_key, key, values = row[0] or 0, row[1], row[2:]
+        description = " - ".join(str(v) for v in values[:n_description] if v not in (None, ""))
+        detail = "; ".join(str(v) for v in values[n_description:] if v not in (None, ""))
+        events.append((date_key, event_type, description, detail, key))
+    cursor.close()
+    return events
+
+
+def _render_timeline(sources: list[list[tuple]], row_limit: int) -> str:
+    """Merge per-source newest-first event lists and render the newest row_limit in date order"""
+    merged = heapq.merge(*sources, key=lambda event: event[0], reverse=True)
+    newest = list(itertools.islice(merged, row_limit + 1))
+    more = len(newest) > row_limit or any(len(events) >= row_limit for events in sources)
+    builder = BoundedCSV(["date", "type", "description", "detail", "key"])
+    shown = newest[:row_limit][::-1]
+    for index, (date_key, event_type, description, detail, key) in enumerate(shown):
+        if not builder.add((_format_date_key(date_key), event_type, description, detail, key)):
+            shown = shown[:index]
+            more = True
+            break
+    text = builder.text()
+    if more:
+        since = f" (from {_format_date_key(shown[0][0])})" if shown and shown[0][0] else ""
+        text += (f"\n[truncated: showing the {len(shown)} most recent events{since}; "
+                 f"set end_date or event_types to see earlier ones]")
+    return text
+
+
+def _render_page(page: dict) -> str:
+    """CSV for one page of a held result, followed by a line saying how to get the next one"""
+    if page["text"] is None:
         return "Query executed successfully (no results returned)"
+    first, count = page["first_row"], page["rows"]
+    span = f"rows {first}-{first + count - 1}" if count else "no rows"
+    if page["byte_limited"]:
+        span += f" (page cut short at the {MAX_RESPONSE_BYTES // 1024} KB response budget)"
+    if page["clipped_columns"]:
+        span += f" ({', '.join(page['clipped_columns'])} clipped to fit the response budget)"
+    if page["next_token"]:
+        trailer = f"[{span}; more rows available: call fetch_next_page with page_token={page['next_token']}]"
+    else:
+        trailer = f"[{span}; end of results]"
+    return page["text"] + "\n\n" + trailer
+
 
-    csv_lines = [",".join(columns)]
-    csv_lines.extend([",".join(str(v) if v is not None else "" for v in row) for row in rows])
-    return "\n".join(csv_lines)
+def _rewrite_trailer(notes: list[str], sql: str) -> str:
+    return (f"\n\n[rewritten: {'; '.join(notes)}. Pass rewrite=false to run the query as written.]\n"
+            f"{sql.strip()}")
 
 
-def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: ClinicalDBConfig, schema: str = "deid_uf"):
+def register_query_tools(mcp: FastMCP, namespace_prefix: str, executor: QueryExecutor, cache: ResultCache,
+                         cursors: CursorStore, patients: PatientResolver, codesets: CodeSetStore, guard: CostGuard,
+                         schema: str = "deid_uf"):
     """Register SQL execution and canned query tools"""
 
+    def _guarded_query(conn, sql: str, row_limit: int) -> str:
+        """Check the estimated plan against the cost limits on the same connection, then run the query"""
+        if not ClinicalQueryValidator.is_read_only_clinical_query(sql):
+            raise ToolError("Only SELECT queries are allowed. Write operations are blocked for security.")
+        guard.check(conn, sql)
+        return _execute_readonly_query(conn, sql, row_limit)
+
+    async def _durable_key(patient_id: str) -> str:
+        """Quoted PatientDurableKey literal for any patient identifier, resolved once per identifier"""
+        durable = patients.cached(patient_id)
+        if durable is None:
+            durable = await executor.run("resolve_patient", patients.resolve, patient_id)
+        if durable is None:
+            raise ToolError(f"No patient found with PatientDurableKey or PatientKey {patient_id!r}")
+        return quote_literal(durable)
+
+    async def _batch_query(tool: str, table: str, order_column: str, patient_ids: list[str],
+                           rows_per_patient: int) -> str:
+        """Fetch a fact table for many patients in concurrent IN-list chunks, grouped by patient"""
+        ids = list(dict.fromkeys(p.strip() for p in patient_ids if p and p.strip()))
+        if not ids:
+            raise ToolError("patient_ids must contain at least one PatientDurableKey")
+        if len(ids) > MAX_BATCH_PATIENTS:
+            raise ToolError(f"At most {MAX_BATCH_PATIENTS} patients per call; got {len(ids)}. Split the list.")
+        if not 1 <= rows_per_patient <= MAX_ROWS_PER_PATIENT:
+            raise ToolError(f"rows_per_patient must be between 1 and {MAX_ROWS_PER_PATIENT}")
+
+        gate = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def run_chunk(chunk: list[str]):
+            sql = _batch_sql(schema, table, order_column, chunk, rows_per_patient)
+            async with gate:
+                return await executor.run(tool, _fetch_batch_chunk, sql, heavy=True)
+
+        chunks = [ids[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(ids), BATCH_CHUNK_SIZE)]
+        results = await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+        columns = results[0][0]
+        grouped = {patient: rows for _, chunk_rows in results for patient, rows in chunk_rows.items()}
+        with timed("render"):
+            return _render_batch(ids, columns, grouped, rows_per_patient)
+
+    async def _cached_query(tool: str, sql: str, row_limit: int = DEFAULT_ROW_LIMIT, heavy: bool = False) -> str:
+        return await cache.fetch(tool, sql, row_limit, lambda: executor.run(
+            tool, _execute_readonly_query, sql, row_limit, heavy=heavy
+        ))
+
     @mcp.tool(
         name=f"{namespace_prefix}query",
         annotations=ToolAnnotations(
@@ -53,15 +288,35 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def query(
+    async def query(
         sql_query: str = Field(..., description="Read-only SQL SELECT query"),
-        row_limit: int = Field(DEFAULT_ROW_LIMIT, description="Maximum rows to return (default 1000)")
+        row_limit: int = Field(DEFAULT_ROW_LIMIT, description="Maximum rows to return (default 1000); the page size when paginate is true"),
+        paginate: bool = Field(False, description="Keep the result open on the server and return a page_token for fetch_next_page when more than row_limit rows exist"),
+        rewrite: bool = Field(True, description="Rewrite known slow patterns (PatientDim joins, CTE joins, TOP N DISTINCT, converted date keys, missing TOP) before running")
     ) -> ToolResult:
         """Execute a READ-ONLY SQL query on the Clinical Data Warehouse.
         Only SELECT, WITH, and DECLARE statements are allowed. SQL comments (--) are supported.
         Results are returned as CSV. Use get_database_overview and describe_table first
         to understand the schema before writing queries.
 
+        REWRITES: unless rewrite=false, the patterns below that time out are rewritten
+        before the query runs, and the response ends with the SQL that was executed:
+        a JOIN to PatientDim (with IsCurrent = 1) or to a CTE of patient keys that only
+        filters a fact table becomes WHERE PatientDurableKey IN (subquery);
+        TOP N DISTINCT becomes DISTINCT TOP N; CONVERT(DATE, CAST(xDateKey ...)) compared
+        with a date becomes an integer comparison on xDateKey; an outermost SELECT
+        without TOP gets TOP row_limit+1.
+
+        COST LIMITS: the server may reject a query whose estimated plan is too expensive,
+        before it runs, with hints on what to filter. Use explain_query to check a
+        query's estimated cost first.
+
+        PAGING: rows beyond row_limit are normally discarded. With paginate=true the query
+        runs once, the first row_limit rows are returned, and the rest stay on the server;
+        the response ends with a page_token to pass to fetch_next_page. Open results are
+        released after their last page, after a couple of idle minutes, or via
+        fetch_next_page(close=true). Do not re-run the query with a larger row_limit.
+
         IMPORTANT — COLUMN NAMES:
         - PatientDim: PatientKey, PatientDurableKey, Sex, BirthDate, DeathDate, FirstRace, Ethnicity,
           PreferredLanguage, MaritalStatus, SmokingStatus, IsCurrent, Status, StartDate
@@ -93,11 +348,93 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
         - Use SELECT DISTINCT TOP N (not SELECT TOP N DISTINCT)
         - CTE + JOIN patterns also timeout — use subqueries instead
         - Multi-fact queries (e.g., diagnosis + medication): use a 2-step approach.
-          First query concept tools to get key values, then use hardcoded IN (...) lists
-          instead of nested subqueries across multiple fact tables.
+          First get a code-set handle from expand_code_set, then filter with
+          DiagnosisKey IN ({{codeset:<handle>}}) instead of nested subqueries across
+          multiple fact tables; the server inlines the keys.
         - note_metadata/note_text use PatientDurableKey (not PatientKey)"""
-        result = _execute_readonly_query(clinical_config, sql_query, row_limit)
-        return ToolResult(content=[TextContent(type="text", text=result)])
+        notes = []
+        if rewrite:
+            sql_query, notes = rewrite_query(sql_query, None if paginate else row_limit)
+        trailer = _rewrite_trailer(notes, sql_query) if notes else ""
+        sql_query = codesets.expand_sql(sql_query)
+        if paginate:
+            if not ClinicalQueryValidator.is_read_only_clinical_query(sql_query):
+                raise ToolError("Only SELECT queries are allowed. Write operations are blocked for security.")
+            if not cursors.enabled:
+                raise ToolError("Paged results are disabled on this server (CDW_MAX_OPEN_CURSORS=0).")
+            if row_limit < 1:
+                raise ToolError("row_limit must be at least 1 when paginate is true")
+            if guard.enabled:
+                await executor.run("query", guard.check, sql_query, heavy=True)
+            page = await executor.run("query", cursors.open, sql_query, row_limit, heavy=True, checkout=False)
+            return ToolResult(content=[TextContent(type="text", text=_render_page(page) + trailer)])
+        result = await cache.fetch("query", sql_query, row_limit, lambda: executor.run(
+            "query", _guarded_query, sql_query, row_limit, heavy=True
+        ))
+        return ToolResult(content=[TextContent(type="text", text=result + trailer)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}explain_query",
+        annotations=ToolAnnotations(
+            title="Explain Query",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def explain_query(
+        sql_query: str = Field(..., description="Read-only SQL SELECT query to estimate (it is compiled, not run)"),
+        rewrite: bool = Field(True, description="Apply the same rewrites as query before estimating")
+    ) -> ToolResult:
+        """Estimate what a query will cost before running it, from SQL Server's estimated plan.
+        Returns the estimated cost (summed over all statements) and the row count of the
+        most expensive statement, the largest scans (table, index and rows
+        read), the number of index seeks, plan warnings such as implicit conversions or
+        missing join predicates, indexes SQL Server reports as missing, and hints for
+        narrowing the query. violations lists the server's cost limits the query would
+        exceed; query, cohort_summary and export_query_to_csv reject such queries.
+        Use it for any query over large fact tables without a PatientDurableKey filter."""
+        notes = []
+        if rewrite:
+            sql_query, notes = rewrite_query(sql_query)
+        shown = sql_query
+        sql_query = codesets.expand_sql(sql_query)
+        if not ClinicalQueryValidator.is_read_only_clinical_query(sql_query):
+            raise ToolError("Only SELECT queries are allowed. Write operations are blocked for security.")
+        summary = await executor.run("explain_query", guard.explain, sql_query, heavy=True)
+        if notes:
+            summary["rewrites"] = notes
+            summary["rewritten_sql"] = shown.strip()
+        return ToolResult(content=[TextContent(type="text", text=json.dumps(summary, indent=2))])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}fetch_next_page",
+        annotations=ToolAnnotations(
+            title="Fetch Next Page",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=False,
+            openWorldHint=False
+        )
+    )
+    async def fetch_next_page(
+        page_token: str = Field(..., description="page_token from the end of the previous query or fetch_next_page response"),
+        page_size: int = Field(DEFAULT_ROW_LIMIT, description="Rows to return (default 1000)"),
+        close: bool = Field(False, description="Release the open result instead of fetching (use when no more rows are needed)")
+    ) -> ToolResult:
+        """Fetch the next page of a query run with paginate=true, continuing where the last
+        page ended without re-running the query. Results are returned as CSV, followed by
+        the next page_token or an end-of-results marker. Calling again with the same token
+        returns the same page."""
+        if close:
+            released = await executor.run("fetch_next_page", cursors.close, page_token, checkout=False)
+            text = "Result released." if released else "Result was already released."
+            return ToolResult(content=[TextContent(type="text", text=text)])
+        if page_size < 1:
+            raise ToolError("page_size must be at least 1")
+        page = await executor.run("fetch_next_page", cursors.fetch, page_token, page_size, heavy=True, checkout=False)
+        return ToolResult(content=[TextContent(type="text", text=_render_page(page))])
 
     @mcp.tool(
         name=f"{namespace_prefix}get_patient_demographics",
@@ -109,7 +446,7 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def get_patient_demographics(
+    async def get_patient_demographics(
         patient_id: str = Field(..., description="PatientDurableKey (preferred, stable) or PatientKey (SCD surrogate). Use PatientDurableKey when available.")
     ) -> ToolResult:
         """Retrieve demographic information for a patient from PatientDim.
@@ -120,14 +457,59 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
 
         Key columns: PatientKey, PatientDurableKey, Sex, BirthDate, DeathDate,
         FirstRace, Ethnicity, PreferredLanguage, MaritalStatus, SmokingStatus, IsCurrent, Status."""
-        # Auto-detect: if it looks like a PatientDurableKey (appears in both PatientKey and PatientDurableKey),
-        # query by PatientDurableKey for reliable matching
+        durable = await _durable_key(patient_id)
         sql = (
             f"SELECT TOP 1 * FROM {schema}.PatientDim "
-            f"WHERE (PatientDurableKey = '{patient_id}' OR PatientKey = '{patient_id}') "
+            f"WHERE PatientDurableKey = {durable} "
             f"ORDER BY CASE WHEN IsCurrent = 1 THEN 0 ELSE 1 END, StartDate DESC"
         )
-        result = _execute_readonly_query(clinical_config, sql)
+        result = await _cached_query("get_patient_demographics", sql)
+        return ToolResult(content=[TextContent(type="text", text=result)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}get_patient_timeline",
+        annotations=ToolAnnotations(
+            title="Get Patient Timeline",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def get_patient_timeline(
+        patient_id: str = Field(..., description="PatientDurableKey (preferred) or PatientKey"),
+        start_date: Optional[str] = Field(None, description="Earliest event date, YYYY-MM-DD (inclusive)"),
+        end_date: Optional[str] = Field(None, description="Latest event date, YYYY-MM-DD (inclusive)"),
+        event_types: Optional[list[str]] = Field(None, description="Subset of encounter, medication, diagnosis, lab, note (default all)"),
+        row_limit: int = Field(500, description="Maximum events to return (the most recent in the window)")
+    ) -> ToolResult:
+        """Retrieve one chronological timeline of a patient's encounters, medication orders,
+        diagnoses, lab results and notes. Use this instead of calling get_encounters,
+        get_medications, get_diagnoses and get_labs separately to get a clinical picture.
+
+        Returns compact CSV (date, type, description, detail, key), oldest first. Each row
+        carries the source key (EncounterKey, MedicationOrderKey, DiagnosisEventKey,
+        LabComponentResultKey or deid_note_key) for follow-up queries or get_note.
+        When more events exist than row_limit, the most recent ones are kept; set
+        start_date/end_date to page back through earlier history."""
+        types = event_types or list(_TIMELINE_SOURCES)
+        unknown = [t for t in types if t not in _TIMELINE_SOURCES]
+        if unknown:
+            raise ToolError(f"Unknown event_types {unknown}; choose from {', '.join(_TIMELINE_SOURCES)}")
+        if row_limit < 1:
+            raise ToolError("row_limit must be at least 1")
+        start = _parse_date_key(start_date, "start_date")
+        end = _parse_date_key(end_date, "end_date")
+        durable = await _durable_key(patient_id)
+
+        # One query per source, each on its own pooled connection, all in flight at once
+        sources = await asyncio.gather(*(
+            executor.run("get_patient_timeline", _fetch_timeline_events,
+                         _timeline_sql(schema, t, durable, start, end, row_limit), t, heavy=True)
+            for t in dict.fromkeys(types)
+        ))
+        with timed("render"):
+            result = _render_timeline(sources, row_limit)
         return ToolResult(content=[TextContent(type="text", text=result)])
 
     @mcp.tool(
@@ -140,7 +522,7 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def get_encounters(
+    async def get_encounters(
         patient_id: str = Field(..., description="PatientDurableKey (preferred) or PatientKey"),
         row_limit: int = Field(DEFAULT_ROW_LIMIT, description="Maximum rows to return")
     ) -> ToolResult:
@@ -149,10 +531,11 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
         IMPORTANT: Use PatientDurableKey (stable) rather than PatientKey (SCD surrogate).
         Key columns: EncounterKey, PatientKey, PatientDurableKey, DateKey, Type (not EncounterType),
         DepartmentName, DepartmentSpecialty, PatientClass, VisitType."""
+        durable = await _durable_key(patient_id)
         sql = (f"SELECT TOP {row_limit} * FROM {schema}.EncounterFact "
-               f"WHERE PatientDurableKey = '{patient_id}' OR PatientKey = '{patient_id}' "
+               f"WHERE PatientDurableKey = {durable} "
                f"ORDER BY DateKey DESC")
-        result = _execute_readonly_query(clinical_config, sql, row_limit)
+        result = await _cached_query("get_encounters", sql, row_limit)
         return ToolResult(content=[TextContent(type="text", text=result)])
 
     @mcp.tool(
@@ -165,7 +548,7 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def get_medications(
+    async def get_medications(
         patient_id: str = Field(..., description="PatientDurableKey (preferred) or PatientKey"),
         row_limit: int = Field(DEFAULT_ROW_LIMIT, description="Maximum rows to return")
     ) -> ToolResult:
@@ -174,10 +557,11 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
         IMPORTANT: Use PatientDurableKey (stable) rather than PatientKey (SCD surrogate).
         Treatment duration: use StartDateKey/EndDateKey span, not just OrderedDateKey.
         Filter invalid dates: WHERE DateKey > 19000101."""
+        durable = await _durable_key(patient_id)
         sql = (f"SELECT TOP {row_limit} * FROM {schema}.MedicationOrderFact "
-               f"WHERE PatientDurableKey = '{patient_id}' OR PatientKey = '{patient_id}' "
+               f"WHERE PatientDurableKey = {durable} "
                f"ORDER BY OrderedDateKey DESC")
-        result = _execute_readonly_query(clinical_config, sql, row_limit)
+        result = await _cached_query("get_medications", sql, row_limit)
         return ToolResult(content=[TextContent(type="text", text=result)])
 
     @mcp.tool(
@@ -190,17 +574,18 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def get_diagnoses(
+    async def get_diagnoses(
         patient_id: str = Field(..., description="PatientDurableKey (preferred) or PatientKey"),
         row_limit: int = Field(DEFAULT_ROW_LIMIT, description="Maximum rows to return")
     ) -> ToolResult:
         """Retrieve diagnosis history for a patient from DiagnosisEventFact.
 
         IMPORTANT: Use PatientDurableKey (stable) rather than PatientKey (SCD surrogate)."""
+        durable = await _durable_key(patient_id)
         sql = (f"SELECT TOP {row_limit} * FROM {schema}.DiagnosisEventFact "
-               f"WHERE PatientDurableKey = '{patient_id}' OR PatientKey = '{patient_id}' "
+               f"WHERE PatientDurableKey = {durable} "
                f"ORDER BY StartDateKey DESC")
-        result = _execute_readonly_query(clinical_config, sql, row_limit)
+        result = await _cached_query("get_diagnoses", sql, row_limit)
         return ToolResult(content=[TextContent(type="text", text=result)])
 
     @mcp.tool(
@@ -213,7 +598,7 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def get_labs(
+    async def get_labs(
         patient_id: str = Field(..., description="PatientDurableKey (preferred) or PatientKey"),
         row_limit: int = Field(DEFAULT_ROW_LIMIT, description="Maximum rows to return")
     ) -> ToolResult:
@@ -222,8 +607,105 @@ def register_query_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
         IMPORTANT: Use PatientDurableKey (stable) rather than PatientKey (SCD surrogate).
         Key columns: Value (string result — use this, not NumericValue which is DEID'd),
         ReferenceValues (combined string), Flag, Abnormal, ResultDateKey (YYYYMMDD int)."""
+        durable = await _durable_key(patient_id)
         sql = (f"SELECT TOP {row_limit} * FROM {schema}.LabComponentResultFact "
-               f"WHERE PatientDurableKey = '{patient_id}' OR PatientKey = '{patient_id}' "
+               f"WHERE PatientDurableKey = {durable} "
                f"ORDER BY ResultDateKey DESC")
-        result = _execute_readonly_query(clinical_config, sql, row_limit)
+        result = await _cached_query("get_labs", sql, row_limit)
+        return ToolResult(content=[TextContent(type="text", text=result)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}get_encounters_batch",
+        annotations=ToolAnnotations(
+            title="Get Encounters for Many Patients",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def get_encounters_batch(
+        patient_ids: list[str] = Field(..., description=f"PatientDurableKeys (up to {MAX_BATCH_PATIENTS})"),
+        rows_per_patient: int = Field(DEFAULT_ROWS_PER_PATIENT, description="Most recent rows to return per patient (default 100)")
+    ) -> ToolResult:
+        """Retrieve encounter history for many patients at once from EncounterFact.
+        Use this instead of calling get_encounters once per patient when reviewing a cohort.
+        Rows are returned as one CSV grouped by patient in the order given, most recent
+        first (DateKey DESC), at most rows_per_patient per patient. A summary line
+        reports how many patients had rows and how many hit the per-patient cap.
+
+        IMPORTANT: patient_ids must be PatientDurableKeys (not PatientKeys)."""
+        result = await _batch_query("get_encounters_batch", "EncounterFact", "DateKey", patient_ids, rows_per_patient)
+        return ToolResult(content=[TextContent(type="text", text=result)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}get_medications_batch",
+        annotations=ToolAnnotations(
+            title="Get Medications for Many Patients",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def get_medications_batch(
+        patient_ids: list[str] = Field(..., description=f"PatientDurableKeys (up to {MAX_BATCH_PATIENTS})"),
+        rows_per_patient: int = Field(DEFAULT_ROWS_PER_PATIENT, description="Most recent rows to return per patient (default 100)")
+    ) -> ToolResult:
+        """Retrieve medication orders for many patients at once from MedicationOrderFact.
+        Use this instead of calling get_medications once per patient when reviewing a cohort.
+        Rows are returned as one CSV grouped by patient in the order given, most recent
+        first (OrderedDateKey DESC), at most rows_per_patient per patient. A summary line
+        reports how many patients had rows and how many hit the per-patient cap.
+
+        IMPORTANT: patient_ids must be PatientDurableKeys (not PatientKeys)."""
+        result = await _batch_query("get_medications_batch", "MedicationOrderFact", "OrderedDateKey", patient_ids, rows_per_patient)
+        return ToolResult(content=[TextContent(type="text", text=result)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}get_diagnoses_batch",
+        annotations=ToolAnnotations(
+            title="Get Diagnoses for Many Patients",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def get_diagnoses_batch(
+        patient_ids: list[str] = Field(..., description=f"PatientDurableKeys (up to {MAX_BATCH_PATIENTS})"),
+        rows_per_patient: int = Field(DEFAULT_ROWS_PER_PATIENT, description="Most recent rows to return per patient (default 100)")
+    ) -> ToolResult:
+        """Retrieve diagnosis history for many patients at once from DiagnosisEventFact.
+        Use this instead of calling get_diagnoses once per patient when reviewing a cohort.
+        Rows are returned as one CSV grouped by patient in the order given, most recent
+        first (StartDateKey DESC), at most rows_per_patient per patient. A summary line
+        reports how many patients had rows and how many hit the per-patient cap.
+
+        IMPORTANT: patient_ids must be PatientDurableKeys (not PatientKeys)."""
+        result = await _batch_query("get_diagnoses_batch", "DiagnosisEventFact", "StartDateKey", patient_ids, rows_per_patient)
+        return ToolResult(content=[TextContent(type="text", text=result)])
+
+    @mcp.tool(
+        name=f"{namespace_prefix}get_labs_batch",
+        annotations=ToolAnnotations(
+            title="Get Labs for Many Patients",
+            readOnlyHint=True,
+            destructiveHint=False,
+            idempotentHint=True,
+            openWorldHint=False
+        )
+    )
+    async def get_labs_batch(
+        patient_ids: list[str] = Field(..., description=f"PatientDurableKeys (up to {MAX_BATCH_PATIENTS})"),
+        rows_per_patient: int = Field(DEFAULT_ROWS_PER_PATIENT, description="Most recent rows to return per patient (default 100)")
+    ) -> ToolResult:
+        """Retrieve lab component results for many patients at once from LabComponentResultFact.
+        Use this instead of calling get_labs once per patient when reviewing a cohort.
+        Rows are returned as one CSV grouped by patient in the order given, most recent
+        first (ResultDateKey DESC), at most rows_per_patient per patient. A summary line
+        reports how many patients had rows and how many hit the per-patient cap.
+
+        IMPORTANT: patient_ids must be PatientDurableKeys (not PatientKeys)."""
+        result = await _batch_query("get_labs_batch", "LabComponentResultFact", "ResultDateKey", patient_ids, rows_per_patient)
         return ToolResult(content=[TextContent(type="text", text=result)])
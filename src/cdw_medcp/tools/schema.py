@@ -2,28 +2,108 @@
 
 import json
 import logging
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
+from pydantic import Field
 from fastmcp.exceptions import ToolError
 from fastmcp.server import FastMCP
 from fastmcp.tools.tool import ToolResult, TextContent
 from mcp.types import ToolAnnotations
 
-logger = logging.getLogger("CDW_MedCP")
-
-_SCHEMA_REF_PATH = Path(__file__).parent.parent.parent.parent / "data" / "schema_reference.json"
-_schema_ref: Optional[dict] = None
+from cdw_medcp.schema_index import SchemaIndex
+from cdw_medcp.schema_store import SchemaStore
 
+logger = logging.getLogger("CDW_MedCP")
 
-def _get_schema_ref() -> dict:
-    global _schema_ref
-    if _schema_ref is None:
-        if not _SCHEMA_REF_PATH.exists():
-            raise ToolError(f"Schema reference not found at {_SCHEMA_REF_PATH}")
-        with open(_SCHEMA_REF_PATH) as f:
-            _schema_ref = json.load(f)
-    return _schema_ref
+_SCHEMA_STORE_PATH = Path(__file__).parent.parent.parent.parent / "data" / "schema_reference.cdw"
+_schema_store: Optional[SchemaStore] = None
+_schema_index: Optional[SchemaIndex] = None
+_overview_text: Optional[str] = None
+
+# Matching columns listed per table in search_schema results
+MAX_COLUMNS_PER_TABLE = 10
+
+# Data quality notes for specific tables, surfaced in describe_table
+TABLE_NOTES = {
+    "PatientDim": (
+        "SCD Type 2 table: multiple historical rows per patient. "
+        "Use IsCurrent=1 for current record, or ORDER BY StartDate DESC for most recent. "
+        "Some patients may not have IsCurrent=1; always fall back to MAX(StartDate)."
+    ),
+    "LabComponentResultFact": (
+        "NumericValue is de-identified (contains 'DEID'). Use the Value column (string) "
+        "for actual numeric results. ReferenceValues is a combined string (e.g., 'Low: 10 High: 61'). "
+        "Use Flag and Abnormal columns for abnormality indicators. "
+        "There is no TextValue, ReferenceLow, ReferenceHigh, or AbnormalFlag column."
+    ),
+    "LabComponentDim": (
+        "The LOINC code column is named LoincCode (not Loinc)."
+    ),
+    "MedicationDim": (
+        "Pre-Epic legacy records show *Unspecified for GenericName, TherapeuticClass, "
+        "Strength, Form. Only Name (e.g., 'COPAXONE') is reliable for those records."
+    ),
+}
+
+
+def _get_schema_store() -> SchemaStore:
+    global _schema_store
+    if _schema_store is None:
+        if not _SCHEMA_STORE_PATH.exists():
+            raise ToolError(f"Schema reference not found at {_SCHEMA_STORE_PATH}")
+        _schema_store = SchemaStore(_SCHEMA_STORE_PATH)
+    return _schema_store
+
+
+def _get_schema_index() -> SchemaIndex:
+    global _schema_index
+    if _schema_index is None:
+        _schema_index = SchemaIndex.build(_get_schema_store().load_all())
+    return _schema_index
+
+
+def _render_overview() -> str:
+    """get_database_overview response, rendered once from the store's table of contents"""
+    global _overview_text
+    if _overview_text is None:
+        overview = []
+        for summary in _get_schema_store().summaries():
+            entry = {
+                "table_name": summary["name"],
+                "description": summary.get("description", ""),
+                "has_patient_data": summary.get("has_patient_data", False),
+                "has_encounter_data": summary.get("has_encounter_data", False),
+                "column_count": summary["column_count"],
+            }
+            pk = summary.get("patient_key_column")
+            if pk:
+                entry["patient_key_column"] = pk
+            ek = summary.get("encounter_key_column")
+            if ek:
+                entry["encounter_key_column"] = ek
+            overview.append(entry)
+        _overview_text = json.dumps(overview, indent=2)
+    return _overview_text
+
+
+@lru_cache(maxsize=None)
+def _render_table(table_name: str) -> str:
+    """describe_table response for one table, decoded and rendered on first request"""
+    info = _get_schema_store().table(table_name)
+    result = {
+        "table_name": table_name,
+        "description": info.get("description", ""),
+        "has_patient_data": info.get("has_patient_data", False),
+        "patient_key_column": info.get("patient_key_column"),
+        "encounter_key_column": info.get("encounter_key_column"),
+        "columns": info.get("columns", []),
+    }
+    # Add data quality notes if available
+    if table_name in TABLE_NOTES:
+        result["data_notes"] = TABLE_NOTES[table_name]
+    return json.dumps(result, indent=2)
 
 
 def register_schema_tools(mcp: FastMCP, namespace_prefix: str):
@@ -43,46 +123,7 @@ def register_schema_tools(mcp: FastMCP, namespace_prefix: str):
         """Get an overview of all tables in the Clinical Data Warehouse with their descriptions.
         Returns table names, descriptions, and whether they contain patient/encounter data.
         Call this first to understand what data is available."""
-        schema = _get_schema_ref()
-        overview = []
-        for name, info in schema.items():
-            entry = {
-                "table_name": name,
-                "description": info.get("description", ""),
-                "has_patient_data": info.get("has_patient_data", False),
-                "has_encounter_data": info.get("has_encounter_data", False),
-                "column_count": len(info.get("columns", [])),
-            }
-            pk = info.get("patient_key_column")
-            if pk:
-                entry["patient_key_column"] = pk
-            ek = info.get("encounter_key_column")
-            if ek:
-                entry["encounter_key_column"] = ek
-            overview.append(entry)
-        return ToolResult(content=[TextContent(type="text", text=json.dumps(overview, indent=2))])
-
-    # Data quality notes for specific tables, surfaced in describe_table
-    TABLE_NOTES = {
-        "PatientDim": (
-            "SCD Type 2 table: multiple historical rows per patient. "
-            "Use IsCurrent=1 for current record, or ORDER BY StartDate DESC for most recent. "
-            "Some patients may not have IsCurrent=1; always fall back to MAX(StartDate)."
-        ),
-        "LabComponentResultFact": (
-            "NumericValue is de-identified (contains 'DEID'). Use the Value column (string) "
-            "for actual numeric results. ReferenceValues is a combined string (e.g., 'Low: 10 High: 61'). "
-            "Use Flag and Abnormal columns for abnormality indicators. "
-            "There is no TextValue, ReferenceLow, ReferenceHigh, or AbnormalFlag column."
-        ),
-        "LabComponentDim": (
-            "The LOINC code column is named LoincCode (not Loinc)."
-        ),
-        "MedicationDim": (
-            "Pre-Epic legacy records show *Unspecified for GenericName, TherapeuticClass, "
-            "Strength, Form. Only Name (e.g., 'COPAXONE') is reliable for those records."
-        ),
-    }
+        return ToolResult(content=[TextContent(type="text", text=_render_overview())])
 
     @mcp.tool(
         name=f"{namespace_prefix}describe_table",
@@ -99,26 +140,10 @@ def register_schema_tools(mcp: FastMCP, namespace_prefix: str):
         data types, descriptions, and foreign key relationships (lookup tables).
         Columns marked queryable=false may not exist in the SQL view — use the
         corresponding base column instead (e.g., DateKey instead of DateKeyValue)."""
-        schema = _get_schema_ref()
-        if table_name not in schema:
-            matches = [k for k in schema if k.lower() == table_name.lower()]
-            if matches:
-                table_name = matches[0]
-            else:
-                raise ToolError(f"Table '{table_name}' not found. Use get_database_overview to see available tables.")
-        info = schema[table_name]
-        result = {
-            "table_name": table_name,
-            "description": info.get("description", ""),
-            "has_patient_data": info.get("has_patient_data", False),
-            "patient_key_column": info.get("patient_key_column"),
-            "encounter_key_column": info.get("encounter_key_column"),
-            "columns": info.get("columns", []),
-        }
-        # Add data quality notes if available
-        if table_name in TABLE_NOTES:
-            result["data_notes"] = TABLE_NOTES[table_name]
-        return ToolResult(content=[TextContent(type="text", text=json.dumps(result, indent=2))])
+        resolved = _get_schema_store().resolve(table_name)
+        if resolved is None:
+            raise ToolError(f"Table '{table_name}' not found. Use get_database_overview to see available tables.")
+        return ToolResult(content=[TextContent(type="text", text=_render_table(resolved))])
 
     @mcp.tool(
         name=f"{namespace_prefix}search_schema",
@@ -130,39 +155,49 @@ def register_schema_tools(mcp: FastMCP, namespace_prefix: str):
             openWorldHint=False
         )
     )
-    def search_schema(keyword: str) -> ToolResult:
-        """Search table and column names and descriptions for a keyword.
+    def search_schema(
+        keyword: str = Field(..., description="One or more search terms; tables must match all of them (e.g. 'allergy', 'lab loinc')"),
+        top_n: int = Field(20, description="Maximum number of tables to return, best matches first")
+    ) -> ToolResult:
+        """Search table and column names and descriptions for one or more keywords.
         Useful for finding which tables contain data about a specific concept
-        (e.g., 'allergy', 'medication', 'diagnosis', 'lab')."""
-        schema = _get_schema_ref()
-        keyword_lower = keyword.lower()
+        (e.g., 'allergy', 'medication', 'diagnosis', 'lab').
+        Terms are prefix-matched against words in names and descriptions
+        (CamelCase names are split, so 'durable' matches PatientDurableKey) and
+        combined with AND. Tables are ranked by relevance: a table named after a term
+        ranks above tables that only mention it in column names or descriptions,
+        however many."""
+        store = _get_schema_store()
+        ranked = _get_schema_index().search(keyword, top_n)
         results = []
 
-        for table_name, info in schema.items():
-            table_match = keyword_lower in table_name.lower() or keyword_lower in (info.get("description") or "").lower()
+        for hit in ranked:
+            info = store.table(hit["table_name"])
+            columns_by_name = {col.get("name", ""): col for col in info.get("columns", [])}
             matching_columns = []
-            for col in info.get("columns", []):
-                col_name = col.get("name", "")
-                col_desc = col.get("description", "") or ""
-                if keyword_lower in col_name.lower() or keyword_lower in col_desc.lower():
-                    col_entry = {
-                        "column_name": col_name,
-                        "description": col_desc,
-                        "data_type": col.get("data_type"),
-                    }
-                    if col.get("queryable") is False:
-                        col_entry["queryable"] = False
-                        col_entry["note"] = col.get("note", "")
-                    matching_columns.append(col_entry)
-
-            if table_match or matching_columns:
-                entry = {
-                    "table_name": table_name,
-                    "table_description": info.get("description", ""),
+            for col_name in list(hit["matching_columns"])[:MAX_COLUMNS_PER_TABLE]:
+                col = columns_by_name[col_name]
+                col_entry = {
+                    "column_name": col_name,
+                    "description": col.get("description", "") or "",
+                    "data_type": col.get("data_type"),
                 }
-                if matching_columns:
-                    entry["matching_columns"] = matching_columns
-                results.append(entry)
+                if col.get("queryable") is False:
+                    col_entry["queryable"] = False
+                    col_entry["note"] = col.get("note", "")
+                matching_columns.append(col_entry)
+
+            entry = {
+                "table_name": hit["table_name"],
+                "table_description": info.get("description", ""),
+                "score": hit["score"],
+            }
+            if matching_columns:
+                entry["matching_columns"] = matching_columns
+                more = len(hit["matching_columns"]) - len(matching_columns)
+                if more > 0:
+                    entry["more_matching_columns"] = more
+            results.append(entry)
 
         if not results:
             return ToolResult(content=[TextContent(type="text", text=f"No tables or columns matching '{keyword}' found.")])
@@ -2,6 +2,8 @@
 
 import json
 import logging
+import time
+from typing import Optional
 
 from pydantic import Field
 from fastmcp.exceptions import ToolError
@@ -9,14 +11,66 @@ from fastmcp.server import FastMCP
 from fastmcp.tools.tool import ToolResult, TextContent
 from mcp.types import ToolAnnotations
 
-from cdw_medcp.config import ClinicalDBConfig
-from cdw_medcp.db import get_connection
+from cdw_medcp.codesets import CodeSetStore
+from cdw_medcp.executor import QueryExecutor
+from cdw_medcp.explain import CostGuard
+from cdw_medcp.metrics import statement, timed
 from cdw_medcp.validation import ClinicalQueryValidator
 
 logger = logging.getLogger("CDW_MedCP")
 
+NULL_COUNT_BATCH_SIZE = 200  # columns aggregated per pass over the table
+_SAMPLE_SEED = 42
 
-def register_stats_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: ClinicalDBConfig, schema: str = "deid_uf"):
+_DROP_COHORT_SQL = "IF OBJECT_ID('tempdb..#cohort') IS NOT NULL DROP TABLE #cohort"
+
+# Result keys of cohort_summary breakdowns, in GROUPING SETS column order
+_BREAKDOWNS = ("sex", "race", "ethnicity", "age_band", "vital_status")
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def _is_invalid_column(error: Exception, column: str) -> bool:
+    """True for SQL Server error 207 (Invalid column name) naming column"""
+    args = getattr(error, "args", ())
+    message = args[1] if len(args) > 1 else str(error)
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", "replace")
+    return bool(args) and args[0] == 207 and column.lower() in str(message).lower()
+
+
+def _materialize_cohort_sql(patient_key_query: str, id_column: str) -> str:
+    return (
+        f"SELECT DISTINCT sub.{id_column} AS id INTO #cohort "
+        f"FROM ({patient_key_query}) sub WHERE sub.{id_column} IS NOT NULL"
+    )
+
+
+def _breakdown_sql(schema: str, id_column: str) -> str:
+    """Sex, race, ethnicity, age band and vital status counts in one GROUPING SETS pass"""
+    # Whole years between birth and death (or today), from yyyymmdd integers
+    age = (
+        "(CONVERT(INT, CONVERT(CHAR(8), COALESCE(p.DeathDate, GETDATE()), 112)) "
+        "- CONVERT(INT, CONVERT(CHAR(8), p.BirthDate, 112))) / 10000"
+    )
+    return (
+        "SELECT GROUPING(Sex), GROUPING(FirstRace), GROUPING(Ethnicity), GROUPING(AgeBand), GROUPING(VitalStatus), "
+        "Sex, FirstRace, Ethnicity, AgeBand, VitalStatus, COUNT(*) AS n FROM ("
+        "SELECT p.Sex, p.FirstRace, p.Ethnicity, "
+        f"CASE WHEN p.BirthDate IS NULL THEN 'Unknown' "
+        f"WHEN {age} < 18 THEN '0-17' WHEN {age} < 35 THEN '18-34' WHEN {age} < 50 THEN '35-49' "
+        f"WHEN {age} < 65 THEN '50-64' WHEN {age} < 80 THEN '65-79' ELSE '80+' END AS AgeBand, "
+        "CASE WHEN p.DeathDate IS NOT NULL THEN 'Deceased' ELSE 'Alive' END AS VitalStatus "
+        f"FROM {schema}.PatientDim p "
+        f"WHERE p.IsCurrent = 1 AND p.{id_column} IN (SELECT id FROM #cohort)"
+        ") d GROUP BY GROUPING SETS ((Sex), (FirstRace), (Ethnicity), (AgeBand), (VitalStatus))"
+    )
+
+
+def register_stats_tools(mcp: FastMCP, namespace_prefix: str, executor: QueryExecutor, codesets: CodeSetStore,
+                         guard: CostGuard, schema: str = "deid_uf"):
     """Register data summarization tools"""
 
     @mcp.tool(
@@ -29,21 +83,33 @@ def register_stats_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def summarize_table(
-        table_name: str = Field(..., description="Table name to summarize")
+    async def summarize_table(
+        table_name: str = Field(..., description="Table name to summarize"),
+        sample_percent: Optional[float] = Field(None, gt=0, le=100, description=(
+            "Estimate null rates from roughly this percent of the table's pages via TABLESAMPLE "
+            "(e.g. 1 for 1%). Recommended for large fact tables. Omit for exact counts."
+        ))
     ) -> ToolResult:
-        """Get summary statistics for a table: row count, column null rates, and
-        sample value distributions for key columns."""
+        """Get summary statistics for a table: row count and column null rates.
+
+        Null counts for all columns are computed in a single aggregate pass
+        (batched for very wide tables). The row count comes from partition
+        metadata when available, so it is instant even on billion-row fact tables.
+        For tables like LabComponentResultFact or EncounterFact, pass sample_percent
+        to scan only a sample; the response reports the sampling fraction used."""
         if not table_name.replace("_", "").replace(".", "").isalnum():
             raise ToolError("Invalid table name")
 
-        conn = get_connection(clinical_config)
-        try:
+        def _summarize(conn) -> dict:
             cursor = conn.cursor()
 
             qualified_table = f"[{schema}].[{table_name}]"
-            cursor.execute(f"SELECT COUNT(*) FROM {qualified_table}")
-            row_count = cursor.fetchone()[0]
+            # Heap (0) or clustered index (1) row counts; NULL for views
+            cursor.execute(
+                f"SELECT SUM(p.rows) FROM sys.partitions p "
+                f"WHERE p.object_id = OBJECT_ID('{schema}.{table_name}') AND p.index_id IN (0, 1)"
+            )
+            metadata_row_count = cursor.fetchone()[0]
 
             cursor.execute(
                 f"SELECT COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS "
@@ -51,25 +117,57 @@ def register_stats_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             )
             columns = cursor.fetchall()
 
-            summary = {"table_name": f"{schema}.{table_name}", "row_count": row_count, "columns": []}
-            for col_name, data_type in columns[:50]:
-                cursor.execute(
-                    f"SELECT COUNT(*) FROM {qualified_table} WHERE [{col_name}] IS NULL"
-                )
-                null_count = cursor.fetchone()[0]
-                col_summary = {
+            summary = {"table_name": f"{schema}.{table_name}"}
+            source = qualified_table
+            if sample_percent and metadata_row_count is not None:
+                # REPEATABLE keeps every batch on the same sampled pages
+                source += f" TABLESAMPLE SYSTEM ({sample_percent} PERCENT) REPEATABLE ({_SAMPLE_SEED})"
+                summary["sampling_fraction"] = sample_percent / 100
+            elif sample_percent:
+                summary["sampling_note"] = "TABLESAMPLE is only supported on base tables; scanned the full view"
+
+            # One aggregate pass per batch of columns instead of one scan per column
+            scanned_rows = 0
+            null_counts = []
+            for start in range(0, max(len(columns), 1), NULL_COUNT_BATCH_SIZE):
+                batch = columns[start:start + NULL_COUNT_BATCH_SIZE]
+                exprs = [f"SUM(CASE WHEN [{col_name}] IS NULL THEN 1 ELSE 0 END)" for col_name, _ in batch]
+                if start == 0:
+                    exprs.insert(0, "COUNT_BIG(*)")
+                cursor.execute(f"SELECT {', '.join(exprs)} FROM {source}")
+                values = list(cursor.fetchone())
+                if start == 0:
+                    scanned_rows = values.pop(0)
+                null_counts.extend(v or 0 for v in values)
+
+            if metadata_row_count is not None:
+                summary["row_count"] = metadata_row_count
+                summary["row_count_source"] = "partition_metadata"
+            else:
+                summary["row_count"] = scanned_rows
+                summary["row_count_source"] = "scan"
+            if "sampling_fraction" in summary:
+                summary["sampled_rows"] = scanned_rows
+                if metadata_row_count:
+                    summary["effective_sampling_fraction"] = round(scanned_rows / metadata_row_count, 6)
+
+            summary["columns"] = [
+                {
                     "name": col_name,
                     "data_type": data_type,
                     "null_count": null_count,
-                    "null_pct": round(null_count / row_count * 100, 1) if row_count > 0 else 0,
+                    "null_pct": round(null_count / scanned_rows * 100, 1) if scanned_rows > 0 else 0,
                 }
-                summary["columns"].append(col_summary)
+                for (col_name, data_type), null_count in zip(columns, null_counts)
+            ]
 
             cursor.close()
-        finally:
-            conn.close()
+            return summary
 
-        return ToolResult(content=[TextContent(type="text", text=json.dumps(summary, indent=2))])
+        summary = await executor.run("summarize_table", _summarize, heavy=True)
+        with timed("render"):
+            text = json.dumps(summary, indent=2)
+        return ToolResult(content=[TextContent(type="text", text=text)])
 
     @mcp.tool(
         name=f"{namespace_prefix}cohort_summary",
@@ -81,7 +179,7 @@ def register_stats_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             openWorldHint=False
         )
     )
-    def cohort_summary(
+    async def cohort_summary(
         patient_key_query: str = Field(..., description=(
             "SQL subquery that returns PatientDurableKey values defining the cohort. "
             "IMPORTANT: Use PatientDurableKey (stable identifier), NOT PatientKey (SCD surrogate). "
@@ -89,7 +187,7 @@ def register_stats_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
             "WHERE DiagnosisKey IN (SELECT DiagnosisKey FROM deid_uf.DiagnosisTerminologyDim "
             "WHERE Type = 'ICD-10-CM' AND Value LIKE 'G35%')\""
         )),
-        demographics: bool = Field(True, description="Include sex/race/ethnicity breakdown")
+        demographics: bool = Field(True, description="Include sex/race/ethnicity/age band/vital status breakdown")
     ) -> ToolResult:
         """Summarize a cohort defined by a subquery returning PatientDurableKey values.
 
@@ -101,62 +199,84 @@ def register_stats_tools(mcp: FastMCP, namespace_prefix: str, clinical_config: C
 
         Use concept search tools first to find the right diagnosis/medication/procedure keys,
         then build a subquery to identify patient keys from the relevant fact table.
+        A code-set handle from expand_code_set can stand in for the key list:
+        WHERE DiagnosisKey IN ({{codeset:<handle>}}).
+
+        The subquery is executed once and materialized into a temp table; the patient
+        count and all breakdowns are computed from it. Per-phase timings are returned
+        under timings_ms. A subquery whose estimated plan exceeds the server's cost
+        limits is rejected before it runs (see explain_query).
 
         IMPORTANT: Always schema-qualify table names (e.g., deid_uf.DiagnosisEventFact).
         Do NOT join PatientDim directly to fact tables — use WHERE PatientDurableKey IN (subquery) instead."""
-        if not ClinicalQueryValidator.is_read_only_clinical_query(patient_key_query):
+        cohort_sql = codesets.expand_sql(patient_key_query)
+        if not ClinicalQueryValidator.is_read_only_clinical_query(cohort_sql):
             raise ToolError("Invalid patient_key_query — only read-only SELECT queries are allowed.")
 
-        conn = get_connection(clinical_config)
-        try:
+        def _summarize_cohort(conn) -> dict:
+            timings = {}
+            if guard.enabled:
+                started = time.perf_counter()
+                guard.check(conn, cohort_sql)
+                timings["cost_check"] = _elapsed_ms(started)
             cursor = conn.cursor()
 
-            # Auto-detect if query returns PatientDurableKey or PatientKey
-            # Try PatientDurableKey first (preferred)
-            count_sql = f"SELECT COUNT(DISTINCT PatientDurableKey) FROM ({patient_key_query}) sub"
+            # Materialize the cohort once into a session temp table so the
+            # user's (possibly expensive) query is executed a single time.
+            # Try PatientDurableKey first (preferred), fall back to PatientKey
+            # only when that column does not exist; a missing column fails at
+            # compile time, before any data is read. Any other error is raised
+            # as is rather than running the query a second time.
+            started = time.perf_counter()
+            cursor.execute(_DROP_COHORT_SQL)
+            id_column = "PatientDurableKey"
+            with statement(cohort_sql) as materialized:
+                try:
+                    cursor.execute(_materialize_cohort_sql(cohort_sql, id_column))
+                except Exception as e:
+                    if not _is_invalid_column(e, id_column):
+                        raise
+                    id_column = "PatientKey"
+                    cursor.execute(_materialize_cohort_sql(cohort_sql, id_column))
+                materialized["rows"] = max(cursor.rowcount, 0)
             try:
-                cursor.execute(count_sql)
-                count = cursor.fetchone()[0]
-                id_column = "PatientDurableKey"
-            except Exception:
-                # Fallback to PatientKey if PatientDurableKey doesn't exist in subquery
-                count_sql = f"SELECT COUNT(DISTINCT PatientKey) FROM ({patient_key_query}) sub"
-                cursor.execute(count_sql)
+                cursor.execute("CREATE UNIQUE CLUSTERED INDEX ix_cohort_id ON #cohort (id)")
+                timings["materialize"] = _elapsed_ms(started)
+
+                started = time.perf_counter()
+                cursor.execute("SELECT COUNT(*) FROM #cohort")
                 count = cursor.fetchone()[0]
-                id_column = "PatientKey"
-
-            result = {"patient_key_query": patient_key_query, "id_column": id_column, "patient_count": count}
-
-            if demographics and count > 0:
-                # Use the detected id_column for joins
-                join_col = id_column
-
-                # Sex breakdown
-                sex_sql = (
-                    f"SELECT Sex, COUNT(*) AS n FROM {schema}.PatientDim "
-                    f"WHERE IsCurrent = 1 AND {join_col} IN ({patient_key_query}) GROUP BY Sex ORDER BY n DESC"
-                )
-                cursor.execute(sex_sql)
-                result["sex"] = {str(row[0]): row[1] for row in cursor.fetchall()}
-
-                # Race breakdown
-                race_sql = (
-                    f"SELECT FirstRace, COUNT(*) AS n FROM {schema}.PatientDim "
-                    f"WHERE IsCurrent = 1 AND {join_col} IN ({patient_key_query}) GROUP BY FirstRace ORDER BY n DESC"
-                )
-                cursor.execute(race_sql)
-                result["race"] = {str(row[0]): row[1] for row in cursor.fetchall()}
-
-                # Ethnicity breakdown
-                eth_sql = (
-                    f"SELECT Ethnicity, COUNT(*) AS n FROM {schema}.PatientDim "
-                    f"WHERE IsCurrent = 1 AND {join_col} IN ({patient_key_query}) GROUP BY Ethnicity ORDER BY n DESC"
-                )
-                cursor.execute(eth_sql)
-                result["ethnicity"] = {str(row[0]): row[1] for row in cursor.fetchall()}
+                timings["count"] = _elapsed_ms(started)
+
+                result = {"patient_key_query": patient_key_query, "id_column": id_column, "patient_count": count}
+
+                if demographics and count > 0:
+                    # Every breakdown comes from one GROUPING SETS pass over PatientDim
+                    started = time.perf_counter()
+                    cursor.execute(_breakdown_sql(schema, id_column))
+                    breakdowns = {key: {} for key in _BREAKDOWNS}
+                    for row in cursor.fetchall():
+                        grouping_flags, values, n = row[:len(_BREAKDOWNS)], row[len(_BREAKDOWNS):-1], row[-1]
+                        # GROUPING() is 0 for the column this row is grouped by
+                        idx = list(grouping_flags).index(0)
+                        breakdowns[_BREAKDOWNS[idx]][str(values[idx])] = n
+                    for key, counts in breakdowns.items():
+                        result[key] = dict(sorted(counts.items(), key=lambda kv: kv[1], reverse=True))
+                    timings["breakdowns"] = _elapsed_ms(started)
+            finally:
+                # Pooled connections outlive this call; never leave the temp table behind.
+                # On a broken connection the drop fails too: log it rather than let it
+                # replace the error that broke the connection (the next call drops first).
+                try:
+                    cursor.execute(_DROP_COHORT_SQL)
+                except Exception as e:
+                    logger.warning(f"Could not drop #cohort: {e}")
 
+            result["timings_ms"] = timings
             cursor.close()
-        finally:
-            conn.close()
+            return result
 
-        return ToolResult(content=[TextContent(type="text", text=json.dumps(result, indent=2))])
+        result = await executor.run("cohort_summary", _summarize_cohort, heavy=True)
+        with timed("render"):
+            text = json.dumps(result, indent=2)
+        return ToolResult(content=[TextContent(type="text", text=text)])
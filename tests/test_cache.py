@@ -0,0 +1,15 @@
+"""SQL normalization used for result cache keys (cdw_medcp.cache)"""
+
+from cdw_medcp.cache import normalize_sql
+
+
+def test_comment_markers_inside_literals_are_kept():
+    first = normalize_sql("SELECT * FROM t WHERE x='a--b' AND y=1")
+    second = normalize_sql("SELECT * FROM t WHERE x='a--c' AND y=2")
+    assert first == "select * from t where x='a--b' and y=1"
+    assert first != second
+
+
+def test_comments_are_stripped_and_literals_kept_verbatim():
+    sql = "SELECT  a -- it's a comment\nFROM /* block\n 'x' */ T WHERE s = 'Two  Spaces'"
+    assert normalize_sql(sql) == "select a from t where s = 'Two  Spaces'"
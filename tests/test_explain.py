@@ -0,0 +1,50 @@
+"""Plan summaries and the cost guard (cdw_medcp.explain), fed recorded ShowPlanXML"""
+
+from pathlib import Path
+
+import pytest
+from fastmcp.exceptions import ToolError
+
+from cdw_medcp.config import CostGuardConfig
+from cdw_medcp.explain import CostGuard, parse_plan
+
+BATCH_PLAN = (Path(__file__).parent / "plans" / "encounter_batch.sqlplan").read_text(encoding="utf-8")
+BATCH_SQL = "SELECT e.PatientDurableKey, e.DateKey FROM deid_uf.EncounterFact e WHERE e.DateKey >= 20200101"
+
+
+def recorded(conn, sql):
+    return [BATCH_PLAN]
+
+
+def test_batch_sums_cost_and_takes_rows_of_costliest_statement():
+    summary = parse_plan([BATCH_PLAN])
+    assert summary["statements"] == 3
+    assert summary["estimated_cost"] == 412.757
+    # The last statement estimates 1 row; the expensive SELECT before it 1.25M
+    assert summary["estimated_rows"] == 1_250_000
+    assert summary["estimated_rows_of"] == "most expensive statement"
+    assert summary["seeks"] == 1
+    assert [(s["table"], s["rows_read"]) for s in summary["largest_scans"]] == [("deid_uf.EncounterFact", 48_000_000)]
+
+
+def test_guard_rejects_scan_over_max_scan_rows():
+    guard = CostGuard(CostGuardConfig(max_scan_rows=10_000_000), plan_source=recorded)
+    with pytest.raises(ToolError, match=r"scan of deid_uf\.EncounterFact reads ~48,000,000 rows"):
+        guard.check(None, BATCH_SQL)
+    assert guard.stats()["rejections"] == 1
+
+
+def test_guard_passes_plan_within_limits():
+    guard = CostGuard(CostGuardConfig(max_cost=1000, max_scan_rows=100_000_000), plan_source=recorded)
+    guard.check(None, BATCH_SQL)
+    assert guard.stats()["checks"] == 1 and guard.stats()["rejections"] == 0
+
+
+def test_guard_without_limits_fetches_no_plan():
+    def unreachable(conn, sql):
+        raise AssertionError("plan fetched with both limits off")
+
+    guard = CostGuard(CostGuardConfig(), plan_source=unreachable)
+    assert not guard.enabled
+    guard.check(None, BATCH_SQL)
+    assert guard.stats()["checks"] == 0
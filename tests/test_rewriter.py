@@ -0,0 +1,80 @@
+"""Rewrites of known slow query shapes (cdw_medcp.rewriter)"""
+
+from cdw_medcp.rewriter import rewrite_query
+
+
+def test_top_distinct_is_reordered():
+    sql, notes = rewrite_query("SELECT TOP 10 DISTINCT PatientDurableKey FROM deid_uf.EncounterFact")
+    assert sql == "SELECT DISTINCT TOP 10 PatientDurableKey FROM deid_uf.EncounterFact"
+    assert notes
+
+
+def test_patientdim_join_becomes_semi_join():
+    sql, _ = rewrite_query(
+        "SELECT f.DateKey FROM deid_uf.EncounterFact f JOIN deid_uf.PatientDim p "
+        "ON p.PatientDurableKey = f.PatientDurableKey AND p.IsCurrent = 1 WHERE p.Sex = 'Female'"
+    )
+    assert sql == (
+        "SELECT f.DateKey FROM deid_uf.EncounterFact f\n"
+        "WHERE f.PatientDurableKey IN (SELECT PatientDurableKey FROM deid_uf.PatientDim "
+        "WHERE IsCurrent = 1 AND Sex = 'Female')"
+    )
+
+
+def test_semi_join_keeps_between_together():
+    sql, _ = rewrite_query(
+        "SELECT e.DateKey FROM deid_uf.EncounterFact e JOIN deid_uf.PatientDim p "
+        "ON p.PatientDurableKey = e.PatientDurableKey "
+        "WHERE p.IsCurrent = 1 AND p.BirthDate BETWEEN '1950-01-01' AND '1960-01-01' "
+        "AND e.DateKey BETWEEN 20200101 AND 20201231"
+    )
+    assert sql == (
+        "SELECT e.DateKey FROM deid_uf.EncounterFact e\n"
+        "WHERE e.PatientDurableKey IN (SELECT PatientDurableKey FROM deid_uf.PatientDim "
+        "WHERE IsCurrent = 1 AND BirthDate BETWEEN '1950-01-01' AND '1960-01-01') "
+        "AND e.DateKey BETWEEN 20200101 AND 20201231"
+    )
+
+
+def test_join_feeding_the_output_is_left_alone():
+    original = ("SELECT p.Sex, COUNT(*) FROM deid_uf.EncounterFact f JOIN deid_uf.PatientDim p "
+                "ON p.PatientDurableKey = f.PatientDurableKey AND p.IsCurrent = 1 GROUP BY p.Sex")
+    assert rewrite_query(original) == (original, [])
+
+
+def test_converted_date_key_becomes_integer_comparison():
+    sql, _ = rewrite_query(
+        "SELECT DISTINCT PatientDurableKey FROM deid_uf.EncounterFact "
+        "WHERE CONVERT(DATE, CAST(DateKey AS VARCHAR(8)), 112) >= '2020-01-01'"
+    )
+    assert sql == "SELECT DISTINCT PatientDurableKey FROM deid_uf.EncounterFact WHERE DateKey >= 20200101"
+
+
+def test_unbounded_select_gets_top():
+    sql, _ = rewrite_query("SELECT Type FROM deid_uf.EncounterFact", row_limit=100)
+    assert sql == "SELECT TOP 101 Type FROM deid_uf.EncounterFact"
+
+
+def test_semi_join_skipped_when_where_has_top_level_or():
+    for original in (
+        "SELECT f.DateKey FROM deid_uf.EncounterFact f JOIN deid_uf.PatientDim p "
+        "ON p.PatientDurableKey = f.PatientDurableKey AND p.IsCurrent = 1 "
+        "WHERE f.Type = 'A' OR f.Type = 'B' AND p.Sex = 'Female'",
+        "SELECT f.DateKey FROM deid_uf.EncounterFact f JOIN deid_uf.PatientDim p "
+        "ON p.PatientDurableKey = f.PatientDurableKey AND p.IsCurrent = 1 "
+        "WHERE p.Sex = 'Female' OR p.Sex = 'Male'",
+    ):
+        assert rewrite_query(original) == (original, [])
+
+
+def test_semi_join_moves_parenthesized_or_as_one_condition():
+    sql, _ = rewrite_query(
+        "SELECT f.DateKey FROM deid_uf.EncounterFact f JOIN deid_uf.PatientDim p "
+        "ON p.PatientDurableKey = f.PatientDurableKey AND p.IsCurrent = 1 "
+        "WHERE (p.Sex = 'Female' OR p.Sex = 'Male')"
+    )
+    assert sql == (
+        "SELECT f.DateKey FROM deid_uf.EncounterFact f\n"
+        "WHERE f.PatientDurableKey IN (SELECT PatientDurableKey FROM deid_uf.PatientDim "
+        "WHERE IsCurrent = 1 AND (Sex = 'Female' OR Sex = 'Male'))"
+    )
@@ -0,0 +1,34 @@
+"""Ranked schema search (cdw_medcp.schema_index)"""
+
+from cdw_medcp.schema_index import SchemaIndex
+
+SCHEMA = {
+    "PatientDim": {
+        "description": "One row per patient version",
+        "columns": [{"name": "PatientDurableKey"}, {"name": "Sex"}, {"name": "BirthDate"}],
+    },
+    # Wide fact table mentioning patients in dozens of columns
+    "SurgicalCaseFact": {
+        "description": "Surgical cases",
+        "columns": [{"name": f"Patient{i}Flag", "description": "Patient status flag"} for i in range(40)],
+    },
+    "MedicationDim": {
+        "description": "One row per medication",
+        "columns": [{"name": "MedicationKey"}, {"name": "Name"}, {"name": "GenericName"}],
+    },
+    "MedicationAdministrationFact": {
+        "description": "Medication administrations",
+        "columns": [{"name": "MedicationKey"}, {"name": "MedicationRoute"}, {"name": "PatientDurableKey"}],
+    },
+}
+
+
+def test_table_name_hit_outranks_many_column_hits():
+    ranked = [r["table_name"] for r in SchemaIndex.build(SCHEMA).search("patient")]
+    assert ranked[0] == "PatientDim"
+    assert ranked.index("SurgicalCaseFact") > ranked.index("PatientDim")
+
+
+def test_closer_table_name_ranks_first():
+    ranked = [r["table_name"] for r in SchemaIndex.build(SCHEMA).search("medication")]
+    assert ranked[:2] == ["MedicationDim", "MedicationAdministrationFact"]